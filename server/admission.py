@@ -0,0 +1,98 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from aiohttp import web
+
+from common import JobData
+from counters import API_REQUESTS_REJECTED_CTR
+import loop_monitor
+
+
+CLIENT_RATE = float(os.environ.get("API_RATE_LIMIT_PER_CLIENT", 20))
+CLIENT_BURST = int(os.environ.get("API_RATE_LIMIT_BURST", 40))
+EMAIL_RATE = float(os.environ.get("ADD_SERVICE_RATE_LIMIT_PER_EMAIL", 1))
+EMAIL_BURST = int(os.environ.get("ADD_SERVICE_RATE_LIMIT_BURST", 10))
+MAX_PENDING_JOB_STARTS = int(os.environ.get("MAX_PENDING_JOB_STARTS", 1000))
+SHED_LAG_THRESHOLD = int(os.environ.get("LOAD_SHED_LAG_MS", 500)) / 1000
+SHED_RETRY_AFTER = 1
+# X-Forwarded-For is only honoured behind a trusted load balancer
+TRUST_FORWARDED_FOR = os.environ.get("API_TRUST_FORWARDED_FOR") is not None
+MAX_TRACKED_KEYS = 10_000
+
+# acknowledging alerts and probes of the platform itself are never limited
+# /local_jobs is queried by the other pods for listings already admitted by them
+EXEMPT_ROUTES = {'/healthz', '/readyz', '/metrics_handler', '/receive_alert', '/local_jobs'}
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by client address or email.
+    Least recently used keys are evicted above `max_keys`, which at worst refills their bucket.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = MAX_TRACKED_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[Hashable, list] = OrderedDict()
+
+    def acquire(self, key: Hashable, now: Optional[float] = None) -> float:
+        """
+        Takes a token from the bucket of `key`.
+        :param key: client address or email
+        :param now: monotonic time, current time if not provided
+        :return: 0 if a token was taken, otherwise seconds until the next token is available
+        """
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        self._buckets[key] = bucket
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0
+        bucket[0] = tokens
+        return (1 - tokens) / self.rate
+
+
+CLIENT_LIMITER = RateLimiter(CLIENT_RATE, CLIENT_BURST)
+EMAIL_LIMITER = RateLimiter(EMAIL_RATE, EMAIL_BURST)
+
+# jobs saved by add_service waiting for job_starter_task to start pinging them
+PENDING_JOB_STARTS: asyncio.Queue[JobData] = asyncio.Queue(MAX_PENDING_JOB_STARTS)
+
+
+def reject(status: int, reason: str, retry_after: float) -> web.Response:
+    API_REQUESTS_REJECTED_CTR.labels(reason).inc()
+    return web.json_response({'error': reason}, status=status,
+                             headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+def client_key(request: web.Request) -> str:
+    if TRUST_FORWARDED_FOR and 'X-Forwarded-For' in request.headers:
+        return request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return request.remote
+
+
+@web.middleware
+async def admission_middleware(request: web.Request, handler):
+    """Sheds load while the event loop lags and limits the request rate of every client."""
+    resource = request.match_info.route.resource
+    if resource is not None and resource.canonical in EXEMPT_ROUTES:
+        return await handler(request)
+
+    if loop_monitor.current_lag() > SHED_LAG_THRESHOLD:
+        return reject(503, "overloaded", SHED_RETRY_AFTER)
+    retry_after = CLIENT_LIMITER.acquire(client_key(request))
+    if retry_after:
+        return reject(429, "rate_limited_client", retry_after)
+    return await handler(request)
@@ -0,0 +1,100 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from counters import CIRCUITS_OPEN_GAUGE, CIRCUIT_TRANSITIONS_CTR
+
+
+# consecutive connect failures of pings to one host after which its circuit opens, 0 disables circuit breaking
+FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 20))
+# while open, one trial ping per that many seconds checks whether the host is reachable again
+OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", 10))
+MAX_TRACKED_HOSTS = 10_000
+
+# outcomes of allow()
+CLOSED = "closed"
+TRIAL = "trial"
+OPEN = "open"
+
+
+class CircuitBreaker:
+    """
+    Circuit breakers of pinged hosts, only hosts with recent connect failures are tracked.
+
+    After `failure_threshold` consecutive connect failures the circuit of a host opens and its
+    pings are short-circuited, except a single trial ping every `open_seconds`. A trial that
+    connects closes the circuit for all jobs of the host, a failed one keeps it open.
+    Least recently failing hosts are evicted above `max_hosts`, which at worst closes their circuit.
+    """
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, open_seconds: float = OPEN_SECONDS,
+                 max_hosts: int = MAX_TRACKED_HOSTS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_hosts = max_hosts
+        # host -> [consecutive connect failures, opened at (None while closed), trial in flight]
+        self._hosts: OrderedDict[str, list] = OrderedDict()
+
+    def allow(self, host: str, now: Optional[float] = None) -> str:
+        """
+        :param host: host (and port) of the pinged url
+        :param now: monotonic time, current time if not provided
+        :return: CLOSED or TRIAL if the ping may be sent, OPEN if it is short-circuited
+        """
+        entry = self._hosts.get(host)
+        if entry is None or entry[1] is None:
+            return CLOSED
+        now = time.monotonic() if now is None else now
+        if not entry[2] and now - entry[1] >= self.open_seconds:
+            entry[2] = True
+            return TRIAL
+        return OPEN
+
+    def record(self, host: str, connect_failed: bool, trial: bool = False, now: Optional[float] = None) -> None:
+        """
+        :param host: host (and port) of the pinged url
+        :param connect_failed: whether the ping failed to connect, any HTTP response counts as connected
+        :param trial: whether the ping was the trial of an open circuit
+        :param now: monotonic time, current time if not provided
+        :return: None
+        """
+        if self.failure_threshold <= 0:
+            return
+        entry = self._hosts.get(host)
+        if not connect_failed:
+            if entry is not None:
+                del self._hosts[host]
+                if entry[1] is not None:
+                    self._transition("closed")
+            return
+
+        now = time.monotonic() if now is None else now
+        if entry is None:
+            entry = [0, None, False]
+            self._hosts[host] = entry
+            if len(self._hosts) > self.max_hosts:
+                _, evicted = self._hosts.popitem(last=False)
+                if evicted[1] is not None:
+                    self._transition("closed")
+        else:
+            self._hosts.move_to_end(host)
+        entry[0] += 1
+        if entry[1] is None:
+            if entry[0] >= self.failure_threshold:
+                entry[1] = now
+                self._transition("open")
+        elif trial:
+            # stays open until the next trial
+            entry[1] = now
+            entry[2] = False
+
+    def _transition(self, to: str) -> None:
+        CIRCUIT_TRANSITIONS_CTR.labels(to).inc()
+        if to == "open":
+            CIRCUITS_OPEN_GAUGE.inc()
+        else:
+            CIRCUITS_OPEN_GAUGE.dec()
+
+
+BREAKER = CircuitBreaker()
@@ -6,12 +6,30 @@ job_id_t = int
 notification_id_t = int
 JobData = namedtuple("JobData", ["job_id", "mail1", "mail2", "url", "period", "window", "response_time", "is_active"])
 NotificationData = namedtuple("NotificationData", ["notification_id", "time_sent", "admin_responded", "notification_num", "job_id"])
+JobStatsData = namedtuple("JobStatsData", ["job_id", "minute", "pings_ok", "pings_failed", "latency_sum_ms", "latency_max_ms"])
+AlertTimings = namedtuple("AlertTimings", ["notification_id", "first_failure", "decided", "committed", "smtp_accepted"])
 
 
 DB_HOST = os.environ.get("DB_HOST")
-DB_PORT = 5432
+DB_PORT = int(os.environ.get("DB_PORT", 5432))
+# optional read-only replica for listing and recovery reads, e.g. the -ro service of the cluster
+DB_RO_HOST = os.environ.get("DB_RO_HOST")
+DB_RO_PORT = int(os.environ.get("DB_RO_PORT", DB_PORT))
+# listings read from the primary while the replica's data is older than that
+DB_RO_MAX_LAG_SECONDS = float(os.environ.get("DB_RO_MAX_LAG_SECONDS", 5))
 
 APP_HOST = os.environ.get("APP_HOST")
-APP_PORT = 8080
+APP_PORT = int(os.environ.get("APP_PORT", 8080))
+
+NOTIFICATIONS_PARTITIONS_AHEAD = 3
+NOTIFICATIONS_RETENTION_DAYS = int(os.environ.get("NOTIFICATIONS_RETENTION_DAYS", 365))
+NOTIFICATIONS_ARCHIVE = os.environ.get("NOTIFICATIONS_ARCHIVE") is not None
+NOTIFICATIONS_RECOVERY_LOOKBACK_HOURS = int(os.environ.get("NOTIFICATIONS_RECOVERY_LOOKBACK_HOURS", 24 * 7))
+
+JOBS_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("JOBS_ARCHIVE_INTERVAL_SECONDS", 300))
+JOBS_ARCHIVE_BATCH_SIZE = int(os.environ.get("JOBS_ARCHIVE_BATCH_SIZE", 500))
 
 ERR_MSG_CREATE_POSITIVE_INT = "fields 'period', 'alerting_window' and 'response_time' should be positive integers"
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+ERR_MSG_IDEMPOTENCY_KEY = f"header 'Idempotency-Key' should have 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters"
+ERR_MSG_IDEMPOTENCY_KEY_REUSED = "header 'Idempotency-Key' was already used for a different service"
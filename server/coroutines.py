@@ -1,16 +1,25 @@
 import asyncio
+import collections
 import time
 import smtplib
-from queue import PriorityQueue
-from aiohttp import ClientSession
-from typing import Tuple, Optional
+from aiohttp import ClientSession, ClientConnectorError, ClientConnectorDNSError, ClientTimeout, ConnectionTimeoutError, \
+    DummyCookieJar, TCPConnector, TraceConfig
+from yarl import URL
+from typing import List, Optional, Tuple
 from email.mime.text import MIMEText
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import threading
 
 
+import admission
+import circuit_breaker
 import db_access
+import dns_cache
+import job_index
+import job_stats
+import job_state
+from job_state import JobState
 from common import *
 from counters import *
 
@@ -18,6 +27,33 @@ from counters import *
 active_jobs_cache = set()
 active_jobs_sync_loc = threading.Lock()
 cleanup_job_initialized = False
+_ping_session: Optional[ClientSession] = None
+
+write_queue = db_access.WriteBehindQueue(lambda: db_access.setup_connection(DB_HOST, DB_PORT))
+
+DISPATCH_TICK = int(os.environ.get("DISPATCH_TICK_MS", 10)) / 1000
+# alerting windows of all jobs are checked at once, that often
+WINDOW_CHECK_INTERVAL = int(os.environ.get("WINDOW_CHECK_MS", 100)) / 1000
+# PING_KEEPALIVE=0 opens a new connection for every ping
+PING_KEEPALIVE = os.environ.get("PING_KEEPALIVE") != "0"
+# 0 lets the pool of a host grow to the number of its concurrent pings, a limit makes further pings wait
+PING_CONNECTIONS_PER_HOST = int(os.environ.get("PING_CONNECTIONS_PER_HOST", 0))
+PING_KEEPALIVE_SECONDS = float(os.environ.get("PING_KEEPALIVE_SECONDS", 30))
+PING_CONNECTIONS_SAMPLE_SECONDS = 15
+# connecting to a host that does not answer fails after that long instead of the total timeout of 5 minutes
+PING_CONNECT_TIMEOUT = ClientTimeout(total=5 * 60, sock_connect=float(os.environ.get("PING_CONNECT_TIMEOUT_SECONDS", 10)))
+# alerted jobs keep being probed with exponential backoff, from their period up to DEGRADED_PROBE_MAX_SECONDS,
+# until they recover or DEGRADED_PROBE_MAX_HOURS pass
+DEGRADED_PROBING = os.environ.get("DEGRADED_PROBING") != "0"
+DEGRADED_PROBE_MAX_SECONDS = float(os.environ.get("DEGRADED_PROBE_MAX_SECONDS", 300))
+DEGRADED_PROBE_MAX_HOURS = float(os.environ.get("DEGRADED_PROBE_MAX_HOURS", 24))
+DEGRADED_RECOVERY_SUCCESSES = int(os.environ.get("DEGRADED_RECOVERY_SUCCESSES", 3))
+# recovered jobs are pinged again at full rate unless DEGRADED_REARM=0
+DEGRADED_REARM = os.environ.get("DEGRADED_REARM") != "0"
+DEGRADED_PROBE_TIMEOUT = ClientTimeout(total=10)
+# second notifications of escalations resumed after a restart sent concurrently
+RECOVERY_ESCALATION_WORKERS = int(os.environ.get("RECOVERY_ESCALATION_WORKERS", 8))
+RECOVERY_READ_BATCH = 1000
 
 smtp_server = os.environ.get("SMTP_SERVER")
 smtp_server = 'smtp.gmail.com' if not smtp_server else smtp_server
@@ -35,6 +71,7 @@ def send_email(to: str, subject: str, body: str):
     msg['Subject'] = subject
     msg['From'] = smtp_username
     msg['To'] = to
+    start = time.perf_counter()
     try:
         logging.info("Email sent", extra={"json_fields": log_data})
         smtp = smtplib.SMTP(smtp_server, smtp_port)
@@ -48,8 +85,10 @@ def send_email(to: str, subject: str, body: str):
                 raise e
         smtp.sendmail(smtp_username, to, msg.as_string())
     except Exception as e:
+        EMAIL_SEND_DURATION_HIST.labels("error").observe(time.perf_counter() - start)
         logging.error(f"Error sending email: {e}", extra={"json_fields": log_data})
         raise e
+    EMAIL_SEND_DURATION_HIST.labels("success").observe(time.perf_counter() - start)
 
 
 def send_alert(to: str, url: str, notification_id: int):
@@ -63,7 +102,206 @@ def send_alert(to: str, url: str, notification_id: int):
     send_email(to, subject, body)
 
 
-async def pinging_task(job_data: JobData, pod_index: int):
+def ping_phase(job_id: job_id_t, period: float) -> float:
+    """
+    :param job_id: job id
+    :param period: pinging period in seconds
+    :return: stable offset of the job's pings within the period, in seconds
+    """
+    # Knuth's multiplicative hash, spreads consecutive ids evenly over the period
+    return ((job_id * 2654435761) & 0xFFFFFFFF) / 2 ** 32 * period
+
+
+def first_ping_delay(job_id: job_id_t, period: float, now: Optional[float] = None) -> float:
+    """
+    :param job_id: job id
+    :param period: pinging period in seconds
+    :param now: unix time, current time if not provided
+    :return: seconds until the job's next ping on the schedule aligned to the unix epoch
+    """
+    now = time.time() if now is None else now
+    return (ping_phase(job_id, period) - now) % period
+
+
+_dispatch_tick = 0
+_dispatch_tick_count = 0
+
+
+def count_dispatch():
+    """
+    Counts a ping dispatched in the current scheduler tick and observes the count of the previous tick.
+    Ticks without dispatches are not observed.
+    :return: None
+    """
+    global _dispatch_tick, _dispatch_tick_count
+    tick = int(time.monotonic() / DISPATCH_TICK)
+    if tick != _dispatch_tick:
+        if _dispatch_tick_count:
+            PINGS_DISPATCHED_PER_TICK_HIST.observe(_dispatch_tick_count)
+        _dispatch_tick = tick
+        _dispatch_tick_count = 0
+    _dispatch_tick_count += 1
+
+
+async def record_alert_timings(timings: AlertTimings):
+    """
+    Observes the stages of an alert's detection latency and stores them on its notification.
+    :param timings: timings of a first notification, smtp_accepted is None if sending failed
+    :return: None
+    """
+    ALERT_LATENCY_HIST.labels("detection").observe((timings.decided - timings.first_failure).total_seconds())
+    ALERT_LATENCY_HIST.labels("commit").observe((timings.committed - timings.decided).total_seconds())
+    if timings.smtp_accepted is not None:
+        ALERT_LATENCY_HIST.labels("smtp").observe((timings.smtp_accepted - timings.committed).total_seconds())
+        ALERT_LATENCY_HIST.labels("end_to_end").observe((timings.smtp_accepted - timings.first_failure).total_seconds())
+    try:
+        await write_queue.save_alert_timings(timings)
+    except Exception as e:
+        logging.error("Error saving alert timings: %s", e,
+                      extra={"json_fields": {"function_name": "record_alert_timings", "notification_id": timings.notification_id}})
+
+
+async def _connection_created(session, context, params):
+    PING_CONNECTIONS_OPENED_CTR.labels("new").inc()
+
+
+async def _connection_reused(session, context, params):
+    PING_CONNECTIONS_OPENED_CTR.labels("reused").inc()
+
+
+def ping_session() -> ClientSession:
+    """
+    :return: session shared by all pings, created on first use as it needs a running event loop
+    """
+    global _ping_session
+    if _ping_session is None or _ping_session.closed:
+        if PING_KEEPALIVE:
+            # jobs on the same host share a pool of keep-alive connections
+            connector = TCPConnector(resolver=dns_cache.RESOLVER, use_dns_cache=False, limit=0,
+                                     limit_per_host=PING_CONNECTIONS_PER_HOST, keepalive_timeout=PING_KEEPALIVE_SECONDS)
+        else:
+            connector = TCPConnector(resolver=dns_cache.RESOLVER, use_dns_cache=False, limit=0, force_close=True)
+        trace_config = TraceConfig()
+        trace_config.on_connection_create_end.append(_connection_created)
+        trace_config.on_connection_reuseconn.append(_connection_reused)
+        # cookies set by one probed service must not be sent back on later probes
+        _ping_session = ClientSession(cookie_jar=DummyCookieJar(), connector=connector, trace_configs=[trace_config],
+                                      timeout=PING_CONNECT_TIMEOUT)
+    return _ping_session
+
+
+def sample_ping_connections():
+    """
+    Sets the gauges of open ping connections. Per-host counts are only aggregated,
+    a label per host would be unbounded.
+    :return: None
+    """
+    connector = _ping_session.connector if _ping_session is not None and not _ping_session.closed else None
+    # the connector does not expose its pools publicly
+    idle = getattr(connector, "_conns", {})
+    in_use = getattr(connector, "_acquired_per_host", {})
+    per_host = collections.Counter()
+    for key, connections in idle.items():
+        per_host[key.host] += len(connections)
+    for key, connections in in_use.items():
+        per_host[key.host] += len(connections)
+    PING_CONNECTIONS_GAUGE.labels("idle").set(sum(len(connections) for connections in idle.values()))
+    PING_CONNECTIONS_GAUGE.labels("in_use").set(sum(len(connections) for connections in in_use.values()))
+    PING_CONNECTION_HOSTS_GAUGE.set(sum(1 for count in per_host.values() if count))
+    PING_CONNECTIONS_PER_HOST_MAX_GAUGE.set(max(per_host.values(), default=0))
+
+
+async def ping_connections_task():
+    """
+    Samples the open ping connections every PING_CONNECTIONS_SAMPLE_SECONDS.
+    :return: None
+    """
+    while True:
+        await asyncio.sleep(PING_CONNECTIONS_SAMPLE_SECONDS)
+        sample_ping_connections()
+
+
+async def close_ping_session():
+    global _ping_session
+    if _ping_session is not None:
+        await _ping_session.close()
+        _ping_session = None
+
+
+def ping_host(url: str) -> str:
+    """
+    :return: host and port of `url`, the unit of circuit breaking
+    """
+    try:
+        url = URL(url)
+    except ValueError:
+        return url
+    return f"{url.host}:{url.port}"
+
+
+async def single_request(state: JobState):
+    """
+    Pings the job's url once and records the outcome in its state.
+    :param state: state of the pinged job
+    :return: None
+    """
+    job_id = state.job.job_id
+    sent_ns = time.time_ns()
+    state.sent(sent_ns)
+    host = ping_host(state.job.url)
+    circuit = circuit_breaker.BREAKER.allow(host)
+    if circuit == circuit_breaker.OPEN:
+        # counts towards the alerting window like the connect failure it stands for
+        PINGS_SHORT_CIRCUITED_CTR.inc()
+        job_stats.STORE.record_ping(job_id, False, 0)
+        return
+    trial = circuit == circuit_breaker.TRIAL
+    is_connected = False
+    start = time.perf_counter()
+    try:
+        session = ping_session()
+        PINGS_SENT_CTR.inc()
+        is_connected = True
+        HTTP_CONNS_ACTIVE_CTR.inc()
+        async with session.get(state.job.url) as response:
+            duration = time.perf_counter() - start
+            if 200 <= response.status < 300:
+                SUCCESSFUL_PINGS_CTR.inc()
+                PING_DURATION_HIST.labels("success").observe(duration)
+                job_stats.STORE.record_ping(job_id, True, int(duration * 1000))
+                state.succeeded(sent_ns)
+            else:
+                PING_DURATION_HIST.labels("failure").observe(duration)
+                job_stats.STORE.record_ping(job_id, False, int(duration * 1000))
+            HTTP_CONNS_ACTIVE_CTR.dec()
+        circuit_breaker.BREAKER.record(host, False, trial)
+    except ClientConnectorDNSError:
+        # the resolver only fails once no cached address of the host is younger than DNS_STALE_SECONDS,
+        # from then on the host is as unreachable as a service that is down
+        duration = time.perf_counter() - start
+        PING_DURATION_HIST.labels("dns_error").observe(duration)
+        job_stats.STORE.record_ping(job_id, False, int(duration * 1000))
+        HTTP_CONNS_ACTIVE_CTR.dec()
+        circuit_breaker.BREAKER.record(host, True, trial)
+    except BaseException as e:
+        duration = time.perf_counter() - start
+        PING_DURATION_HIST.labels("error").observe(duration)
+        job_stats.STORE.record_ping(job_id, False, int(duration * 1000))
+        if is_connected:
+            HTTP_CONNS_ACTIVE_CTR.dec()
+        # a cancelled trial keeps the circuit open until the next one
+        connect_failed = isinstance(e, (ClientConnectorError, ConnectionTimeoutError)) or not isinstance(e, Exception)
+        circuit_breaker.BREAKER.record(host, connect_failed, trial)
+
+
+async def pinging_task(job_data: JobData, pod_index: int, ping_now: bool = False):
+    """
+    Pings the job's url every period until the job alerts or is no longer active.
+    :param job_data: pinged job
+    :param pod_index: pod index
+    :param ping_now: send the first ping right away instead of at the job's phase, for new jobs
+    :return: None
+    """
     global cleanup_job_initialized, active_jobs_sync_loc
     with active_jobs_sync_loc:
         active_jobs_cache.add(job_data.job_id)
@@ -72,120 +310,260 @@ async def pinging_task(job_data: JobData, pod_index: int):
             cleanup_job_initialized = True
             asyncio.create_task(active_job_updater_task(pod_index))
 
-    async def single_request():
-        is_connected = False
-        try:
-            async with ClientSession() as session:
-                PINGS_SENT_CTR.inc()
-                is_connected = True
-                HTTP_CONNS_ACTIVE_CTR.inc()
-                async with session.get(job_data.url) as response:
-                    if 200 <= response.status < 300:
-                        SUCCESSFUL_PINGS_CTR.inc()
-                    HTTP_CONNS_ACTIVE_CTR.dec()
-                    return response
-        except:
-            if is_connected:
-                HTTP_CONNS_ACTIVE_CTR.dec()
-            return None
-
-    futures: PriorityQueue[Tuple[int, asyncio.Task]] = PriorityQueue()
-    while True:
-
-        delay_start = time.time_ns()
-        with active_jobs_sync_loc:
-            if job_data.job_id not in active_jobs_cache:
-                logging.info(f"Found that job with {job_data.job_id} is not active. finishing task.", extra={"json_fields": job_data})
-                JOBS_ACTIVE_CTR.dec()
+    loop = asyncio.get_running_loop()
+    period = job_data.period / 1000
+    # pings follow an absolute schedule at the job's own phase, so jobs started
+    # together (e.g. by recover_jobs) do not ping in the same tick
+    state = JobState(job_data, loop.time() + first_ping_delay(job_data.job_id, period), job_state.WINDOWS)
+    dns_cache.RESOLVER.prefetch(job_data.url)
+    job_stats.STORE.acquire(job_data.job_id)
+    try:
+        if ping_now:
+            # the alerting window of a new job starts with its first ping, it must not wait for the phase
+            asyncio.create_task(single_request(state))
+            count_dispatch()
+        await asyncio.sleep(state.next_ping - loop.time())
+        while True:
+            # released by window_checker_task once the job alerted
+            if state.slot is None:
                 return
 
-        task = asyncio.create_task(single_request())
-        futures.put((time.time_ns(), task))
+            with active_jobs_sync_loc:
+                if job_data.job_id not in active_jobs_cache:
+                    logging.info(f"Found that job with {job_data.job_id} is not active. finishing task.", extra={"json_fields": job_data})
+                    JOBS_ACTIVE_CTR.dec()
+                    job_stats.STORE.release(job_data.job_id)
+                    return
+
+            asyncio.create_task(single_request(state))
+            count_dispatch()
+
+            state.next_ping += period
+            now = loop.time()
+            if state.next_ping < now:
+                logging.warning("handling the event loop consumed more time than the pinging period! keeping pinging period cannot be guaranteed!", extra={"json_fields": job_data})
+                # skip the missed pings instead of sending them in a burst
+                state.next_ping += ((now - state.next_ping) // period + 1) * period
+            await asyncio.sleep(state.next_ping - now)
+    finally:
+        state.release()
 
-        latest = -1
-        for (t, ftr) in futures.queue:
-            if ftr.done():
-                resp = ftr.result()
-                if resp is not None and 200 <= resp.status < 300:
-                    latest = max(latest, t)
 
-        tmp: Optional[Tuple[int, asyncio.Task]] = None
+async def alert(state: JobState, first_failure_ns: int, pod_index: int):
+    """
+    Sends the first notification of a job whose alerting window elapsed and, if the admin
+    does not respond in time and the service did not recover meanwhile, the second one.
+    :param state: state of the job, already released from the window table
+    :param first_failure_ns: send time of the oldest ping not followed by a successful one
+    :param pod_index: pod index
+    :return: None
+    """
+    job_data = state.job
+    first_failure = datetime.fromtimestamp(first_failure_ns / 1_000_000_000)
+    decided = datetime.now()
+    # committed together, before the email is sent
+    notification_id, _ = await asyncio.gather(
+        write_queue.save_notification(NotificationData(-1, decided, False, 1, job_data.job_id)),
+        write_queue.set_job_inactive(job_data.job_id)
+    )
+    committed = datetime.now()
+    state.notification_id = notification_id
+    job_index.INDEX.set_active(job_data.job_id, False)
+    JOBS_ACTIVE_CTR.dec()
+    job_stats.STORE.release(job_data.job_id)
+    if DEGRADED_PROBING:
+        asyncio.create_task(degraded_probing_task(state, pod_index))
+
+    smtp_accepted = None
+    try:
+        send_alert(job_data.mail1, job_data.url, notification_id)
+        smtp_accepted = datetime.now()
+    finally:
+        await record_alert_timings(AlertTimings(notification_id, first_failure, decided, committed, smtp_accepted))
 
-        while True:
-            if futures.empty():
-                tmp = None
-                break
-            tmp = futures.get()
-            if tmp[0] <= latest:
-                continue
-            futures.put(tmp)
-            break
+    await asyncio.sleep(job_data.response_time / 1000)
+    if state.recovered:
+        return
+    conn = db_access.setup_connection(DB_HOST, DB_PORT)
+    try:
+        admin_responded = db_access.get_notification_by_id(notification_id, conn).admin_responded
+    finally:
+        conn.close()
 
-        if tmp is not None:
-            if (time.time_ns() - tmp[0]) / 1_000_000 >= job_data.window:
-                conn = db_access.setup_connection(DB_HOST, DB_PORT)
+    if not admin_responded:
+        second_notification_id = await write_queue.save_notification(NotificationData(-1, datetime.now(), False, 2, job_data.job_id))
+        send_alert(job_data.mail2, job_data.url, second_notification_id)
 
-                try:
-                    notification_id = db_access.save_notification(NotificationData(-1, datetime.now(), False, 1, job_data.job_id), conn)
-                    JOBS_ACTIVE_CTR.dec()
 
-                    send_alert(job_data.mail1, job_data.url, notification_id)
-                    db_access.set_job_inactive(job_data.job_id, conn)
+async def probe(url: str) -> bool:
+    """
+    :param url: url of an alerted job
+    :return: whether the service responded with 2xx
+    """
+    try:
+        async with ping_session().get(url, timeout=DEGRADED_PROBE_TIMEOUT) as response:
+            ok = 200 <= response.status < 300
+    except Exception:
+        ok = False
+    DEGRADED_PROBES_CTR.labels("success" if ok else "failure").inc()
+    return ok
 
-                finally:
-                    conn.close()
-                try:
 
-                    await asyncio.sleep(job_data.response_time / 1000)
-                    conn = db_access.setup_connection(DB_HOST, DB_PORT)
+async def degraded_probing_task(state: JobState, pod_index: int):
+    """
+    Probes an alerted job with exponential backoff, so targets that are down get a fraction of the
+    full-rate load. After DEGRADED_RECOVERY_SUCCESSES successful probes in a row the job is considered
+    recovered, which cancels its pending escalation, and is re-armed.
+    :param state: state of the alerted job
+    :param pod_index: pod index
+    :return: None
+    """
+    job_data = state.job
+    log_data = {"function_name": "degraded_probing_task", "job_id": job_data.job_id}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DEGRADED_PROBE_MAX_HOURS * 3600
+    delay = job_data.period / 1000
+    successes = 0
+    JOBS_DEGRADED_GAUGE.inc()
+    try:
+        while successes < DEGRADED_RECOVERY_SUCCESSES:
+            if loop.time() + delay > deadline:
+                logging.info("Job did not recover, stopped probing", extra={"json_fields": log_data})
+                return
+            await asyncio.sleep(delay)
+            if await probe(job_data.url):
+                # recovery is confirmed at the current rate
+                successes += 1
+            else:
+                successes = 0
+                delay = min(delay * 2, max(DEGRADED_PROBE_MAX_SECONDS, job_data.period / 1000))
+    finally:
+        JOBS_DEGRADED_GAUGE.dec()
+
+    state.recovered = True
+    JOBS_RECOVERED_CTR.inc()
+    logging.info("Job recovered", extra={"json_fields": log_data})
+    if not DEGRADED_REARM:
+        return
+    conn = db_access.setup_connection(DB_HOST, DB_PORT)
+    try:
+        rearmed = db_access.set_job_active(job_data.job_id, pod_index, conn)
+    except Exception as e:
+        logging.error("Error re-arming a recovered job: %s", e, extra={"json_fields": log_data})
+        return
+    finally:
+        conn.close()
+    if not rearmed:
+        # deleted, or archived once its escalation ended
+        logging.info("Recovered job is no longer stored, not re-armed", extra={"json_fields": log_data})
+        return
+    job_index.INDEX.set_active(job_data.job_id, True)
+    logging.info("Recovered job re-armed", extra={"json_fields": log_data})
+    asyncio.create_task(new_job(job_data._replace(is_active=True), pod_index, ping_now=True))
 
-                    if not db_access.get_notification_by_id(notification_id, conn).admin_responded:
-                        second_notification_id = db_access.save_notification(NotificationData(-1, datetime.now(), False, 2, job_data.job_id), conn)
-                        send_alert(job_data.mail2, job_data.url, second_notification_id)
 
-                finally:
-                    conn.close()
+async def window_checker_task(pod_index: int):
+    """
+    Finds every job whose alerting window elapsed in one vectorized pass per tick and starts its alert.
+    :param pod_index: pod index
+    :return: None
+    """
+    while True:
+        await asyncio.sleep(WINDOW_CHECK_INTERVAL)
+        start = time.perf_counter()
+        for state in job_state.WINDOWS.due(time.time_ns()):
+            first_failure_ns = state.oldest_unconfirmed()
+            state.release()
+            asyncio.create_task(alert(state, first_failure_ns, pod_index))
+        WINDOW_CHECK_DURATION_HIST.observe(time.perf_counter() - start)
 
-                return
 
-        delay = time.time_ns() - delay_start
-        if delay / 1_000_000 > job_data.period:
-            logging.warning("handling the event loop consumed more time than the pinging period! keeping pinging period cannot be guaranteed!", extra={"json_fields": job_data})
-        await asyncio.sleep(max(0, job_data.period / 1000 - delay / 1_000_000))
+async def new_job(job_data: JobData, pod_index: int, ping_now: bool = False):
+    JOBS_ACTIVE_CTR.inc()
+    await pinging_task(job_data, pod_index, ping_now)
 
 
-async def new_job(job_data: JobData, pod_index: int):
-    JOBS_ACTIVE_CTR.inc()
-    await pinging_task(job_data, pod_index)
+async def job_starter_task(pod_index: int):
+    """
+    Starts pinging jobs admitted by add_service, one per event loop iteration.
+    :param pod_index: pod index
+    :return: None
+    """
+    while True:
+        job_data = await admission.PENDING_JOB_STARTS.get()
+        asyncio.create_task(new_job(job_data, pod_index, ping_now=True))
+        # get() does not yield while the queue is non-empty
+        await asyncio.sleep(0)
 
 
-async def continue_notifications(job_data: JobData, notification_data: NotificationData):
-    log_data = {"function_name": "continue_notifications", "job_data": job_data._asdict()}
-    logging.info("Continue notifications called", extra={"json_fields": log_data})
+async def resume_escalations(pending: List[Tuple[JobData, NotificationData]], workers: int = RECOVERY_ESCALATION_WORKERS):
+    """
+    Resumes escalations interrupted by a restart. Jobs whose response time elapsed are checked in
+    batches, the notifications of a batch are re-read with one query, and second notifications are
+    sent by a bounded pool of workers, so recovering thousands of alerts uses a single connection.
+    :param pending: pending jobs with their newest (unacknowledged first) notification
+    :param workers: number of second notifications sent concurrently
+    :return: None
+    """
+    log_data = {"function_name": "resume_escalations", "jobs": len(pending)}
+    logging.info("Resuming escalations", extra={"json_fields": log_data})
 
-    if job_data.is_active:
-        try:
-            conn = db_access.setup_connection(DB_HOST, DB_PORT)
-            db_access.set_job_inactive(job_data.job_id, conn)
-        finally:
-            conn.close()
+    # committed in one transaction by the write-behind queue
+    deactivations = [write_queue.set_job_inactive(job.job_id) for job, _ in pending if job.is_active]
+    if deactivations:
+        await asyncio.gather(*deactivations)
+        for job, _ in pending:
+            job_index.INDEX.set_active(job.job_id, False)
+
+    def deadline(item: Tuple[JobData, NotificationData]) -> float:
+        job, notification = item
+        return notification.time_sent.timestamp() + job.response_time / 1000
 
-    remaining_response_time = notification_data.time_sent.timestamp() * 1000 + job_data.response_time - time.time_ns() / 1_000_000
+    waiting = collections.deque(sorted(pending, key=deadline))
+    queue = asyncio.Queue(maxsize=workers)
 
+    async def escalate():
+        while True:
+            job = await queue.get()
+            try:
+                second_notification_id = await write_queue.save_notification(NotificationData(-1, datetime.now(), False, 2, job.job_id))
+                await asyncio.to_thread(send_alert, job.mail2, job.url, second_notification_id)
+            except Exception as e:
+                logging.error("Error while sending a second notification: %s", e,
+                              extra={"json_fields": {**log_data, "job_data": job._asdict()}})
+            finally:
+                queue.task_done()
+
+    escalators = [asyncio.create_task(escalate()) for _ in range(workers)]
     try:
-        await asyncio.sleep(max(0, remaining_response_time / 1000))
-        conn = db_access.setup_connection(DB_HOST, DB_PORT)
+        while waiting:
+            await asyncio.sleep(max(0.0, deadline(waiting[0]) - time.time()))
+            due = []
+            while waiting and len(due) < RECOVERY_READ_BATCH and deadline(waiting[0]) <= time.time():
+                due.append(waiting.popleft())
 
-        notifications = db_access.get_notifications_for_jobs([job_data.job_id], conn)[job_data.job_id]
-        if not any(notification.admin_responded for notification in notifications):
-            second_notification_id = db_access.save_notification(NotificationData(-1, datetime.now(), False, 2, job_data.job_id), conn)
-            send_alert(job_data.mail2, job_data.url, second_notification_id, False)
-            await asyncio.sleep(job_data.response_time / 1000)
-        logging.info("Notifying complete", extra={"json_fields": log_data})
-    except Exception as e:
-        logging.error("Error while sending a second notification: %s", e, extra={"json_fields": log_data})
+            conn = db_access.setup_connection(DB_HOST, DB_PORT)
+            try:
+                notifications = db_access.get_notifications_for_jobs(
+                    [job.job_id for job, _ in due], conn, min(notification.time_sent for _, notification in due))
+            except Exception as e:
+                logging.error("Error while reading notifications of pending escalations: %s", e, extra={"json_fields": log_data})
+                waiting.extendleft(reversed(due))
+                await asyncio.sleep(1)
+                continue
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            for job, notification in due:
+                if not any(other.admin_responded for other in notifications[job.job_id]
+                           if other.time_sent >= notification.time_sent):
+                    await queue.put(job)
+        await queue.join()
     finally:
-        conn.close()
+        for escalator in escalators:
+            escalator.cancel()
+    logging.info("Notifying complete", extra={"json_fields": log_data})
 
 
 async def active_job_updater_task(pod_index: int):
@@ -207,3 +585,89 @@ async def active_job_updater_task(pod_index: int):
         if active_jobs_cache_new is not None:
             with active_jobs_sync_loc:
                 active_jobs_cache = active_jobs_cache_new
+            # picks up jobs deleted through other pods
+            job_index.INDEX.sync_active(active_jobs_cache_new)
+
+
+async def job_stats_flush_task():
+    """
+    Writes per-minute job statistics changed since the previous flush in batches.
+    :return: None
+    """
+    last_cleanup = time.time()
+    while True:
+        await asyncio.sleep(job_stats.FLUSH_INTERVAL)
+        rows = job_stats.STORE.take_dirty()
+        if not rows:
+            continue
+
+        conn = db_access.setup_connection(DB_HOST, DB_PORT)
+        try:
+            for i in range(0, len(rows), job_stats.FLUSH_BATCH_SIZE):
+                db_access.save_job_stats(rows[i:i + job_stats.FLUSH_BATCH_SIZE], conn)
+            if time.time() - last_cleanup > job_stats.RETENTION.total_seconds() / 24:
+                db_access.delete_job_stats_before(datetime.now() - job_stats.RETENTION, conn)
+                last_cleanup = time.time()
+        except Exception as e:
+            job_stats.STORE.restore_dirty(rows)
+            logging.error("Error while flushing job statistics: %s", e,
+                          extra={"json_fields": {"function_name": "job_stats_flush_task", "rows": len(rows)}})
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+async def notification_partitions_task():
+    """
+    Keeps monthly notification partitions created ahead of time and drops (or archives) expired ones.
+    :return: None
+    """
+    log_data = {"function_name": "notification_partitions_task"}
+    while True:
+        conn = db_access.setup_connection(DB_HOST, DB_PORT)
+        try:
+            removed = db_access.maintain_notification_partitions(
+                NOTIFICATIONS_PARTITIONS_AHEAD,
+                datetime.now() - timedelta(days=NOTIFICATIONS_RETENTION_DAYS),
+                NOTIFICATIONS_ARCHIVE,
+                conn
+            )
+            if removed:
+                logging.info(f"Removed {removed} expired notification partitions", extra={"json_fields": log_data})
+        except Exception as e:
+            logging.error("Error while maintaining notification partitions: %s", e, extra={"json_fields": log_data})
+        finally:
+            if conn is not None:
+                conn.close()
+        await asyncio.sleep(3600)
+
+
+async def job_archiver_task(pod_index: int):
+    """
+    Moves inactive jobs of the pod with no pending escalation out of the jobs table, in batches.
+    :param pod_index: pod index
+    :return: None
+    """
+    log_data = {"function_name": "job_archiver_task"}
+    while True:
+        await asyncio.sleep(JOBS_ARCHIVE_INTERVAL_SECONDS)
+        conn = db_access.setup_connection(DB_HOST, DB_PORT)
+        archived = 0
+        try:
+            while True:
+                since = datetime.now() - timedelta(hours=NOTIFICATIONS_RECOVERY_LOOKBACK_HOURS)
+                moved = db_access.archive_inactive_jobs(pod_index, since, JOBS_ARCHIVE_BATCH_SIZE, conn)
+                for job_id in moved:
+                    job_index.INDEX.remove(job_id)
+                archived += len(moved)
+                if len(moved) < JOBS_ARCHIVE_BATCH_SIZE:
+                    break
+                # let pings run between batches
+                await asyncio.sleep(0)
+        except Exception as e:
+            logging.error("Error while archiving inactive jobs: %s", e, extra={"json_fields": log_data})
+        finally:
+            if conn is not None:
+                conn.close()
+        if archived:
+            logging.info(f"Archived {archived} inactive jobs", extra={"json_fields": log_data})
@@ -1,7 +1,46 @@
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Gauge, Histogram
 
 
 PINGS_SENT_CTR = Counter('pings_sent_total', 'Total Pings')
 SUCCESSFUL_PINGS_CTR = Counter('successful_pings_total', 'Total Pings')
 HTTP_CONNS_ACTIVE_CTR = Gauge('http_conns_active_total', 'Total HTTP connections')
-JOBS_ACTIVE_CTR = Gauge('jobs_active_total', 'Total Jobs')
\ No newline at end of file
+JOBS_ACTIVE_CTR = Gauge('jobs_active_total', 'Total Jobs')
+
+# labels are kept to small, fixed sets (outcome / function / route) - never per job or per url
+PING_DURATION_HIST = Histogram('ping_duration_seconds', 'Ping round trip time', ['outcome'])
+DB_QUERY_DURATION_HIST = Histogram('db_query_duration_seconds', 'Duration of db_access calls', ['function'])
+EMAIL_SEND_DURATION_HIST = Histogram('email_send_duration_seconds', 'Duration of sending an email over SMTP', ['outcome'],
+                                     buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+HTTP_HANDLER_DURATION_HIST = Histogram('http_handler_duration_seconds', 'Duration of API handlers', ['route', 'status'])
+EVENT_LOOP_LAG_GAUGE = Gauge('event_loop_lag_seconds', 'Delay of the event loop in waking up a sleeping task')
+EVENT_LOOP_STALLS_CTR = Counter('event_loop_stalls_total', 'Event loop stalls over the threshold by blocking call site', ['call_site'])
+LOG_RECORDS_DROPPED_CTR = Counter('log_records_dropped_total', 'Log records dropped before export', ['reason'])
+API_REQUESTS_REJECTED_CTR = Counter('api_requests_rejected_total', 'API requests rejected by admission control', ['reason'])
+# detection: first failed probe -> alert decided, commit: decided -> notification committed,
+# smtp: committed -> email accepted, end_to_end: first failed probe -> email accepted
+ALERT_LATENCY_HIST = Histogram('alert_latency_seconds', 'Stages of the time from a target failing to its alert being sent', ['stage'],
+                               buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+PINGS_DISPATCHED_PER_TICK_HIST = Histogram('pings_dispatched_per_tick', 'Pings dispatched within one scheduler tick (DISPATCH_TICK_MS)',
+                                           buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+WINDOW_CHECK_DURATION_HIST = Histogram('window_check_duration_seconds', 'Duration of one pass over the alerting windows of all jobs',
+                                       buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1))
+# hit, miss, stale (expired entry served while the resolver fails), failure, temporary_failure (resolver unavailable)
+DNS_LOOKUPS_CTR = Counter('dns_lookups_total', 'Host name resolutions of pinged urls by outcome', ['outcome'])
+DNS_LOOKUP_DURATION_HIST = Histogram('dns_lookup_duration_seconds', 'Duration of host name resolutions not answered from the cache', ['outcome'],
+                                     buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+PING_CONNECTIONS_OPENED_CTR = Counter('ping_connections_opened_total', 'Connections used by pings, new or reused from the keep-alive pool', ['origin'])
+PING_CONNECTIONS_GAUGE = Gauge('ping_connections', 'Open connections of the ping session', ['state'])
+PING_CONNECTION_HOSTS_GAUGE = Gauge('ping_connection_hosts', 'Hosts with open connections of the ping session')
+PING_CONNECTIONS_PER_HOST_MAX_GAUGE = Gauge('ping_connections_per_host_max', 'Open connections of the ping session to the busiest host')
+JOBS_DEGRADED_GAUGE = Gauge('jobs_degraded', 'Alerted jobs probed with backoff until they recover')
+DEGRADED_PROBES_CTR = Counter('degraded_probes_total', 'Backoff probes of alerted jobs', ['outcome'])
+JOBS_RECOVERED_CTR = Counter('jobs_recovered_total', 'Alerted jobs whose service responded again')
+CIRCUITS_OPEN_GAUGE = Gauge('circuits_open', 'Pinged hosts whose circuit is open after consistent connect failures')
+CIRCUIT_TRANSITIONS_CTR = Counter('circuit_transitions_total', 'Circuits of pinged hosts opened or closed', ['to'])
+PINGS_SHORT_CIRCUITED_CTR = Counter('pings_short_circuited_total', 'Pings not sent because the circuit of their host is open')
+DB_REPLICA_LAG_GAUGE = Gauge('db_replica_lag_seconds', 'Replay lag of the read replica at its last check')
+# target: replica, primary (no replica configured, or it is unreachable or too stale)
+DB_READS_CTR = Counter('db_reads_total', 'Listing and recovery reads by the server they were sent to', ['target'])
+JOBS_DEDUPLICATED_CTR = Counter('jobs_deduplicated_total', 'add_service retries answered with the job saved by the first call of their idempotency key')
+# memory, fallback (a pod did not answer, listed from the database)
+JOB_LISTINGS_CTR = Counter('job_listings_total', 'get_alerting_jobs listings with source=memory by how they were answered', ['source'])
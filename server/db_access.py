@@ -1,11 +1,76 @@
+import asyncio
+import functools
+import math
 import os
-from typing import Optional, List, Set, Dict
+import time
+from datetime import datetime
+from typing import Optional, List, Set, Dict, Callable, Tuple
 
 import psycopg2
 
-from common import JobData, job_id_t, NotificationData, notification_id_t
+from common import JobData, job_id_t, NotificationData, notification_id_t, JobStatsData, AlertTimings
+from counters import DB_QUERY_DURATION_HIST, DB_REPLICA_LAG_GAUGE
 
 
+def _timed(func):
+    histogram = DB_QUERY_DURATION_HIST.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with histogram.time():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+USE_PREPARED_STATEMENTS = os.environ.get("DB_PREPARED_STATEMENTS", "1") != "0"
+
+JOB_COLUMNS = "job_id, mail1, mail2, url, period, alerting_window, response_time, is_active"
+NOTIFICATION_COLUMNS = "notification_id, time_sent, admin_responded, notification_no, job_id"
+# shared by save_notification and save_notifications_and_set_jobs_inactive, they prepare it under the same name
+SAVE_NOTIFICATION_SQL = """
+    INSERT INTO notifications (time_sent, admin_responded, notification_no, job_id)
+    VALUES (%s, %s, %s, %s)
+    RETURNING notification_id;
+    """
+
+
+class _Connection(psycopg2.extensions.connection):
+    """Connection remembering which statements were prepared in its session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements: Set[str] = set()
+
+
+def _execute(cursor, name: str, query: str, params: tuple) -> None:
+    """
+    Executes the query as a server-side prepared statement, preparing it on its first use in the session.
+    :param cursor: cursor of the connection
+    :param name: statement name, unique per query
+    :param query: query with %s placeholders
+    :param params: query parameters
+    :return: None
+    """
+    conn = cursor.connection
+    if not USE_PREPARED_STATEMENTS:
+        cursor.execute(query, params)
+    elif isinstance(conn, _Connection):
+        if name not in conn.prepared_statements:
+            parts = query.strip().rstrip(';').split("%s")
+            statement = parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+            # PREPARE is not transactional, the statement survives a rollback
+            cursor.execute(f"PREPARE {name} AS {statement};")
+            conn.prepared_statements.add(name)
+        placeholders = ", ".join(["%s"] * len(params))
+        cursor.execute(f"EXECUTE {name} ({placeholders});", params)
+    elif hasattr(conn, "prepare_threshold"):
+        # psycopg 3 connection, which prepares statements natively
+        cursor.execute(query, params, prepare=True)
+    else:
+        cursor.execute(query, params)
+
+
+@_timed
 def setup_connection(db_host: str, db_port: int) -> Optional[psycopg2.extensions.connection]:
     db_user = os.environ.get("DB_USER")
     db_pass = os.environ.get("DB_PASS")
@@ -17,7 +82,8 @@ def setup_connection(db_host: str, db_port: int) -> Optional[psycopg2.extensions
             port=db_port,
             user=db_user,
             password=db_pass,
-            database=db_name
+            database=db_name,
+            connection_factory=_Connection
         )
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
@@ -26,10 +92,12 @@ def setup_connection(db_host: str, db_port: int) -> Optional[psycopg2.extensions
     return conn
 
 
+@_timed
 def set_job_inactive(job_id: job_id_t, conn: psycopg2.extensions.connection) -> None:
     cursor = conn.cursor()
-    cursor.execute(
-        f"""
+    _execute(
+        cursor, "set_job_inactive",
+        """
         UPDATE jobs SET is_active=false WHERE jobs.job_id = %s;
         """,
         (job_id,)
@@ -37,11 +105,36 @@ def set_job_inactive(job_id: job_id_t, conn: psycopg2.extensions.connection) ->
     conn.commit()
 
 
+@_timed
+def set_job_active(job_id: job_id_t, stateful_set_index: int, conn: psycopg2.extensions.connection) -> bool:
+    """
+    Re-arms an inactive job of the pod.
+    :param job_id: job id
+    :param stateful_set_index: pod index
+    :param conn: postgres connection
+    :return: whether the job was re-armed, False if it was archived or is pinged by another pod
+    """
+    cursor = conn.cursor()
+    _execute(
+        cursor, "set_job_active",
+        """
+        UPDATE jobs SET is_active=true WHERE job_id = %s AND stateful_set_index = %s AND NOT is_active;
+        """,
+        (job_id, stateful_set_index)
+    )
+    rearmed = cursor.rowcount == 1
+    conn.commit()
+    return rearmed
+
+
+@_timed
 def save_job(job: JobData, conn: psycopg2.extensions.connection, set_idx: int) -> job_id_t:
     cursor = conn.cursor()
-    cursor.execute(
-        f"""
-        INSERT INTO jobs VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s)
+    _execute(
+        cursor, "save_job",
+        """
+        INSERT INTO jobs (mail1, mail2, url, period, alerting_window, response_time, stateful_set_index, is_active)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
         RETURNING job_id;
         """,
         (job.mail1, job.mail2, job.url, job.period, job.window, job.response_time, set_idx, job.is_active)
@@ -50,47 +143,74 @@ def save_job(job: JobData, conn: psycopg2.extensions.connection, set_idx: int) -
     return job_id_t(cursor.fetchone()[0])
 
 
+@_timed
+def save_job_idempotent(job: JobData, idempotency_key: str, conn: psycopg2.extensions.connection,
+                        set_idx: int) -> Tuple[JobData, bool]:
+    """
+    Inserts the job unless a job of the same primary email was already saved with `idempotency_key`.
+    :param job: job to save
+    :param idempotency_key: key sent by the client, the same for retries of one request
+    :param conn: postgres connection
+    :param set_idx: pod index
+    :return: the saved job, or the job saved with the key before, and whether it was inserted
+    """
+    cursor = conn.cursor()
+    _execute(
+        cursor, "save_job_idempotent",
+        f"""
+        INSERT INTO jobs (mail1, mail2, url, period, alerting_window, response_time, stateful_set_index, is_active, idempotency_key)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (mail1, idempotency_key) WHERE idempotency_key IS NOT NULL
+        DO UPDATE SET idempotency_key = EXCLUDED.idempotency_key
+        RETURNING {JOB_COLUMNS}, xmax = 0;
+        """,
+        (job.mail1, job.mail2, job.url, job.period, job.window, job.response_time, set_idx, job.is_active, idempotency_key)
+    )
+    row = cursor.fetchone()
+    conn.commit()
+    return JobData._make(row[:-1]), row[-1]
+
+
+@_timed
 def get_jobs(primary_email: str, conn: psycopg2.extensions.connection) -> List[JobData]:
     cursor = conn.cursor()
-    cursor.execute(
+    _execute(
+        cursor, "get_jobs",
         f"""
-        SELECT * FROM jobs WHERE mail1 = %s;
+        SELECT {JOB_COLUMNS} FROM jobs WHERE mail1 = %s;
         """,
         (primary_email,)
     )
-    rows = cursor.fetchall()
 
-    jobs = []
-    for row in rows:
-        jobs.append(JobData(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[8]))
-    return jobs
+    return [JobData._make(row) for row in cursor.fetchall()]
 
 
+@_timed
 def save_notification(notification: NotificationData, conn: psycopg2.extensions.connection) -> notification_id_t:
     cursor = conn.cursor()
-    cursor.execute(
-        f"""
-        INSERT INTO notifications VALUES (DEFAULT, %s, %s, %s, %s)
-        RETURNING notification_id;
-        """,
+    _execute(
+        cursor, "save_notification", SAVE_NOTIFICATION_SQL,
         (notification.time_sent, notification.admin_responded, notification.notification_num, notification.job_id)
     )
     conn.commit()
     return notification_id_t(cursor.fetchone()[0])
 
 
+@_timed
 def get_notification_by_id(notification_id: int, conn: psycopg2.extensions.connection) -> NotificationData:
     cursor = conn.cursor()
-    cursor.execute(
+    _execute(
+        cursor, "get_notification_by_id",
         f"""
-        SELECT * FROM notifications WHERE notification_id = %s;
+        SELECT {NOTIFICATION_COLUMNS} FROM notifications WHERE notification_id = %s;
         """,
         (notification_id,)
     )
 
-    return NotificationData(*cursor.fetchone())
+    return NotificationData._make(cursor.fetchone())
 
 
+@_timed
 def update_notification_response_status(notification_id: int, conn: psycopg2.extensions.connection) -> bool:
     """
     :param notification_id:
@@ -99,8 +219,9 @@ def update_notification_response_status(notification_id: int, conn: psycopg2.ext
     """
     cursor = conn.cursor()
 
-    cursor.execute(
-        f"""
+    _execute(
+        cursor, "update_notification_response_status",
+        """
         UPDATE notifications SET admin_responded = TRUE WHERE notification_id = %s;
         """,
         (notification_id,)
@@ -112,6 +233,7 @@ def update_notification_response_status(notification_id: int, conn: psycopg2.ext
     return rowcount == 1
 
 
+@_timed
 def get_active_job_ids(conn: psycopg2.extensions.connection, pod_index: int) -> Set[job_id_t]:
     """
     :param conn: postgres connection
@@ -119,7 +241,8 @@ def get_active_job_ids(conn: psycopg2.extensions.connection, pod_index: int) ->
     :return: list of all active jobs assigned to this pod
     """
     cursor = conn.cursor()
-    cursor.execute(
+    _execute(
+        cursor, "get_active_job_ids",
         """
         SELECT job_id FROM jobs WHERE is_active = TRUE and stateful_set_index = %s;
         """,
@@ -130,34 +253,476 @@ def get_active_job_ids(conn: psycopg2.extensions.connection, pod_index: int) ->
     return {job_id_t(x[0]) for x in cursor.fetchall()}
 
 
+@_timed
 def get_jobs_for_stateful_set(stateful_set_index: int, conn: psycopg2.extensions.connection) -> List[JobData]:
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT * FROM jobs WHERE stateful_set_index = %s;
+    _execute(
+        cursor, "get_jobs_for_stateful_set",
+        f"""
+        SELECT {JOB_COLUMNS} FROM jobs WHERE stateful_set_index = %s;
         """,
         (stateful_set_index,)
     )
-    rows = cursor.fetchall()
-    
-    jobs = []
-    for row in rows:
-        jobs.append(JobData(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[8]))
-    return jobs
+
+    return [JobData._make(row) for row in cursor.fetchall()]
 
 
-def get_notifications_for_jobs(job_ids: list[job_id_t], conn: psycopg2.extensions.connection) -> Dict[job_id_t, List[NotificationData]]:
+@_timed
+def get_notifications_for_jobs(job_ids: list[job_id_t], conn: psycopg2.extensions.connection,
+                               since: datetime = datetime.min) -> Dict[job_id_t, List[NotificationData]]:
+    """
+    :param job_ids: jobs to get notifications for
+    :param conn: postgres connection
+    :param since: only notifications sent at or after that time are returned, older partitions are not read
+    :return: notifications of each job
+    """
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT * FROM notifications WHERE job_id = ANY(%s);
+    _execute(
+        cursor, "get_notifications_for_jobs",
+        f"""
+        SELECT {NOTIFICATION_COLUMNS} FROM notifications WHERE job_id = ANY(%s) AND time_sent >= %s;
         """,
-        (job_ids,)
+        (job_ids, since)
     )
-    rows = cursor.fetchall()
 
     notifications = {job_id: [] for job_id in job_ids}
-    for row in rows:
-        notification = NotificationData(*row)
+    for row in cursor.fetchall():
+        notification = NotificationData._make(row)
         notifications[notification.job_id].append(notification)
-    return notifications
\ No newline at end of file
+    return notifications
+
+
+@_timed
+def archive_inactive_jobs(stateful_set_index: int, since: datetime, batch_size: int,
+                          conn: psycopg2.extensions.connection) -> List[job_id_t]:
+    """
+    Moves inactive jobs of the pod with no pending escalation to jobs_history.
+    An escalation is pending when every notification of the job sent since `since` is
+    an unacknowledged first notification, the same condition recover_jobs resumes.
+    :param stateful_set_index: pod index
+    :param since: start of the recovery lookback
+    :param batch_size: maximum number of jobs moved
+    :param conn: postgres connection
+    :return: ids of the moved jobs
+    """
+    cursor = conn.cursor()
+    try:
+        _execute(
+            cursor, "archive_inactive_jobs",
+            f"""
+            WITH moved AS (
+                DELETE FROM jobs WHERE job_id IN (
+                    SELECT job_id FROM jobs
+                    WHERE NOT is_active AND stateful_set_index = %s
+                      AND (
+                        NOT EXISTS (SELECT 1 FROM notifications n
+                                    WHERE n.job_id = jobs.job_id AND n.time_sent >= %s)
+                        OR EXISTS (SELECT 1 FROM notifications n
+                                   WHERE n.job_id = jobs.job_id AND n.time_sent >= %s
+                                     AND (n.notification_no <> 1 OR n.admin_responded))
+                      )
+                    ORDER BY job_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {JOB_COLUMNS}, stateful_set_index
+            )
+            INSERT INTO jobs_history (
+                {JOB_COLUMNS}, stateful_set_index, archived_at
+            )
+            SELECT *, now() FROM moved
+            RETURNING job_id;
+            """,
+            (stateful_set_index, since, since, batch_size)
+        )
+        moved = [job_id_t(row[0]) for row in cursor.fetchall()]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return moved
+
+
+@_timed
+def get_archived_jobs(primary_email: str, conn: psycopg2.extensions.connection) -> List[JobData]:
+    cursor = conn.cursor()
+    _execute(
+        cursor, "get_archived_jobs",
+        f"""
+        SELECT {JOB_COLUMNS} FROM jobs_history WHERE mail1 = %s;
+        """,
+        (primary_email,)
+    )
+    conn.commit()
+
+    return [JobData._make(row) for row in cursor.fetchall()]
+
+
+@_timed
+def maintain_notification_partitions(months_ahead: int, retention_before: datetime, archive: bool,
+                                     conn: psycopg2.extensions.connection) -> int:
+    """
+    Creates monthly notification partitions ahead of time and removes the expired ones.
+    Only one pod does the work at a time, the others return immediately.
+    :param months_ahead: number of future months to create partitions for
+    :param retention_before: partitions holding only older notifications are removed
+    :param archive: if true, expired partitions are detached and kept as notifications_archive_pYYYYMM tables
+    :param conn: postgres connection
+    :return: number of removed partitions
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('notification_partitions'));")
+        if not cursor.fetchone()[0]:
+            conn.commit()
+            return 0
+        cursor.execute("SELECT create_notification_partitions(now()::timestamp, %s);", (months_ahead,))
+        cursor.execute("SELECT remove_notification_partitions(%s, %s);", (retention_before, archive))
+        removed = cursor.fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return removed
+
+
+@_timed
+def save_job_stats(stats: List[JobStatsData], conn: psycopg2.extensions.connection) -> None:
+    """
+    Upserts per-minute job statistics in a single statement.
+    :param stats: buckets with full per-minute totals, at most one per (job_id, minute)
+    :param conn: postgres connection
+    :return: None
+    """
+    cursor = conn.cursor()
+    _execute(
+        cursor, "save_job_stats",
+        """
+        INSERT INTO job_stats (job_id, minute, pings_ok, pings_failed, latency_sum_ms, latency_max_ms)
+        SELECT * FROM unnest(%s::int[], %s::timestamp[], %s::int[], %s::int[], %s::bigint[], %s::int[])
+        ON CONFLICT (job_id, minute) DO UPDATE SET
+            pings_ok = EXCLUDED.pings_ok,
+            pings_failed = EXCLUDED.pings_failed,
+            latency_sum_ms = EXCLUDED.latency_sum_ms,
+            latency_max_ms = EXCLUDED.latency_max_ms;
+        """,
+        tuple([getattr(s, field) for s in stats] for field in JobStatsData._fields)
+    )
+    conn.commit()
+
+
+@_timed
+def get_job_stats(job_id: job_id_t, since: datetime, conn: psycopg2.extensions.connection) -> List[JobStatsData]:
+    cursor = conn.cursor()
+    _execute(
+        cursor, "get_job_stats",
+        """
+        SELECT job_id, minute, pings_ok, pings_failed, latency_sum_ms, latency_max_ms
+        FROM job_stats WHERE job_id = %s AND minute >= %s ORDER BY minute;
+        """,
+        (job_id, since)
+    )
+    conn.commit()
+
+    return [JobStatsData._make(row) for row in cursor.fetchall()]
+
+
+@_timed
+def delete_job_stats_before(before: datetime, conn: psycopg2.extensions.connection) -> int:
+    """
+    :param before: buckets older than that are deleted
+    :param conn: postgres connection
+    :return: number of deleted buckets
+    """
+    cursor = conn.cursor()
+    _execute(
+        cursor, "delete_job_stats_before",
+        """
+        DELETE FROM job_stats WHERE minute < %s;
+        """,
+        (before,)
+    )
+    rowcount = cursor.rowcount
+    conn.commit()
+    return rowcount
+
+
+@_timed
+def save_notifications_and_set_jobs_inactive(notifications: List[NotificationData], job_ids: List[job_id_t],
+                                             conn: psycopg2.extensions.connection,
+                                             alert_timings: List[AlertTimings] = ()) -> List[notification_id_t]:
+    """
+    Saves notifications, deactivates jobs and stores alert timings in a single transaction.
+    :param notifications: notifications to insert
+    :param job_ids: jobs to set inactive
+    :param conn: postgres connection
+    :param alert_timings: timings of already saved notifications
+    :return: ids of the inserted notifications, in order
+    """
+    cursor = conn.cursor()
+    try:
+        notification_ids = []
+        for notification in notifications:
+            _execute(
+                cursor, "save_notification", SAVE_NOTIFICATION_SQL,
+                (notification.time_sent, notification.admin_responded, notification.notification_num, notification.job_id)
+            )
+            notification_ids.append(notification_id_t(cursor.fetchone()[0]))
+        if job_ids:
+            _execute(
+                cursor, "set_jobs_inactive",
+                """
+                UPDATE jobs SET is_active=false WHERE jobs.job_id = ANY(%s);
+                """,
+                (job_ids,)
+            )
+        if alert_timings:
+            _execute(
+                cursor, "save_alert_timings",
+                """
+                UPDATE notifications SET first_failure_at = t.first_failure, decided_at = t.decided,
+                                         committed_at = t.committed, smtp_accepted_at = t.smtp_accepted
+                FROM unnest(%s::int[], %s::timestamp[], %s::timestamp[], %s::timestamp[], %s::timestamp[])
+                     AS t(notification_id, first_failure, decided, committed, smtp_accepted)
+                WHERE notifications.notification_id = t.notification_id;
+                """,
+                tuple(list(column) for column in zip(*alert_timings))
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return notification_ids
+
+
+@_timed
+def get_alert_timings(notification_id: notification_id_t, conn: psycopg2.extensions.connection) -> Optional[AlertTimings]:
+    cursor = conn.cursor()
+    _execute(
+        cursor, "get_alert_timings",
+        """
+        SELECT notification_id, first_failure_at, decided_at, committed_at, smtp_accepted_at
+        FROM notifications WHERE notification_id = %s;
+        """,
+        (notification_id,)
+    )
+    row = cursor.fetchone()
+    conn.commit()
+    return AlertTimings._make(row) if row is not None else None
+
+
+@_timed
+def get_wal_lsn(conn: psycopg2.extensions.connection) -> str:
+    """
+    :param conn: postgres connection to the primary
+    :return: current write-ahead log position of the primary
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_current_wal_lsn()::text;")
+    lsn = cursor.fetchone()[0]
+    conn.commit()
+    return lsn
+
+
+@_timed
+def get_replication_lag(conn: psycopg2.extensions.connection) -> float:
+    """
+    :param conn: postgres connection
+    :return: seconds the server's data is behind the primary, 0 on the primary or a replica that replayed everything it received
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8, 'Infinity'::float8)
+        END;
+        """
+    )
+    lag = cursor.fetchone()[0]
+    conn.commit()
+    return float(lag)
+
+
+@_timed
+def has_replayed(lsn: str, conn: psycopg2.extensions.connection) -> bool:
+    """
+    :param lsn: write-ahead log position of the primary, from get_wal_lsn
+    :param conn: postgres connection
+    :return: whether the server's data includes everything written on the primary up to `lsn`
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END >= %s::pg_lsn;
+        """,
+        (lsn,)
+    )
+    replayed = cursor.fetchone()[0]
+    conn.commit()
+    return bool(replayed)
+
+
+WRITE_BEHIND_FLUSH_INTERVAL = int(os.environ.get("WRITE_BEHIND_FLUSH_MS", 5)) / 1000
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get("WRITE_BEHIND_MAX_BATCH", 100))
+
+
+class WriteBehindQueue:
+    """
+    Groups notification inserts, job deactivations and alert timing updates submitted
+    within a few milliseconds into one transaction on a dedicated connection.
+
+    Returned futures resolve only after the transaction is committed, so a
+    caller awaiting a notification before sending the email keeps the
+    guarantee recover_jobs relies on: a sent alert always has its
+    notification (and the job deactivation submitted with it) in the database.
+    """
+
+    def __init__(self, conn_factory: Callable[[], Optional[psycopg2.extensions.connection]],
+                 flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL, max_batch: int = WRITE_BEHIND_MAX_BATCH):
+        self._conn_factory = conn_factory
+        self._conn = None
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._notifications: List[Tuple[NotificationData, asyncio.Future]] = []
+        self._deactivations: List[Tuple[job_id_t, asyncio.Future]] = []
+        self._alert_timings: List[Tuple[AlertTimings, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+
+    def save_notification(self, notification: NotificationData) -> "asyncio.Future[notification_id_t]":
+        future = asyncio.get_running_loop().create_future()
+        self._notifications.append((notification, future))
+        self._schedule_flush()
+        return future
+
+    def set_job_inactive(self, job_id: job_id_t) -> "asyncio.Future[None]":
+        future = asyncio.get_running_loop().create_future()
+        self._deactivations.append((job_id, future))
+        self._schedule_flush()
+        return future
+
+    def save_alert_timings(self, alert_timings: AlertTimings) -> "asyncio.Future[None]":
+        future = asyncio.get_running_loop().create_future()
+        self._alert_timings.append((alert_timings, future))
+        self._schedule_flush()
+        return future
+
+    def _schedule_flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        if len(self._notifications) + len(self._deactivations) + len(self._alert_timings) >= self._max_batch:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._flush_handle = loop.call_soon(self.flush)
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._flush_interval, self.flush)
+
+    def _connection(self) -> psycopg2.extensions.connection:
+        if self._conn is None:
+            self._conn = self._conn_factory()
+            if self._conn is None:
+                raise ConnectionError("could not connect to the database")
+        return self._conn
+
+    def flush(self) -> None:
+        """
+        Writes everything submitted so far in one transaction and resolves the futures.
+        :return: None
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        notifications, self._notifications = self._notifications, []
+        deactivations, self._deactivations = self._deactivations, []
+        alert_timings, self._alert_timings = self._alert_timings, []
+        if not notifications and not deactivations and not alert_timings:
+            return
+
+        try:
+            notification_ids = save_notifications_and_set_jobs_inactive(
+                [notification for notification, _ in notifications],
+                list({job_id for job_id, _ in deactivations}),
+                self._connection(),
+                [timings for timings, _ in alert_timings]
+            )
+        except Exception as e:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            for _, future in notifications + deactivations + alert_timings:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), notification_id in zip(notifications, notification_ids):
+            if not future.done():
+                future.set_result(notification_id)
+        for _, future in deactivations + alert_timings:
+            if not future.done():
+                future.set_result(None)
+
+
+class ReadReplica:
+    """
+    Read-only connection to a replica of the database, used by listing and recovery reads so
+    that dashboard load does not contend with alert writes on the primary. Both accessors
+    return None when the replica is unreachable or too stale, callers then read from the primary.
+    """
+
+    def __init__(self, conn_factory: Callable[[], Optional[psycopg2.extensions.connection]], max_lag: float,
+                 check_interval: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        self._conn_factory = conn_factory
+        self._conn = None
+        self.max_lag = max_lag
+        self._check_interval = check_interval
+        self._clock = clock
+        self._checked_at = -math.inf
+        self._lag = math.inf
+
+    def _connection(self) -> Optional[psycopg2.extensions.connection]:
+        if self._conn is None:
+            conn = self._conn_factory()
+            if conn is None:
+                return None
+            # no transaction is left open between reads, it would hold back replay on the replica
+            conn.set_session(readonly=True, autocommit=True)
+            self._conn = conn
+        return self._conn
+
+    def _drop(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    def connection(self) -> Optional[psycopg2.extensions.connection]:
+        """
+        Checks the replication lag at most once per `check_interval`.
+        :return: connection to the replica if its data is at most `max_lag` seconds old, None otherwise
+        """
+        now = self._clock()
+        if now - self._checked_at >= self._check_interval:
+            self._checked_at = now
+            try:
+                conn = self._connection()
+                self._lag = get_replication_lag(conn) if conn is not None else math.inf
+            except psycopg2.Error:
+                self._drop()
+                self._lag = math.inf
+            if self._lag < math.inf:
+                DB_REPLICA_LAG_GAUGE.set(self._lag)
+        return self._conn if self._lag <= self.max_lag else None
+
+    def caught_up_connection(self, lsn: str) -> Optional[psycopg2.extensions.connection]:
+        """
+        :param lsn: write-ahead log position of the primary, from get_wal_lsn
+        :return: connection to the replica if it replayed the primary's writes up to `lsn`, None otherwise
+        """
+        try:
+            conn = self._connection()
+            if conn is not None and has_replayed(lsn, conn):
+                return conn
+        except psycopg2.Error:
+            self._drop()
+        return None
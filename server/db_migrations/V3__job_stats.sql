@@ -0,0 +1,13 @@
+DROP TABLE IF EXISTS job_stats;
+
+CREATE TABLE job_stats (
+    job_id INT not null,
+    minute timestamp not null,
+    pings_ok INT not null,
+    pings_failed INT not null,
+    latency_sum_ms BIGINT not null,
+    latency_max_ms INT not null,
+    PRIMARY KEY (job_id, minute)
+);
+
+CREATE INDEX job_stats_minute_idx ON job_stats (minute);
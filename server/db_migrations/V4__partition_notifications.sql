@@ -0,0 +1,66 @@
+-- notifications are range partitioned by month of time_sent (partitions named notifications_pYYYYMM),
+-- so old alerts can be dropped or archived a partition at a time and recovery reads only recent ones
+CREATE TABLE notifications_partitioned (
+    notification_id INT not null DEFAULT nextval('notifications_notification_id_seq'),
+    time_sent timestamp not null,
+    admin_responded BOOLEAN not null,
+    notification_no INT not null,
+    job_id INT not null,
+    PRIMARY KEY (notification_id, time_sent)
+) PARTITION BY RANGE (time_sent);
+
+CREATE TABLE notifications_default PARTITION OF notifications_partitioned DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_notification_partitions(since timestamp, months_ahead INT) RETURNS void AS $$
+DECLARE
+    month timestamp;
+BEGIN
+    FOR month IN SELECT generate_series(date_trunc('month', since), date_trunc('month', now()) + make_interval(months => months_ahead), interval '1 month')
+    LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF notifications FOR VALUES FROM (%L) TO (%L)',
+                       'notifications_p' || to_char(month, 'YYYYMM'), month, month + interval '1 month');
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- drops (or, with archive, detaches and renames to notifications_archive_pYYYYMM) partitions
+-- holding only notifications older than `before`; returns the number of removed partitions
+CREATE OR REPLACE FUNCTION remove_notification_partitions(before timestamp, archive BOOLEAN) RETURNS INT AS $$
+DECLARE
+    partition_name TEXT;
+    removed INT := 0;
+BEGIN
+    FOR partition_name IN
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'notifications' AND child.relname ~ '^notifications_p[0-9]{6}$'
+          AND to_timestamp(substr(child.relname, 16), 'YYYYMM')::timestamp + interval '1 month' <= before
+    LOOP
+        IF archive THEN
+            EXECUTE format('ALTER TABLE notifications DETACH PARTITION %I', partition_name);
+            -- archived alerts must not block removing the live table's sequence
+            EXECUTE format('ALTER TABLE %I ALTER COLUMN notification_id DROP DEFAULT', partition_name);
+            EXECUTE format('ALTER TABLE %I RENAME TO %I', partition_name, replace(partition_name, 'notifications_p', 'notifications_archive_p'));
+        ELSE
+            EXECUTE format('DROP TABLE %I', partition_name);
+        END IF;
+        removed := removed + 1;
+    END LOOP;
+    RETURN removed;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER SEQUENCE notifications_notification_id_seq OWNED BY notifications_partitioned.notification_id;
+ALTER TABLE notifications RENAME TO notifications_unpartitioned;
+ALTER TABLE notifications_partitioned RENAME TO notifications;
+ALTER INDEX notifications_partitioned_pkey RENAME TO notifications_pkey_tmp;
+
+SELECT create_notification_partitions(LEAST((SELECT min(time_sent) FROM notifications_unpartitioned), now()::timestamp), 3);
+
+INSERT INTO notifications SELECT notification_id, time_sent, admin_responded, notification_no, job_id FROM notifications_unpartitioned;
+DROP TABLE notifications_unpartitioned;
+ALTER INDEX notifications_pkey_tmp RENAME TO notifications_pkey;
+
+-- no foreign key to jobs: alerts, live or archived, outlive the jobs they were sent for
+CREATE INDEX notifications_job_id_time_sent_idx ON notifications (job_id, time_sent);
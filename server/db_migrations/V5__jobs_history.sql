@@ -0,0 +1,20 @@
+DROP TABLE IF EXISTS jobs_history;
+
+-- inactive jobs with no pending escalation are moved here, so jobs holds only live monitoring load
+CREATE TABLE jobs_history (
+    job_id INT PRIMARY KEY not null,
+    mail1 varchar(255) not null,
+    mail2 varchar(255) not null,
+    url varchar(511) not null,
+    period INT not null,
+    alerting_window INT not null,
+    response_time INT not null,
+    stateful_set_index INT not null,
+    is_active BOOLEAN not NULL,
+    archived_at timestamp not null
+);
+
+CREATE INDEX jobs_history_mail1_idx ON jobs_history (mail1);
+
+CREATE INDEX jobs_mail1_idx ON jobs (mail1);
+CREATE INDEX jobs_active_stateful_set_index_idx ON jobs (stateful_set_index) WHERE is_active;
@@ -0,0 +1,6 @@
+-- when the first probe of the outage was sent, when the alert was decided, when its
+-- notification was committed and when the SMTP server accepted the email; set for first notifications
+ALTER TABLE notifications ADD COLUMN first_failure_at timestamp;
+ALTER TABLE notifications ADD COLUMN decided_at timestamp;
+ALTER TABLE notifications ADD COLUMN committed_at timestamp;
+ALTER TABLE notifications ADD COLUMN smtp_accepted_at timestamp;
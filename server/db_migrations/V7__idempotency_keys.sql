@@ -0,0 +1,4 @@
+-- optional key sent by add_service clients, a retry with the same key returns the job created by the first call
+ALTER TABLE jobs ADD COLUMN idempotency_key varchar(255);
+
+CREATE UNIQUE INDEX jobs_mail1_idempotency_key_idx ON jobs (mail1, idempotency_key) WHERE idempotency_key IS NOT NULL;
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from aiohttp.abc import AbstractResolver, ResolveResult
+from aiohttp.resolver import ThreadedResolver
+from yarl import URL
+
+from counters import DNS_LOOKUPS_CTR, DNS_LOOKUP_DURATION_HIST
+
+
+# getaddrinfo does not expose record TTLs, entries are kept that long (the default TTL of cluster DNS)
+DNS_CACHE_TTL = float(os.environ.get("DNS_CACHE_TTL_SECONDS", 30))
+# while the resolver fails, expired entries are served for that long instead of failing the pings
+DNS_STALE_SECONDS = float(os.environ.get("DNS_STALE_SECONDS", 300))
+# hosts used within the last TTL are re-resolved that long before their entry expires
+REFRESH_AHEAD = DNS_CACHE_TTL / 5
+REFRESH_INTERVAL = 1
+MAX_CONCURRENT_REFRESHES = 32
+
+# (host, port, family)
+CacheKey = Tuple[str, int, int]
+
+
+class CacheEntry:
+    __slots__ = ("addresses", "expires", "last_used")
+
+    def __init__(self, addresses: List[ResolveResult], expires: float, last_used: float):
+        self.addresses = addresses
+        self.expires = expires
+        self.last_used = last_used
+
+
+class CachingResolver(AbstractResolver):
+    """
+    Resolver shared by all pings of the pod.
+
+    Entries are refreshed in the background before they expire, so pings of busy hosts never
+    wait for DNS; concurrent lookups of one host are coalesced, and expired entries are served
+    while the resolver fails, so a resolver outage does not fail pings of known hosts.
+    """
+
+    def __init__(self, ttl: float = DNS_CACHE_TTL, stale_seconds: float = DNS_STALE_SECONDS,
+                 resolver: Optional[AbstractResolver] = None, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.stale_seconds = stale_seconds
+        # created lazily, ThreadedResolver needs a running event loop
+        self._resolver = resolver
+        self._entries: Dict[CacheKey, CacheEntry] = {}
+        self._lookups: Dict[CacheKey, asyncio.Future] = {}
+        self._prefetch: Set[CacheKey] = set()
+
+    async def _lookup(self, key: CacheKey) -> List[ResolveResult]:
+        """Resolves `key`, sharing the lookup with concurrent callers, and caches the result."""
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._resolve_uncached(key))
+            self._lookups[key] = lookup
+            lookup.add_done_callback(lambda _: self._lookups.pop(key, None))
+        return await asyncio.shield(lookup)
+
+    async def _resolve_uncached(self, key: CacheKey) -> List[ResolveResult]:
+        if self._resolver is None:
+            self._resolver = ThreadedResolver()
+        host, port, family = key
+        start = time.perf_counter()
+        try:
+            addresses = await self._resolver.resolve(host, port, family)
+        except OSError as e:
+            outcome = "temporary_failure" if isinstance(e, socket.gaierror) and e.errno == socket.EAI_AGAIN else "failure"
+            DNS_LOOKUPS_CTR.labels(outcome).inc()
+            DNS_LOOKUP_DURATION_HIST.labels(outcome).observe(time.perf_counter() - start)
+            raise
+        DNS_LOOKUP_DURATION_HIST.labels("success").observe(time.perf_counter() - start)
+        now = self.clock()
+        entry = self._entries.get(key)
+        self._entries[key] = CacheEntry(addresses, now + self.ttl, entry.last_used if entry is not None else now)
+        return addresses
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET) -> List[ResolveResult]:
+        key = (host, port, family)
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.last_used = now
+            if now < entry.expires:
+                DNS_LOOKUPS_CTR.labels("hit").inc()
+                return entry.addresses
+        try:
+            addresses = await self._lookup(key)
+        except OSError:
+            if entry is not None and now < entry.expires + self.stale_seconds:
+                DNS_LOOKUPS_CTR.labels("stale").inc()
+                return entry.addresses
+            raise
+        DNS_LOOKUPS_CTR.labels("miss").inc()
+        return addresses
+
+    def prefetch(self, url: str, family: socket.AddressFamily = socket.AF_UNSPEC) -> None:
+        """
+        Queues the host of `url` to be resolved by refresh_task before the first ping.
+        :param url: url of a job that started being pinged
+        :param family: address family of the connector that will connect to it
+        :return: None
+        """
+        try:
+            url = URL(url)
+        except ValueError:
+            return
+        if url.host is None or url.port is None:
+            return
+        key = (url.host, url.port, family)
+        if key not in self._entries:
+            self._prefetch.add(key)
+
+    def _due(self, now: float) -> List[CacheKey]:
+        """:return: prefetched hosts and hosts in use whose entry expires soon"""
+        due = list(self._prefetch)
+        self._prefetch = set()
+        for key, entry in list(self._entries.items()):
+            if now - entry.last_used > self.ttl + self.stale_seconds:
+                # not pinged anymore, the next ping resolves it again
+                del self._entries[key]
+            elif now - entry.last_used <= self.ttl and entry.expires - now <= REFRESH_AHEAD:
+                due.append(key)
+        return due
+
+    async def refresh_task(self, interval: float = REFRESH_INTERVAL):
+        """
+        Resolves prefetched hosts and refreshes entries of hosts in use ahead of their expiry.
+        :return: None
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REFRESHES)
+
+        async def refresh(key: CacheKey):
+            async with semaphore:
+                try:
+                    await self._lookup(key)
+                except OSError as e:
+                    logging.warning("Refreshing the DNS entry of %s failed: %s", key[0], e,
+                                    extra={"json_fields": {"function_name": "refresh_task", "host": key[0]}})
+
+        while True:
+            await asyncio.sleep(interval)
+            due = self._due(self.clock())
+            if due:
+                await asyncio.gather(*(refresh(key) for key in due if key not in self._lookups))
+
+    async def close(self) -> None:
+        if self._resolver is not None:
+            await self._resolver.close()
+
+
+RESOLVER = CachingResolver()
@@ -0,0 +1,70 @@
+from typing import Dict, Iterable, List, Set
+
+from common import JobData, job_id_t
+
+
+class JobIndex:
+    """
+    Jobs of the pod's rows in the jobs table (active or not, archived jobs excluded),
+    indexed by primary email and by url, so admin listings do not query the database.
+
+    Activity is kept apart from the job data, as a set of job ids, so that resyncing
+    it with the database is a set copy whatever the number of jobs.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[job_id_t, JobData] = {}
+        self._active: Set[job_id_t] = set()
+        self._by_email: Dict[str, Set[job_id_t]] = {}
+        self._by_url: Dict[str, Set[job_id_t]] = {}
+
+    def add(self, job: JobData) -> None:
+        if job.job_id in self._jobs:
+            self.remove(job.job_id)
+        self._jobs[job.job_id] = job
+        self._by_email.setdefault(job.mail1, set()).add(job.job_id)
+        self._by_url.setdefault(job.url, set()).add(job.job_id)
+        self.set_active(job.job_id, job.is_active)
+
+    def remove(self, job_id: job_id_t) -> None:
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            return
+        self._active.discard(job_id)
+        for index, key in ((self._by_email, job.mail1), (self._by_url, job.url)):
+            ids = index[key]
+            ids.discard(job_id)
+            if not ids:
+                del index[key]
+
+    def set_active(self, job_id: job_id_t, is_active: bool) -> None:
+        if is_active and job_id in self._jobs:
+            self._active.add(job_id)
+        else:
+            self._active.discard(job_id)
+
+    def sync_active(self, active_ids: Set[job_id_t]) -> None:
+        """
+        Overwrites the activity of indexed jobs, e.g. with jobs deactivated by del_job on another pod.
+        :param active_ids: ids of the pod's active jobs in the database
+        :return: None
+        """
+        # a copy, the caller keeps adding to its set; ids of jobs not indexed are never looked up
+        self._active = set(active_ids)
+
+    def _get(self, job_ids: Iterable[job_id_t]) -> List[JobData]:
+        return [self._jobs[job_id]._replace(is_active=job_id in self._active) for job_id in sorted(job_ids)]
+
+    def by_email(self, primary_email: str) -> List[JobData]:
+        """:return: jobs with `primary_email` as the primary admin's email, by job id"""
+        return self._get(self._by_email.get(primary_email, ()))
+
+    def by_url(self, url: str) -> List[JobData]:
+        """:return: jobs pinging `url`, by job id"""
+        return self._get(self._by_url.get(url, ()))
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+
+INDEX = JobIndex()
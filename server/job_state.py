@@ -0,0 +1,129 @@
+from typing import List, Optional
+
+import numpy as np
+
+from common import JobData, notification_id_t
+
+
+class JobState:
+    """
+    Runtime state of one pinged job.
+
+    Only the send times of pings not followed by a successful one are kept, in send
+    order; the oldest of them and the last success are mirrored into the job's slot
+    of a WindowTable, which decides when the job alerts.
+    """
+    __slots__ = ("job", "next_ping", "unconfirmed", "notification_id", "recovered", "table", "slot")
+
+    def __init__(self, job: JobData, next_ping: float, table: "WindowTable"):
+        self.job = job
+        # event loop time of the next scheduled ping
+        self.next_ping = next_ping
+        # time.time_ns() send times
+        self.unconfirmed: List[int] = []
+        # first notification, once the job alerted
+        self.notification_id: Optional[notification_id_t] = None
+        # set by degraded probing once the alerted service responds again
+        self.recovered = False
+        self.table = table
+        # None once released from the table
+        self.slot: Optional[int] = table.add(self)
+
+    def sent(self, sent_ns: int) -> None:
+        if self.slot is None:
+            return
+        if not self.unconfirmed:
+            self.table.oldest_unconfirmed[self.slot] = sent_ns
+        self.unconfirmed.append(sent_ns)
+
+    def succeeded(self, sent_ns: int) -> None:
+        """
+        Confirms the ping sent at `sent_ns` and every ping sent before it.
+        :param sent_ns: send time of the successful ping
+        :return: None
+        """
+        if self.slot is None or sent_ns <= self.table.last_success[self.slot]:
+            return
+        self.table.last_success[self.slot] = sent_ns
+        unconfirmed = self.unconfirmed
+        confirmed = 0
+        while confirmed < len(unconfirmed) and unconfirmed[confirmed] <= sent_ns:
+            confirmed += 1
+        del unconfirmed[:confirmed]
+        self.table.oldest_unconfirmed[self.slot] = unconfirmed[0] if unconfirmed else 0
+
+    def oldest_unconfirmed(self) -> Optional[int]:
+        """
+        :return: send time of the oldest ping not followed by a successful one
+        """
+        return self.unconfirmed[0] if self.unconfirmed else None
+
+    def release(self) -> None:
+        """
+        Stops tracking the job's alerting window. Pings still in flight are ignored.
+        :return: None
+        """
+        if self.slot is not None:
+            self.table.remove(self.slot)
+            self.slot = None
+
+
+class WindowTable:
+    """
+    Alerting windows of all jobs pinged by the pod.
+
+    Every field is a NumPy array indexed by slot (struct of arrays), so one vectorized
+    pass per tick finds every job whose alerting window elapsed, whatever the number of jobs.
+    Times are time.time_ns(), 0 meaning none.
+    """
+
+    def __init__(self):
+        self._capacity = 0
+        self._states: List[Optional[JobState]] = []
+        self._free_slots: List[int] = []
+        self.oldest_unconfirmed = np.zeros(0, dtype=np.int64)
+        self.last_success = np.zeros(0, dtype=np.int64)
+        self.window = np.zeros(0, dtype=np.int64)
+
+    def _grow(self) -> None:
+        new_capacity = max(1024, self._capacity * 2)
+        added = new_capacity - self._capacity
+        self._states.extend([None] * added)
+        for field in ("oldest_unconfirmed", "last_success", "window"):
+            setattr(self, field, np.concatenate((getattr(self, field), np.zeros(added, dtype=np.int64))))
+        self._free_slots.extend(range(new_capacity - 1, self._capacity - 1, -1))
+        self._capacity = new_capacity
+
+    def add(self, state: JobState) -> int:
+        """
+        :param state: state of a job that started being pinged
+        :return: slot of the job
+        """
+        if not self._free_slots:
+            self._grow()
+        slot = self._free_slots.pop()
+        self._states[slot] = state
+        self.oldest_unconfirmed[slot] = 0
+        self.last_success[slot] = 0
+        self.window[slot] = state.job.window * 1_000_000
+        return slot
+
+    def remove(self, slot: int) -> None:
+        self._states[slot] = None
+        self.oldest_unconfirmed[slot] = 0
+        self._free_slots.append(slot)
+
+    def due(self, now_ns: int) -> List[JobState]:
+        """
+        :param now_ns: current time.time_ns()
+        :return: jobs whose oldest unconfirmed ping is at least their alerting window old
+        """
+        oldest = self.oldest_unconfirmed
+        slots = np.flatnonzero((oldest != 0) & (now_ns - oldest >= self.window))
+        return [self._states[slot] for slot in slots.tolist()]
+
+    def __len__(self) -> int:
+        return self._capacity - len(self._free_slots)
+
+
+WINDOWS = WindowTable()
@@ -0,0 +1,163 @@
+import os
+import time
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, List, Set
+
+from common import JobStatsData, job_id_t
+
+
+BUCKET_SECONDS = 60
+MEMORY_BUCKETS = int(os.environ.get("JOB_STATS_MEMORY_MINUTES", 60))
+FLUSH_INTERVAL = int(os.environ.get("JOB_STATS_FLUSH_SECONDS", 60))
+FLUSH_BATCH_SIZE = 10_000
+RETENTION = timedelta(hours=int(os.environ.get("JOB_STATS_RETENTION_HOURS", 24)))
+_COUNTER_MAX = 2 ** 16 - 1
+
+
+class JobStatsStore:
+    """
+    Per-minute ping aggregates of all jobs of the pod.
+
+    Every field is a single flat array (struct of arrays) indexed by
+    `slot * MEMORY_BUCKETS + minute % MEMORY_BUCKETS`, so recording a ping
+    allocates nothing and a job costs a fixed number of bytes.
+    """
+
+    def __init__(self):
+        self._slots: Dict[job_id_t, int] = {}
+        self._free_slots: List[int] = []
+        self._released: Set[int] = set()
+        self._dirty: Set[int] = set()
+        self._capacity = 0
+
+        self._job_ids = array('q')
+        self._minutes = array('I')
+        self._pings_ok = array('H')
+        self._pings_failed = array('H')
+        self._latency_sum_ms = array('I')
+        self._latency_max_ms = array('I')
+
+    def _grow(self) -> None:
+        new_capacity = max(16, self._capacity * 2)
+        added = new_capacity - self._capacity
+        self._job_ids.extend([-1] * added)
+        for field in (self._minutes, self._pings_ok, self._pings_failed, self._latency_sum_ms, self._latency_max_ms):
+            field.extend(array(field.typecode, [0]) * (added * MEMORY_BUCKETS))
+        self._free_slots.extend(range(new_capacity - 1, self._capacity - 1, -1))
+        self._capacity = new_capacity
+
+    def acquire(self, job_id: job_id_t) -> None:
+        """
+        Starts collecting statistics of a job, pings of other jobs are ignored.
+        :param job_id: job that started being pinged by this pod
+        :return: None
+        """
+        slot = self._slots.get(job_id)
+        if slot is not None:
+            self._released.discard(slot)
+            return
+        if not self._free_slots:
+            self._grow()
+        slot = self._free_slots.pop()
+        self._slots[job_id] = slot
+        self._job_ids[slot] = job_id
+        start = slot * MEMORY_BUCKETS
+        for field in (self._minutes, self._pings_ok, self._pings_failed, self._latency_sum_ms, self._latency_max_ms):
+            field[start:start + MEMORY_BUCKETS] = array(field.typecode, [0]) * MEMORY_BUCKETS
+
+    def record_ping(self, job_id: job_id_t, success: bool, latency_ms: int, now: float = None) -> None:
+        """
+        :param job_id: pinged job
+        :param success: whether the service responded with 2xx
+        :param latency_ms: round trip time, only aggregated for successful pings
+        :param now: unix time of the ping, current time if not provided
+        :return: None
+        """
+        slot = self._slots.get(job_id)
+        # pings still in flight when the job was released must not allocate its slot again
+        if slot is None or slot in self._released:
+            return
+        minute = int((time.time() if now is None else now) // BUCKET_SECONDS)
+        cell = slot * MEMORY_BUCKETS + minute % MEMORY_BUCKETS
+        if self._minutes[cell] != minute:
+            self._minutes[cell] = minute
+            self._pings_ok[cell] = 0
+            self._pings_failed[cell] = 0
+            self._latency_sum_ms[cell] = 0
+            self._latency_max_ms[cell] = 0
+
+        if success:
+            if self._pings_ok[cell] < _COUNTER_MAX:
+                self._pings_ok[cell] += 1
+                self._latency_sum_ms[cell] = min(self._latency_sum_ms[cell] + latency_ms, 2 ** 32 - 1)
+            self._latency_max_ms[cell] = max(self._latency_max_ms[cell], latency_ms)
+        elif self._pings_failed[cell] < _COUNTER_MAX:
+            self._pings_failed[cell] += 1
+        self._dirty.add(cell)
+
+    def release(self, job_id: job_id_t) -> None:
+        """
+        Frees the job's slot once its remaining buckets are flushed.
+        :param job_id: job that is no longer pinged by this pod
+        :return: None
+        """
+        slot = self._slots.get(job_id)
+        if slot is not None:
+            self._released.add(slot)
+
+    def _row(self, cell: int) -> JobStatsData:
+        return JobStatsData(
+            self._job_ids[cell // MEMORY_BUCKETS],
+            datetime.fromtimestamp(self._minutes[cell] * BUCKET_SECONDS),
+            self._pings_ok[cell],
+            self._pings_failed[cell],
+            self._latency_sum_ms[cell],
+            self._latency_max_ms[cell]
+        )
+
+    def take_dirty(self) -> List[JobStatsData]:
+        """
+        :return: buckets changed since the previous call, with their full per-minute totals
+        """
+        rows = [self._row(cell) for cell in self._dirty]
+        self._dirty = set()
+        for slot in self._released:
+            del self._slots[self._job_ids[slot]]
+            self._job_ids[slot] = -1
+            self._free_slots.append(slot)
+        self._released = set()
+        return rows
+
+    def restore_dirty(self, rows: List[JobStatsData]) -> None:
+        """
+        Marks buckets of a failed flush as dirty again, if they are still held in memory.
+        :param rows: rows returned by take_dirty
+        :return: None
+        """
+        for row in rows:
+            slot = self._slots.get(row.job_id)
+            if slot is None:
+                continue
+            minute = int(row.minute.timestamp() // BUCKET_SECONDS)
+            cell = slot * MEMORY_BUCKETS + minute % MEMORY_BUCKETS
+            if self._minutes[cell] == minute:
+                self._dirty.add(cell)
+
+    def get(self, job_id: job_id_t, since: datetime) -> List[JobStatsData]:
+        """
+        :param job_id: job id
+        :param since: earliest minute to return
+        :return: buckets held in memory for the job, oldest first
+        """
+        slot = self._slots.get(job_id)
+        if slot is None:
+            return []
+        since_minute = since.timestamp() // BUCKET_SECONDS
+        start = slot * MEMORY_BUCKETS
+        cells = [cell for cell in range(start, start + MEMORY_BUCKETS)
+                 if self._minutes[cell] >= since_minute and self._pings_ok[cell] + self._pings_failed[cell] > 0]
+        return [self._row(cell) for cell in sorted(cells, key=lambda c: self._minutes[c])]
+
+
+STORE = JobStatsStore()
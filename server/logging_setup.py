@@ -1,24 +1,178 @@
-import google.cloud.logging
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from typing import List, Optional
+
+from counters import LOG_RECORDS_DROPPED_CTR
+
+
+# logging is moved off the event loop thread unless QUEUE_LOGGING=0
+QUEUE_LOGGING = os.environ.get("QUEUE_LOGGING") != "0"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10_000))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 500))
+# fraction of high-volume info records (per-request "... request received" lines) that are kept
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+SAMPLED_MESSAGE_SUFFIX = "request received"
+# outside GCP, discovering Cloud Logging credentials takes seconds before failing
+CLOUD_LOGGING = os.environ.get("CLOUD_LOGGING") != "0"
+
+_listener: Optional["BatchingQueueListener"] = None
+
 
 def _optimizations():
     logging.logThreads = False
     logging.logProcesses = False
     logging.logMultiprocessing = False
     logging.logAsyncioTasks = False
-    
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only `rate` of the info records whose message ends with SAMPLED_MESSAGE_SUFFIX.
+    Warnings and errors are never sampled.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or self.rate >= 1 or not isinstance(record.msg, str) \
+                or not record.msg.endswith(SAMPLED_MESSAGE_SUFFIX):
+            return True
+        if random.random() < self.rate:
+            return True
+        LOG_RECORDS_DROPPED_CTR.labels("sampled").inc()
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records for the listener thread. Only the message is rendered on the caller's
+    thread, formatting and export are left to the handlers behind the listener.
+    A full queue drops the record instead of blocking the event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        # callers keep mutating their log_data dicts after logging
+        json_fields = getattr(record, "json_fields", None)
+        if isinstance(json_fields, dict):
+            record.json_fields = dict(json_fields)
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED_CTR.labels("queue_full").inc()
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    Drains up to `batch_size` records at once and flushes the handlers once per batch.
+    """
+
+    def __init__(self, log_queue: queue.Queue, handlers: List[logging.Handler], batch_size: int):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                    continue
+                try:
+                    self.handle(record)
+                except Exception:
+                    LOG_RECORDS_DROPPED_CTR.labels("handler_error").inc()
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except Exception:
+                    pass
+            for _ in batch:
+                q.task_done()
+            if stop:
+                return
+
+
+def start_queue_logging(batch_size: int = LOG_BATCH_SIZE, queue_size: int = LOG_QUEUE_SIZE,
+                        sample_rate: float = LOG_SAMPLE_RATE) -> BatchingQueueListener:
+    """
+    Moves the handlers of the root logger behind a bounded queue served by a background thread.
+    :return: started listener
+    """
+    global _listener
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue = queue.Queue(queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = BatchingQueueListener(log_queue, handlers, batch_size)
+    _listener.start()
+    return _listener
+
+
+def stop_queue_logging():
+    """
+    Flushes queued records and restores the original handlers.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, NonBlockingQueueHandler):
+            root.removeHandler(handler)
+    for handler in _listener.handlers:
+        root.addHandler(handler)
+    _listener = None
+
+
+def _default_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(funcName)s - %(levelname)s - %(message)s")
+    _optimizations()
+
+
 def setup_logging():
     try:
+        if not CLOUD_LOGGING:
+            _default_logging()
+            return
+        # imported lazily, it takes a large part of the server's import time
+        import google.cloud.logging
         client = google.cloud.logging.Client()
         client.setup_logging(log_level=logging.INFO)
         _optimizations()
-        # Function names are hardcoded in the log data 
+        # Function names are hardcoded in the log data
         # for speed up (avoiding sys._getframe() calls)
-        logging._srcfile = None 
+        logging._srcfile = None
     except Exception as e:
-        logging.basicConfig(
-            level=logging.INFO, 
-            format="%(asctime)s - %(funcName)s - %(levelname)s - %(message)s")
-        _optimizations()
+        _default_logging()
         logging.error("Error setting up Google Cloud logging: %s", e)
-        raise e
\ No newline at end of file
+        raise e
+    finally:
+        if QUEUE_LOGGING:
+            start_queue_logging()
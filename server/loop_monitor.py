@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional
+
+from counters import EVENT_LOOP_LAG_GAUGE, EVENT_LOOP_STALLS_CTR
+
+
+HEARTBEAT_INTERVAL = int(os.environ.get("LOOP_HEARTBEAT_MS", 50)) / 1000
+LAG_THRESHOLD = int(os.environ.get("LOOP_LAG_THRESHOLD_MS", 100)) / 1000
+WATCHDOG_INTERVAL = HEARTBEAT_INTERVAL / 2
+MAX_PROFILE_SECONDS = 60
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_loop_thread_id: Optional[int] = None
+_last_beat = time.monotonic()
+_lag = 0.0
+_watchdog_thread: Optional[threading.Thread] = None
+
+
+async def event_loop_lag_task(interval: float = HEARTBEAT_INTERVAL):
+    """
+    Measures how late the event loop wakes up a task sleeping for `interval` seconds.
+    Each wakeup is also a heartbeat observed by the watchdog thread.
+    :param interval: time between measurements in seconds
+    :return: None
+    """
+    global _last_beat, _lag
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        _last_beat = time.monotonic()
+        _lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG_GAUGE.set(_lag)
+
+
+def current_lag() -> float:
+    """
+    :return: event loop lag measured by the latest heartbeat, in seconds
+    """
+    return _lag
+
+
+def start_watchdog() -> None:
+    """
+    Starts a thread detecting event loop stalls. Has to be called from the event loop thread.
+    :return: None
+    """
+    global _loop_thread_id, _watchdog_thread, _last_beat
+    if _watchdog_thread is not None:
+        return
+    _loop_thread_id = threading.get_ident()
+    _last_beat = time.monotonic()
+    _watchdog_thread = threading.Thread(target=_watchdog, name="loop-watchdog", daemon=True)
+    _watchdog_thread.start()
+
+
+def _watchdog() -> None:
+    reported_beat = None
+    while True:
+        time.sleep(WATCHDOG_INTERVAL)
+        beat = _last_beat
+        overdue = time.monotonic() - beat - HEARTBEAT_INTERVAL
+        # one report per stall: the heartbeat does not move while the loop is blocked
+        if overdue < LAG_THRESHOLD or beat == reported_beat:
+            continue
+        reported_beat = beat
+
+        frame = sys._current_frames().get(_loop_thread_id)
+        if frame is None:
+            continue
+        call_site = _call_site(frame)
+        EVENT_LOOP_STALLS_CTR.labels(call_site).inc()
+        log_data = {"function_name": "loop_watchdog", "call_site": call_site,
+                    "blocked_ms": int(overdue * 1000), "stack": "".join(traceback.format_stack(frame))}
+        logging.warning("Event loop blocked", extra={"json_fields": log_data})
+
+
+def _call_site(frame) -> str:
+    """
+    :param frame: innermost frame of the blocked thread
+    :return: innermost location in the server code, so stalls inside libraries
+             are attributed to the line that called them
+    """
+    innermost = frame
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(SERVER_DIR):
+            break
+        frame = frame.f_back
+    frame = frame if frame is not None else innermost
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample_stacks(duration: float, interval: float) -> Dict[str, int]:
+    """
+    Samples the event loop thread's stack. Blocks, so it should be run in an executor.
+    :param duration: sampling duration in seconds
+    :param interval: time between samples in seconds
+    :return: collapsed stacks ("outer;...;inner") with the number of samples they were seen in
+    """
+    counts = collections.Counter()
+    end = time.monotonic() + min(duration, MAX_PROFILE_SECONDS)
+    while time.monotonic() < end:
+        frame = sys._current_frames().get(_loop_thread_id)
+        if frame is not None:
+            counts[_collapse(frame)] += 1
+        time.sleep(interval)
+    return counts
@@ -1,10 +1,11 @@
 import os
 
-from aiohttp import web
+from aiohttp import web, ClientError, ClientSession, ClientTimeout
 from aiohttp.web_runner import GracefulExit
-from aiohttp_swagger import setup_swagger
 import asyncio
-from prometheus_client import Counter, generate_latest, CONTENT_TYPE_LATEST
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
 from counters import *
 import logging
 import signal
@@ -13,17 +14,74 @@ import logging
 
 from common import *
 import db_access
-from coroutines import new_job, continue_notifications
-from logging_setup import setup_logging
+import job_index
+import job_stats
+from coroutines import new_job, resume_escalations, job_stats_flush_task, notification_partitions_task, job_archiver_task, \
+    job_starter_task, window_checker_task, close_ping_session, ping_connections_task
+from logging_setup import setup_logging, stop_queue_logging
+import loop_monitor
+import admission
+import metrics_exposition
+import dns_cache
 
 STATEFUL_SET_INDEX = int(os.getenv('STATEFUL_SET_INDEX'))
 
-db_conn = db_access.setup_connection(DB_HOST, DB_PORT)
+DB_CONNECT_RETRIES = int(os.environ.get("DB_CONNECT_RETRIES", 10))
+DB_CONNECT_BACKOFF = 0.5
+DB_CONNECT_MAX_BACKOFF = 5
+
+# with source=memory, get_alerting_jobs merges the job indexes of all PEERS pods of the stateful set,
+# reached through the PEERS_SERVICE headless service, and falls back to the database if one does not answer
+PEERS = int(os.environ.get("PEERS", 1))
+PEERS_SERVICE = os.environ.get("PEERS_SERVICE")
+PEERS_TIMEOUT = ClientTimeout(total=int(os.environ.get("PEERS_TIMEOUT_MS", 1000)) / 1000)
+# pods of a stateful set are named <stateful set>-<index>
+POD_NAME_PREFIX = os.environ.get("POD_NAME", "").rsplit("-", 1)[0]
+
+# connected in on_startup, so the import does not wait for the database
+db_conn = None
+_peers_session = None
+# set once recover_jobs has resumed the pod's jobs
+ready = False
+replica = db_access.ReadReplica(lambda: db_access.setup_connection(DB_RO_HOST, DB_RO_PORT),
+                                DB_RO_MAX_LAG_SECONDS) if DB_RO_HOST else None
+
+
+def read_conn():
+    """
+    :return: connection for listing reads, the replica's unless it is not configured, unreachable or too stale
+    """
+    conn = replica.connection() if replica is not None else None
+    DB_READS_CTR.labels("primary" if conn is None else "replica").inc()
+    return db_conn if conn is None else conn
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    """Measures handler duration, labelled by route template (not by the requested path)."""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_HANDLER_DURATION_HIST.labels(route, str(status)).observe(time.perf_counter() - start)
 
 
 async def metrics_handler(request):
-    """Expose Prometheus metrics."""
-    return web.Response(body=generate_latest(), content_type=CONTENT_TYPE_LATEST.rsplit(';', 1)[0])
+    """Expose Prometheus metrics, from a snapshot rendered off the event loop."""
+    fmt = metrics_exposition.negotiate(request.headers.get('Accept', ''), request.headers.get('Accept-Encoding', ''))
+    body = await metrics_exposition.CACHE.get(fmt)
+    headers = {'Content-Type': metrics_exposition.content_type(fmt)}
+    if fmt[1]:
+        headers['Content-Encoding'] = 'gzip'
+    return web.Response(body=body, headers=headers)
 
 
 async def health_handler(request):
@@ -31,6 +89,28 @@ async def health_handler(request):
     return web.Response(text="OK", status=200)
 
 
+async def readiness_handler(request):
+    """Readiness check endpoint, OK only after the pod's jobs are recovered."""
+    if not ready:
+        return web.Response(text="recovering", status=503)
+    return web.Response(text="OK", status=200)
+
+
+async def profile_handler(request: web.Request):
+    """Samples the event loop thread and returns collapsed stacks (flamegraph input)."""
+    try:
+        seconds = float(request.query.get('seconds', 5))
+        interval = float(request.query.get('interval_ms', 5)) / 1000
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+    if seconds <= 0 or interval <= 0:
+        return web.json_response({'error': "'seconds' and 'interval_ms' should be positive"}, status=400)
+
+    counts = await asyncio.get_running_loop().run_in_executor(None, loop_monitor.sample_stacks, seconds, interval)
+    text = "\n".join(f"{stack} {samples}" for stack, samples in counts.most_common())
+    return web.Response(text=text, status=200)
+
+
 async def add_service(request: web.Request):
     """
     ---
@@ -42,6 +122,12 @@ async def add_service(request: web.Request):
     produces:
       - application/json
     parameters:
+      - in: header
+        name: Idempotency-Key
+        required: false
+        type: string
+        description: Key of the request, retries with the same key and primary email return the job saved by the first call.
+        example: "5f6b3c1e-provisioning-42"
       - in: body
         name: body
         required: true
@@ -84,6 +170,8 @@ async def add_service(request: web.Request):
             job_id:
               type: integer
               example: 0
+      "409":
+        description: The idempotency key was used for a different service
     """
     log_data = {"function_name" : "add_service"}
     logging.info("Add service request received", extra={"json_fields" : log_data})
@@ -107,16 +195,43 @@ async def add_service(request: web.Request):
         logging.error("Non-positive value for period, alerting_window or response_time",
                       extra={"json_fields" : log_data})
         return web.json_response({'error': ERR_MSG_CREATE_POSITIVE_INT}, status=400)
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        logging.error("Invalid idempotency key", extra={"json_fields" : log_data})
+        return web.json_response({'error': ERR_MSG_IDEMPOTENCY_KEY}, status=400)
+
+    retry_after = admission.EMAIL_LIMITER.acquire(mail1)
+    if retry_after:
+        logging.warning("Rate limit exceeded for primary email", extra={"json_fields" : log_data})
+        return admission.reject(429, "rate_limited_email", retry_after)
+    if admission.PENDING_JOB_STARTS.full():
+        logging.warning("Too many jobs waiting to be started", extra={"json_fields" : log_data})
+        return admission.reject(503, "job_queue_full", admission.SHED_RETRY_AFTER)
 
     job_data = JobData(-1, mail1, mail2, url ,period, alerting_window, response_time, True)
     try:
-        job_id = db_access.save_job(job_data, db_conn, STATEFUL_SET_INDEX)
+        if idempotency_key is None:
+            job_id = db_access.save_job(job_data, db_conn, STATEFUL_SET_INDEX)
+        else:
+            saved, created = db_access.save_job_idempotent(job_data, idempotency_key, db_conn, STATEFUL_SET_INDEX)
+            job_id = saved.job_id
     except Exception as e:
         logging.error("Error saving job to database: %s", e,
                       extra={"json_fields" : {**log_data, "job_data" : job_data._asdict()}})
         return web.json_response({'error': str(e)}, status=501)
+    if idempotency_key is not None and not created:
+        log_data["job_data"] = saved._asdict()
+        if saved._replace(job_id=-1, is_active=True) != job_data:
+            logging.warning("Idempotency key reused for a different service", extra={"json_fields" : log_data})
+            return web.json_response({'error': ERR_MSG_IDEMPOTENCY_KEY_REUSED}, status=409)
+        # a retry, the job is already being pinged
+        JOBS_DEDUPLICATED_CTR.inc()
+        logging.info("Service already added", extra={"json_fields" : log_data})
+        return web.json_response({'success': True, 'job_id': job_id}, status=200)
     job_data = JobData(job_id, mail1, mail2, url, period, alerting_window, response_time, True)
-    asyncio.create_task(new_job(job_data, STATEFUL_SET_INDEX))
+    job_index.INDEX.add(job_data)
+    # no await since the full() check above, so there is still room
+    admission.PENDING_JOB_STARTS.put_nowait(job_data)
 
     logging.info("Service added",
                  extra={"json_fields" : {**log_data, "job_data" : job_data._asdict()}})
@@ -190,6 +305,18 @@ async def get_alerting_jobs(request: web.Request):
         type: string
         description: Email of the primary administrator.
         example: "primary@example.com"
+      - in: query
+        name: include_archived
+        required: false
+        type: boolean
+        description: Whether to include archived inactive jobs.
+        example: false
+      - in: query
+        name: source
+        required: false
+        type: string
+        description: "memory lists jobs from the in-memory indexes of all pods instead of the database, which may lag deletions by a second."
+        example: "db"
     responses:
       "200":
         description: Successful response
@@ -210,19 +337,196 @@ async def get_alerting_jobs(request: web.Request):
         return web.json_response({'error': str(e)}, status=400)
 
     log_data["primary_email"] = mail1
+    include_archived = request.query.get('include_archived', 'false').lower() == 'true'
+    jobs = None
+    if request.query.get('source') == 'memory':
+        jobs = await list_jobs_from_pods(mail1)
+        JOB_LISTINGS_CTR.labels("memory" if jobs is not None else "fallback").inc()
     try:
-        jobs = db_access.get_jobs(mail1, db_conn)
+        conn = read_conn() if jobs is None or include_archived else None
+        if jobs is None:
+            jobs = [job._asdict() for job in db_access.get_jobs(mail1, conn)]
+        if include_archived:
+            jobs += [job._asdict() for job in db_access.get_archived_jobs(mail1, conn)]
     except Exception as e:
         logging.error("Error getting jobs from database: %s", e,
                       extra={"json_fields" : log_data})
         return web.json_response({'error': str(e)}, status=500)
-    resp = {"jobs": []}
-    for job in jobs:
-        resp["jobs"].append(job._asdict())
+    resp = {"jobs": jobs}
     logging.info("Alerting jobs retrieved", extra={"json_fields" : log_data})
     return web.json_response(resp, status=200)
 
 
+async def local_jobs(request: web.Request):
+    """
+    ---
+    description: Returns the jobs of this pod from its in-memory index, queried by the other pods for source=memory listings.
+    tags:
+      - Service Monitoring
+    produces:
+      - application/json
+    parameters:
+      - in: query
+        name: primary_email
+        required: false
+        type: string
+        description: Email of the primary administrator.
+        example: "primary@example.com"
+      - in: query
+        name: url
+        required: false
+        type: string
+        description: URL of the service, if no primary_email is given.
+        example: "https://www.google.com/"
+    responses:
+      "200":
+        description: Successful response
+        schema:
+          type: object
+          properties:
+            pod_index:
+              type: integer
+              example: 0
+            jobs:
+              type: array
+              example: []
+      "503":
+        description: The pod's jobs are not recovered yet
+    """
+    if 'primary_email' in request.query:
+        jobs = job_index.INDEX.by_email(request.query['primary_email'])
+    elif 'url' in request.query:
+        jobs = job_index.INDEX.by_url(request.query['url'])
+    else:
+        return web.json_response({'error': "'primary_email' or 'url' is required"}, status=400)
+    if not ready:
+        return web.json_response({'error': "jobs are not recovered yet"}, status=503)
+    return web.json_response({"pod_index": STATEFUL_SET_INDEX, "jobs": [job._asdict() for job in jobs]}, status=200)
+
+
+def peer_url(pod_index: int) -> str:
+    """:return: url of the /local_jobs endpoint of the pod, through the headless service"""
+    return f"http://{POD_NAME_PREFIX}-{pod_index}.{PEERS_SERVICE}:{APP_PORT}/local_jobs"
+
+
+def peers_session() -> ClientSession:
+    global _peers_session
+    if _peers_session is None:
+        _peers_session = ClientSession(timeout=PEERS_TIMEOUT)
+    return _peers_session
+
+
+async def list_jobs_from_pods(primary_email: str) -> Optional[List[dict]]:
+    """
+    :param primary_email: email of the primary administrator
+    :return: jobs from the in-memory indexes of all pods, None if a pod did not answer
+    """
+    if not ready or (PEERS > 1 and PEERS_SERVICE is None):
+        return None
+
+    async def ask(pod_index: int) -> Optional[List[dict]]:
+        try:
+            async with peers_session().get(peer_url(pod_index), params={"primary_email": primary_email}) as response:
+                if response.status != 200:
+                    return None
+                return (await response.json())["jobs"]
+        except (ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            logging.warning("Pod %d did not list its jobs: %s", pod_index, e,
+                            extra={"json_fields" : {"function_name" : "list_jobs_from_pods"}})
+            return None
+
+    peers = await asyncio.gather(*(ask(pod_index) for pod_index in range(PEERS) if pod_index != STATEFUL_SET_INDEX))
+    if any(jobs is None for jobs in peers):
+        return None
+    jobs = [job._asdict() for job in job_index.INDEX.by_email(primary_email)]
+    for peer_jobs in peers:
+        jobs += peer_jobs
+    return sorted(jobs, key=lambda job: job["job_id"])
+
+
+async def get_job_stats(request: web.Request):
+    """
+    ---
+    description: Returns per-minute uptime and latency statistics of a job.
+    tags:
+      - Service Monitoring
+    produces:
+      - application/json
+    parameters:
+      - in: query
+        name: job_id
+        required: true
+        type: integer
+        description: ID of the alerting job.
+        example: 0
+      - in: query
+        name: minutes
+        required: false
+        type: integer
+        description: Number of recent minutes to return, 60 by default.
+        example: 60
+    responses:
+      "200":
+        description: Successful response
+        schema:
+          type: object
+          properties:
+            job_id:
+              type: integer
+              example: 0
+            uptime:
+              type: number
+              example: 0.99
+            avg_latency_ms:
+              type: number
+              example: 42.0
+            buckets:
+              type: array
+              example: []
+    """
+    log_data = {"function_name" : "get_job_stats"}
+    logging.info("Get job stats request received", extra={"json_fields" : log_data})
+
+    try:
+        job_id = int(request.query['job_id'])
+        minutes = int(request.query.get('minutes', 60))
+    except KeyError as e:
+        logging.error("Missing key in request: %s", e, extra={"json_fields" : log_data})
+        return web.json_response({'error': str(e)}, status=400)
+    except ValueError as e:
+        logging.error("Invalid value for job_id or minutes: %s", e, extra={"json_fields" : log_data})
+        return web.json_response({'error': str(e)}, status=400)
+    if minutes <= 0:
+        return web.json_response({'error': "field 'minutes' should be a positive integer"}, status=400)
+
+    log_data["job_id"] = job_id
+    since = datetime.fromtimestamp((time.time() // job_stats.BUCKET_SECONDS - minutes + 1) * job_stats.BUCKET_SECONDS)
+    try:
+        stored = db_access.get_job_stats(job_id, since, read_conn())
+    except Exception as e:
+        logging.error("Error getting job stats from database: %s", e, extra={"json_fields" : log_data})
+        return web.json_response({'error': str(e)}, status=500)
+
+    # buckets of jobs pinged by this pod may be newer in memory than in the database
+    buckets = {row.minute: row for row in stored}
+    buckets.update({row.minute: row for row in job_stats.STORE.get(job_id, since)})
+    rows = sorted(buckets.values(), key=lambda row: row.minute)
+
+    pings_ok = sum(row.pings_ok for row in rows)
+    pings_failed = sum(row.pings_failed for row in rows)
+    resp = {
+        "job_id": job_id,
+        "pings_ok": pings_ok,
+        "pings_failed": pings_failed,
+        "uptime": pings_ok / (pings_ok + pings_failed) if rows else None,
+        "avg_latency_ms": sum(row.latency_sum_ms for row in rows) / pings_ok if pings_ok else None,
+        "max_latency_ms": max((row.latency_max_ms for row in rows), default=None),
+        "buckets": [{**row._asdict(), "minute": row.minute.isoformat()} for row in rows]
+    }
+    logging.info("Job stats retrieved", extra={"json_fields" : log_data})
+    return web.json_response(resp, status=200)
+
+
 async def del_job(request: web.Request):
     """
     ---
@@ -263,6 +567,8 @@ async def del_job(request: web.Request):
     except Exception as e:
         logging.error("Error deleting job from database: %s", e, extra={"json_fields" : log_data})
         return web.json_response({'error': str(e)}, status=500)
+    # jobs of other pods are updated by their active job updater
+    job_index.INDEX.set_active(int(job_id), False)
     logging.info("Job deleted", extra={"json_fields" : log_data})
     return web.json_response({'success': True}, status=200)
 
@@ -290,22 +596,35 @@ async def recover_jobs():
     log_data = {"function_name" : "recover_jobs"}
     logging.info("Recovering jobs", extra={"json_fields" : log_data})
 
+    conn = db_conn
+    if replica is not None:
+        # recovery must see every write of the previous run, the replica is used only once it caught up with the primary
+        try:
+            conn = replica.caught_up_connection(db_access.get_wal_lsn(db_conn)) or db_conn
+        except Exception as e:
+            logging.warning("Error getting the position of the primary: %s", e, extra={"json_fields" : log_data})
+    DB_READS_CTR.labels("replica" if conn is not db_conn else "primary").inc()
+
     try:
-      jobs = db_access.get_jobs_for_stateful_set(STATEFUL_SET_INDEX, db_conn)
+      jobs = db_access.get_jobs_for_stateful_set(STATEFUL_SET_INDEX, conn)
     except Exception as e:
         logging.error("Error getting jobs from database: %s", e, extra={"json_fields" : log_data})
-        return
+        return False
 
     job_dict = {job.job_id: job for job in jobs}
+    for job in jobs:
+        job_index.INDEX.add(job)
 
     active_jobs_ids = [job.job_id for job in jobs if job.is_active]
     inactive_jobs_ids = [job.job_id for job in jobs if not job.is_active]
 
+    # escalations pending for longer than the lookback are stale and are not resumed
+    since = datetime.now() - timedelta(hours=NOTIFICATIONS_RECOVERY_LOOKBACK_HOURS)
     try:
-      notifications = db_access.get_notifications_for_jobs(inactive_jobs_ids, db_conn)
+      notifications = db_access.get_notifications_for_jobs(inactive_jobs_ids, conn, since)
     except Exception as e:
         logging.error("Error getting notifications from database: %s", e, extra={"json_fields" : log_data})
-        return
+        return False
 
     pending_notifications_jobs_ids = [
       job_id for job_id in inactive_jobs_ids
@@ -323,28 +642,122 @@ async def recover_jobs():
         logging.info("Resumed job", extra={"json_fields" : {**log_data, "job_data" : job._asdict()}})
     logging.info("Resumed all jobs", extra={"json_fields" : log_data})
 
-    for job_id in pending_notifications_jobs_ids:
-        job = job_dict[job_id]
-        # get newest notification
-        notification = max(notifications[job.job_id], key=lambda x: x.time_sent)
-        asyncio.create_task(continue_notifications(job, notification))
-        logging.info("Resumed job notifying", extra={"json_fields" : {**log_data, "job_data" : job._asdict()}})
+    pending = [
+      # newest notification
+      (job_dict[job_id], max(notifications[job_id], key=lambda x: x.time_sent))
+      for job_id in pending_notifications_jobs_ids
+    ]
+    if pending:
+        asyncio.create_task(resume_escalations(pending))
     logging.info("Resumed all job notifications", extra={"json_fields" : log_data})
+    return True
+
+
+async def recover_until_done():
+    global ready
+    delay = 1
+    # nothing is resumed before both reads succeed, so a failed attempt can be repeated
+    while not await recover_jobs():
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+    ready = True
+
+
+async def connect_db(app):
+    global db_conn
+    delay = DB_CONNECT_BACKOFF
+    for attempt in range(DB_CONNECT_RETRIES):
+        db_conn = db_access.setup_connection(DB_HOST, DB_PORT)
+        if db_conn is not None:
+            return
+        logging.warning(f"Could not connect to the database, attempt {attempt + 1} of {DB_CONNECT_RETRIES}",
+                        extra={"json_fields" : {"function_name" : "connect_db"}})
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, DB_CONNECT_MAX_BACKOFF)
+    raise ConnectionError("could not connect to the database")
+
 
 async def recover(app):
-    asyncio.create_task(recover_jobs())
+    asyncio.create_task(recover_until_done())
+
+
+async def start_jobs(app):
+    asyncio.create_task(job_starter_task(STATEFUL_SET_INDEX))
+
+
+async def archive_jobs(app):
+    asyncio.create_task(job_archiver_task(STATEFUL_SET_INDEX))
+
+
+async def maintain_notification_partitions(app):
+    asyncio.create_task(notification_partitions_task())
+
+
+async def check_alerting_windows(app):
+    asyncio.create_task(window_checker_task(STATEFUL_SET_INDEX))
 
 
-app = web.Application()
+async def refresh_dns_cache(app):
+    asyncio.create_task(dns_cache.RESOLVER.refresh_task())
+
+
+async def sample_ping_connections(app):
+    asyncio.create_task(ping_connections_task())
+
+
+async def close_pings(app):
+    await close_ping_session()
+    await dns_cache.RESOLVER.close()
+
+
+async def close_peers_session(app):
+    if _peers_session is not None:
+        await _peers_session.close()
+
+
+async def flush_job_stats(app):
+    asyncio.create_task(job_stats_flush_task())
+
+
+async def refresh_metrics_exposition(app):
+    asyncio.create_task(metrics_exposition.CACHE.refresh_task())
+
+
+async def monitor_event_loop(app):
+    asyncio.create_task(loop_monitor.event_loop_lag_task())
+    loop_monitor.start_watchdog()
+
+
+app = web.Application(middlewares=[metrics_middleware, admission.admission_middleware])
+app.on_startup.append(connect_db)
 app.on_startup.append(recover)
+app.on_startup.append(monitor_event_loop)
+app.on_startup.append(flush_job_stats)
+app.on_startup.append(maintain_notification_partitions)
+app.on_startup.append(archive_jobs)
+app.on_startup.append(start_jobs)
+app.on_startup.append(check_alerting_windows)
+app.on_startup.append(refresh_dns_cache)
+app.on_startup.append(sample_ping_connections)
+app.on_startup.append(refresh_metrics_exposition)
+app.on_cleanup.append(close_pings)
+app.on_cleanup.append(close_peers_session)
 app.router.add_post('/add_service', add_service)
 app.router.add_get('/receive_alert', receive_alert)
 app.router.add_get('/alerting_jobs', get_alerting_jobs)
+app.router.add_get('/local_jobs', local_jobs)
+app.router.add_get('/job_stats', get_job_stats)
 app.router.add_get('/metrics_handler', metrics_handler)
 app.router.add_get('/healthz', health_handler)
+app.router.add_get('/readyz', readiness_handler)
 app.router.add_delete('/del_job', del_job)
 app.router.add_get('/hello', hello)
-setup_swagger(app, swagger_url="/api/doc", title="Alerting Platform API", description="API Documentation")
+if os.getenv("PROFILING_ENDPOINT") is not None:
+    app.router.add_get('/debug/profile', profile_handler)
+if os.getenv("API_DOCS") != "0":
+    # aiohttp_swagger is only imported when the docs are served
+    from aiohttp_swagger import setup_swagger
+    setup_swagger(app, swagger_url="/api/doc", title="Alerting Platform API", description="API Documentation")
 
 
 def handle_SIGINT(signum, frame):
@@ -361,4 +774,9 @@ if __name__ == '__main__':
     except Exception as e:
         logging.warning("Using default logging setup: %s", e)
 
+    async def flush_logs(app):
+        stop_queue_logging()
+
+    app.on_cleanup.append(flush_logs)
+
     web.run_app(app, host='0.0.0.0', port=APP_PORT)
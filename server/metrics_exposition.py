@@ -0,0 +1,86 @@
+import asyncio
+import gzip
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+
+from prometheus_client import REGISTRY, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE
+from prometheus_client.openmetrics.exposition import generate_latest as generate_openmetrics
+
+
+# scrapes are answered from a snapshot at most that old, 0 renders every scrape (off the event loop)
+CACHE_SECONDS = float(os.environ.get("METRICS_CACHE_SECONDS", 5))
+GZIP_ENABLED = os.environ.get("METRICS_GZIP") != "0"
+# formats nobody scraped for that long are no longer refreshed
+FORMAT_STALE_SECONDS = 300
+
+# (openmetrics, gzip)
+ExpositionFormat = Tuple[bool, bool]
+
+
+class ExpositionCache:
+    """
+    Pre-rendered exposition of a registry, refreshed in a background thread.
+    Only formats requested by scrapers are rendered.
+    """
+
+    def __init__(self, registry: CollectorRegistry = REGISTRY, cache_seconds: float = CACHE_SECONDS):
+        self.registry = registry
+        self.cache_seconds = cache_seconds
+        self._bodies: Dict[ExpositionFormat, bytes] = {}
+        self._requested: Dict[ExpositionFormat, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics-exposition")
+
+    def _render(self, fmt: ExpositionFormat) -> bytes:
+        openmetrics, compress = fmt
+        body = generate_openmetrics(self.registry) if openmetrics else generate_latest(self.registry)
+        return gzip.compress(body, compresslevel=1) if compress else body
+
+    def _render_all(self, formats) -> Dict[ExpositionFormat, bytes]:
+        return {fmt: self._render(fmt) for fmt in formats}
+
+    async def get(self, fmt: ExpositionFormat) -> bytes:
+        """
+        :param fmt: whether to render OpenMetrics and whether to gzip the body
+        :return: latest snapshot of the exposition, rendered now if the format was not requested before
+        """
+        self._requested[fmt] = time.monotonic()
+        body = self._bodies.get(fmt) if self.cache_seconds > 0 else None
+        if body is None:
+            body = await asyncio.get_running_loop().run_in_executor(self._executor, self._render, fmt)
+            if self.cache_seconds > 0:
+                self._bodies[fmt] = body
+        return body
+
+    async def refresh_task(self):
+        """
+        Re-renders requested formats every `cache_seconds`.
+        :return: None
+        """
+        if self.cache_seconds <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.cache_seconds)
+            now = time.monotonic()
+            formats = [fmt for fmt, requested in self._requested.items() if now - requested < FORMAT_STALE_SECONDS]
+            self._requested = {fmt: self._requested[fmt] for fmt in formats}
+            self._bodies = await loop.run_in_executor(self._executor, self._render_all, formats)
+
+
+def negotiate(accept: str, accept_encoding: str) -> ExpositionFormat:
+    """
+    :param accept: Accept header of the scrape
+    :param accept_encoding: Accept-Encoding header of the scrape
+    :return: format to answer with
+    """
+    return 'application/openmetrics-text' in accept, GZIP_ENABLED and 'gzip' in accept_encoding
+
+
+def content_type(fmt: ExpositionFormat) -> str:
+    return OPENMETRICS_CONTENT_TYPE if fmt[0] else CONTENT_TYPE_LATEST
+
+
+CACHE = ExpositionCache()
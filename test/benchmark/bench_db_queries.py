@@ -0,0 +1,75 @@
+"""
+Per-query latency of db_access functions with and without server-side prepared statements.
+"""
+import argparse
+from datetime import datetime
+
+from bench_env import connect, reset_db, measure, report
+import db_access
+from common import JobData, NotificationData
+
+
+def populate(conn, jobs: int) -> None:
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO jobs (mail1, mail2, url, period, alerting_window, response_time, stateful_set_index, is_active)
+        SELECT 'admin' || (i %% 1000) || '@example.com', 'second@example.com', 'http://service' || i || '.com',
+               1000, 5000, 10000, i %% 3, i %% 10 <> 0
+        FROM generate_series(1, %s) AS i;
+        """,
+        (jobs,)
+    )
+    cursor.execute(
+        """
+        INSERT INTO notifications (time_sent, admin_responded, notification_no, job_id)
+        SELECT now() - (i || ' minutes')::interval, i % 2 = 0, 1 + i % 2, job_id
+        FROM jobs, generate_series(1, 3) AS i WHERE NOT is_active;
+        """
+    )
+    conn.commit()
+
+
+def run(iterations: int) -> dict:
+    conn = connect()
+    job_ids = list(range(1, 201))
+    queries = {
+        "get_jobs": lambda: db_access.get_jobs("admin7@example.com", conn),
+        "get_notification_by_id": lambda: db_access.get_notification_by_id(1, conn),
+        "get_active_job_ids": lambda: db_access.get_active_job_ids(conn, 1),
+        "get_notifications_for_jobs": lambda: db_access.get_notifications_for_jobs(job_ids, conn),
+        "update_notification_response_status": lambda: db_access.update_notification_response_status(1, conn),
+        "set_job_inactive": lambda: db_access.set_job_inactive(5, conn),
+        "save_notification": lambda: db_access.save_notification(NotificationData(-1, datetime.now(), False, 1, 5), conn),
+    }
+    try:
+        results = {}
+        for name, query in queries.items():
+            query()  # warm up (and prepare)
+            results[name] = measure(query, iterations)
+        return results
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=30_000)
+    parser.add_argument("--iterations", type=int, default=2_000)
+    args = parser.parse_args()
+
+    results = {}
+    for prepared in (False, True):
+        # fresh data for each mode, the write queries grow the tables
+        conn = connect()
+        reset_db(conn)
+        populate(conn, args.jobs)
+        conn.close()
+
+        db_access.USE_PREPARED_STATEMENTS = prepared
+        results["prepared" if prepared else "unprepared"] = run(args.iterations)
+    report({"benchmark": "db_queries", "jobs": args.jobs, "iterations": args.iterations, "results": results})
+
+
+if __name__ == '__main__':
+    main()
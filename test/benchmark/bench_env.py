@@ -0,0 +1,54 @@
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+import db_access
+
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = int(os.getenv("DB_PORT", 5432))
+
+
+def connect():
+    conn = db_access.setup_connection(DB_HOST, DB_PORT)
+    if conn is None:
+        raise SystemExit("could not connect to the database, check DB_HOST, DB_PORT, DB_USER, DB_PASS and DB_NAME")
+    return conn
+
+
+def reset_db(conn) -> None:
+    """Recreates the schema by applying all migrations. Drops existing data!"""
+    migrations = sorted((server_dir / "db_migrations").glob("V*__*.sql"),
+                        key=lambda path: int(path.name[1:].split("__")[0]))
+    cursor = conn.cursor()
+    for migration in migrations:
+        cursor.execute(migration.read_text())
+    conn.commit()
+
+
+def measure(func: Callable[[], object], iterations: int) -> Dict[str, float]:
+    """
+    :return: latency statistics of `func` in microseconds
+    """
+    samples: List[float] = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1_000_000)
+    samples.sort()
+    return {
+        "mean_us": statistics.fmean(samples),
+        "p50_us": samples[len(samples) // 2],
+        "p99_us": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+    }
+
+
+def report(results: dict) -> None:
+    print(json.dumps(results, indent=2, default=str))
@@ -0,0 +1,67 @@
+"""
+Listing the jobs of one primary email, as get_alerting_jobs does: the SQL query against a
+lookup in the pod's in-memory JobIndex, for --jobs jobs spread over --emails emails.
+Also times the once-a-second resync of the index with the active job ids of the database.
+"""
+import argparse
+import time
+
+from bench_env import connect, reset_db, measure, report
+import db_access
+from job_index import JobIndex
+
+
+def populate(conn, jobs: int, emails: int) -> None:
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO jobs (mail1, mail2, url, period, alerting_window, response_time, stateful_set_index, is_active)
+        SELECT 'admin' || i %% %s || '@example.com', 'second@example.com', 'http://service' || i || '.com',
+               1000, 5000, 10000, 0, i %% 10 <> 0
+        FROM generate_series(1, %s) AS i;
+        """,
+        (emails, jobs)
+    )
+    cursor.execute("ANALYZE;")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=100_000)
+    parser.add_argument("--emails", type=int, default=10_000)
+    parser.add_argument("--iterations", type=int, default=2_000)
+    args = parser.parse_args()
+
+    conn = connect()
+    reset_db(conn)
+    populate(conn, args.jobs, args.emails)
+
+    start = time.perf_counter()
+    index = JobIndex()
+    for job in db_access.get_jobs_for_stateful_set(0, conn):
+        index.add(job)
+    index_seconds = time.perf_counter() - start
+    active_ids = db_access.get_active_job_ids(conn, 0)
+
+    emails = [f"admin{i % args.emails}@example.com" for i in range(args.iterations)]
+    lookups = iter(emails * 2)
+    assert index.by_email(emails[1]) == db_access.get_jobs(emails[1], conn)
+
+    results = {
+        "sql": measure(lambda: [job._asdict() for job in db_access.get_jobs(next(lookups), conn)], args.iterations),
+        "memory": measure(lambda: [job._asdict() for job in index.by_email(next(lookups))], args.iterations),
+        "sync_active": measure(lambda: index.sync_active(active_ids), 20),
+    }
+    conn.close()
+    report({
+        "benchmark": "job_listing",
+        "jobs": args.jobs,
+        "emails": args.emails,
+        "index_build_seconds": index_seconds,
+        "results": results,
+    })
+
+
+if __name__ == '__main__':
+    main()
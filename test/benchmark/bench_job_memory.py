@@ -0,0 +1,94 @@
+"""
+Memory held per active job: the runtime state of a job before (JobData, PriorityQueue of
+send times and the per-job request closure) and after JobState with its WindowTable slot, and whole suspended
+pinging_task tasks, measured with tracemalloc over --jobs jobs. Does not need a database.
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+from queue import PriorityQueue
+
+from bench_env import report
+
+import coroutines
+from common import JobData
+from job_state import JobState, WindowTable
+
+
+def job(job_id: int) -> JobData:
+    return JobData(job_id, f"admin{job_id}@example.com", f"second{job_id}@example.com",
+                   f"http://localhost:9/{job_id}", 60_000, 60_000, 60_000, True)
+
+
+def legacy_state(job_data: JobData, unconfirmed: int, table: WindowTable):
+    """Locals of pinging_task that outlived a tick before JobState."""
+    async def single_request():
+        return job_data.url
+
+    futures = PriorityQueue()
+    for _ in range(unconfirmed):
+        futures.put((time.time_ns(), None))
+    return job_data, futures, single_request, time.monotonic()
+
+
+def job_state(job_data: JobData, unconfirmed: int, table: WindowTable) -> JobState:
+    state = JobState(job_data, time.monotonic(), table)
+    for _ in range(unconfirmed):
+        state.sent(time.time_ns())
+    return state
+
+
+def bytes_per_job(build, jobs: int, unconfirmed: int) -> float:
+    # the job definitions are loaded from the database either way, they are not counted
+    definitions = [job(job_id) for job_id in range(jobs)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # the window table of JobState is counted, it is allocated in the traced section
+    table = WindowTable()
+    states = [build(job_data, unconfirmed, table) for job_data in definitions]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del states, table
+    return (after - before) / jobs
+
+
+async def task_bytes_per_job(jobs: int) -> float:
+    # keeps the tasks from polling the database for inactive jobs
+    coroutines.cleanup_job_initialized = True
+    definitions = [job(job_id) for job_id in range(jobs)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = [asyncio.create_task(coroutines.pinging_task(job_data, 0)) for job_data in definitions]
+    # lets every task reach its first sleep
+    await asyncio.sleep(0)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return (after - before) / jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=100_000)
+    parser.add_argument("--unconfirmed", type=int, default=1,
+                        help="pings awaiting a response per job, 1 for a healthy job pinged every period")
+    args = parser.parse_args()
+
+    report({
+        "benchmark": "job_memory",
+        "jobs": args.jobs,
+        "unconfirmed_pings": args.unconfirmed,
+        "legacy_state_bytes_per_job": bytes_per_job(legacy_state, args.jobs, args.unconfirmed),
+        "job_state_bytes_per_job": bytes_per_job(job_state, args.jobs, args.unconfirmed),
+        "pinging_task_bytes_per_job": asyncio.run(task_bytes_per_job(args.jobs)),
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Time of the notification reads done by recover_jobs on a table holding years of alerts:
+the pre-partitioning layout (single table, no job_id index) against the partitioned
+table read in full and restricted to the recovery lookback.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from bench_env import connect, reset_db, measure, report
+import db_access
+from common import NOTIFICATIONS_RECOVERY_LOOKBACK_HOURS
+
+
+def populate(conn, jobs: int, years: int, alerts_per_day: int) -> None:
+    cursor = conn.cursor()
+    cursor.execute("SELECT create_notification_partitions((now() - make_interval(years => %s))::timestamp, 0);", (years,))
+    cursor.execute(
+        """
+        INSERT INTO jobs (mail1, mail2, url, period, alerting_window, response_time, stateful_set_index, is_active)
+        SELECT 'admin@example.com', 'second@example.com', 'http://service' || i || '.com', 1000, 5000, 10000, 0, i %% 10 <> 0
+        FROM generate_series(1, %s) AS i;
+        """,
+        (jobs,)
+    )
+    cursor.execute(
+        """
+        INSERT INTO notifications (time_sent, admin_responded, notification_no, job_id)
+        SELECT now() - (i * interval '1 day' / %s), i %% 3 <> 0, 1 + i %% 2, 1 + i %% %s
+        FROM generate_series(1, %s) AS i;
+        """,
+        (alerts_per_day, jobs, alerts_per_day * 365 * years)
+    )
+    # the layout before partitioning: one table with no index on job_id
+    cursor.execute("CREATE TABLE notifications_flat AS SELECT * FROM notifications;")
+    cursor.execute("ALTER TABLE notifications_flat ADD PRIMARY KEY (notification_id);")
+    cursor.execute("ANALYZE;")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=20_000)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--alerts-per-day", type=int, default=2_000)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    conn = connect()
+    reset_db(conn)
+    start = time.perf_counter()
+    populate(conn, args.jobs, args.years, args.alerts_per_day)
+    populate_seconds = time.perf_counter() - start
+
+    inactive_job_ids = [job.job_id for job in db_access.get_jobs_for_stateful_set(0, conn) if not job.is_active]
+    since = datetime.now() - timedelta(hours=NOTIFICATIONS_RECOVERY_LOOKBACK_HOURS)
+
+    def flat():
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM notifications_flat WHERE job_id = ANY(%s);", (inactive_job_ids,))
+        cursor.fetchall()
+        conn.commit()
+
+    results = {
+        "unpartitioned": measure(flat, args.iterations),
+        "partitioned_all": measure(lambda: db_access.get_notifications_for_jobs(inactive_job_ids, conn), args.iterations),
+        "partitioned_lookback": measure(lambda: db_access.get_notifications_for_jobs(inactive_job_ids, conn, since), args.iterations),
+    }
+    conn.close()
+    report({
+        "benchmark": "recovery",
+        "jobs": args.jobs,
+        "inactive_jobs": len(inactive_job_ids),
+        "notifications": args.alerts_per_day * 365 * args.years,
+        "lookback_hours": NOTIFICATIONS_RECOVERY_LOOKBACK_HOURS,
+        "populate_seconds": populate_seconds,
+        "results": results,
+    })
+
+
+if __name__ == '__main__':
+    main()
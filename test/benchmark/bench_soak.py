@@ -0,0 +1,259 @@
+"""
+Soak benchmark of a whole pod: starts the server against the benchmark database and the
+mock target server, ramps jobs up in steps and measures every step. At the end a few
+targets start failing to measure how long alert detection takes.
+
+Reports per step: pings/s received by the targets, schedule jitter (distance between
+consecutive pings of a target minus the job period), event loop lag, server RSS and CPU,
+and database transactions per second.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+
+from bench_env import DB_HOST, DB_PORT, server_dir, connect, reset_db, report
+
+
+mock_server_path = Path(__file__).parent.parent / "integration" / "test_env" / "mock_server.py"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def process_usage(pid: int):
+    """:return: RSS in bytes and CPU time in seconds of the process, read from /proc"""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    with open(f"/proc/{pid}/statm") as statm:
+        rss_pages = int(statm.read().split()[1])
+    return rss_pages * PAGE_SIZE, (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def db_transactions(conn) -> int:
+    cursor = conn.cursor()
+    cursor.execute("SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database();")
+    value = cursor.fetchone()[0]
+    conn.commit()
+    return value
+
+
+async def scrape_metric(session: aiohttp.ClientSession, app_url: str, name: str) -> float:
+    async with session.get(f"{app_url}/metrics_handler") as resp:
+        for line in (await resp.text()).splitlines():
+            if line.startswith(name + " "):
+                return float(line.split()[1])
+    return float("nan")
+
+
+async def wait_for(session: aiohttp.ClientSession, url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url) as resp:
+                if resp.status < 500:
+                    return
+        except aiohttp.ClientError:
+            pass
+        if time.monotonic() > deadline:
+            raise SystemExit(f"{url} did not come up in {timeout}s")
+        await asyncio.sleep(0.2)
+
+
+async def add_jobs(session: aiohttp.ClientSession, app_url: str, mock_url: str, first: int, count: int,
+                   args) -> dict:
+    """:return: endpoint id -> job id of the added jobs"""
+    semaphore = asyncio.Semaphore(args.api_concurrency)
+    job_ids = {}
+
+    async def add(endpoint_id: int):
+        payload = {
+            "url": f"{mock_url}/endpoints/{endpoint_id}",
+            "primary_email": f"admin{endpoint_id % 1000}@example.com",
+            "secondary_email": "second@example.com",
+            "period": args.period_ms,
+            "alerting_window": args.window_ms,
+            "response_time": args.response_time_ms,
+        }
+        async with semaphore:
+            while True:
+                async with session.post(f"{app_url}/add_service", json=payload) as resp:
+                    if resp.status == 200:
+                        job_ids[endpoint_id] = (await resp.json())["job_id"]
+                        return
+                    if resp.status not in (429, 503):
+                        raise SystemExit(f"add_service failed with {resp.status}: {await resp.text()}")
+                    await asyncio.sleep(int(resp.headers.get("Retry-After", 1)))
+
+    await asyncio.gather(*(add(endpoint_id) for endpoint_id in range(first, first + count)))
+    return job_ids
+
+
+async def measure_step(session: aiohttp.ClientSession, app_url: str, mock_url: str, server_pid: int, conn,
+                       seconds: float, period_ms: int) -> dict:
+    async with session.post(f"{mock_url}/reset_endpoint_stats") as resp:
+        assert resp.status == 200
+    async with session.get(f"{mock_url}/get_endpoint_stats") as resp:
+        pings_before = (await resp.json())["pings"]
+    rss, cpu_before = process_usage(server_pid)
+    transactions_before = db_transactions(conn)
+    start = time.monotonic()
+
+    lags = []
+    while time.monotonic() - start < seconds:
+        await asyncio.sleep(1)
+        lags.append(await scrape_metric(session, app_url, "event_loop_lag_seconds"))
+
+    elapsed = time.monotonic() - start
+    async with session.get(f"{mock_url}/get_endpoint_stats") as resp:
+        stats = await resp.json()
+    rss, cpu_after = process_usage(server_pid)
+    intervals = stats["interval_ms"]
+    return {
+        "pings_per_s": (stats["pings"] - pings_before) / elapsed,
+        "schedule_jitter_ms": {
+            key: None if value is None else value - period_ms for key, value in intervals.items()
+        },
+        "event_loop_lag_max_ms": max(lags) * 1000 if lags else None,
+        "rss_mb": rss / 2 ** 20,
+        "cpu_percent": (cpu_after - cpu_before) / elapsed * 100,
+        "db_transactions_per_s": (db_transactions(conn) - transactions_before) / elapsed,
+    }
+
+
+async def measure_alert_detection(session: aiohttp.ClientSession, mock_url: str, conn, job_ids: dict,
+                                  alerts: int, timeout: float) -> dict:
+    """:return: time from the target failing until the first notification is recorded, in ms"""
+    failing = dict(list(job_ids.items())[:alerts])
+    failed_at = datetime.now()
+    async with session.post(f"{mock_url}/configure_endpoints",
+                            json={"modes": {endpoint_id: "404" for endpoint_id in failing}}) as resp:
+        assert resp.status == 200
+
+    cursor = conn.cursor()
+    latencies = {}
+    deadline = time.monotonic() + timeout
+    while len(latencies) < len(failing) and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+        cursor.execute(
+            "SELECT job_id, min(time_sent) FROM notifications WHERE job_id = ANY(%s) AND time_sent >= %s GROUP BY job_id;",
+            (list(failing.values()), failed_at)
+        )
+        for job_id, time_sent in cursor.fetchall():
+            latencies[job_id] = (time_sent - failed_at).total_seconds() * 1000
+        conn.commit()
+
+    samples = sorted(latencies.values())
+    return {
+        "alerts": len(failing),
+        "detected": len(samples),
+        "p50_ms": samples[len(samples) // 2] if samples else None,
+        "max_ms": samples[-1] if samples else None,
+    }
+
+
+async def run(args, server: subprocess.Popen, conn) -> dict:
+    app_url = f"http://localhost:{args.app_port}"
+    mock_url = f"http://localhost:{args.mock_port}"
+    connector = aiohttp.TCPConnector(limit=args.api_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_for(session, f"{mock_url}/get_endpoint_stats", 30)
+        await wait_for(session, f"{app_url}/healthz", 60)
+        async with session.post(f"{mock_url}/configure_endpoints",
+                                json={"latency_ms": args.latency_ms, "latency_dist": args.latency_dist,
+                                      "failure_rate": args.failure_rate}) as resp:
+            assert resp.status == 200
+
+        steps = []
+        job_ids = {}
+        step_size = args.jobs // args.steps
+        for step in range(args.steps):
+            start = time.monotonic()
+            job_ids.update(await add_jobs(session, app_url, mock_url, len(job_ids), step_size, args))
+            ramp_seconds = time.monotonic() - start
+            # let every job of the step go through a few periods
+            await asyncio.sleep(max(1.0, 2 * args.period_ms / 1000))
+            steps.append({
+                "jobs": len(job_ids),
+                "ramp_seconds": ramp_seconds,
+                **await measure_step(session, app_url, mock_url, server.pid, conn, args.step_seconds, args.period_ms),
+            })
+
+        alert_detection = await measure_alert_detection(
+            session, mock_url, conn, job_ids, args.alerts, timeout=10 + 3 * args.window_ms / 1000
+        )
+    return {"steps": steps, "alert_detection": alert_detection}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=100_000)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--step-seconds", type=float, default=30)
+    parser.add_argument("--period-ms", type=int, default=10_000)
+    parser.add_argument("--window-ms", type=int, default=5_000)
+    parser.add_argument("--response-time-ms", type=int, default=60_000)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--latency-dist", default="lognormal", choices=["fixed", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--alerts", type=int, default=20)
+    parser.add_argument("--api-concurrency", type=int, default=64)
+    parser.add_argument("--app-port", type=int, default=8080)
+    parser.add_argument("--mock-port", type=int, default=7100)
+    parser.add_argument("--mock-workers", type=int, default=4)
+    parser.add_argument("--smtp-port", type=int, default=1025,
+                        help="alerts are sent there, nothing has to listen on it")
+    parser.add_argument("--log-dir", default=".")
+    args = parser.parse_args()
+
+    conn = connect()
+    reset_db(conn)
+
+    env = {
+        **os.environ,
+        "STATEFUL_SET_INDEX": "0",
+        "DB_HOST": DB_HOST,
+        "DB_PORT": str(DB_PORT),
+        "APP_HOST": "localhost",
+        "APP_PORT": str(args.app_port),
+        "SMTP_SERVER": "localhost",
+        "SMTP_PORT": str(args.smtp_port),
+        "CLOUD_LOGGING": os.environ.get("CLOUD_LOGGING", "0"),
+        # the harness is the only client, admission control must not throttle the ramp
+        "API_RATE_LIMIT_PER_CLIENT": "1000000",
+        "API_RATE_LIMIT_BURST": "1000000",
+        "ADD_SERVICE_RATE_LIMIT_PER_EMAIL": "1000000",
+        "ADD_SERVICE_RATE_LIMIT_BURST": "1000000",
+    }
+    log_dir = Path(args.log_dir)
+    with open(log_dir / "soak-mock.log", "a") as mock_log, open(log_dir / "soak-server.log", "a") as server_log:
+        mock = subprocess.Popen([sys.executable, str(mock_server_path), "localhost", str(args.mock_port),
+                                 "--workers", str(args.mock_workers), "--max-endpoints", str(args.jobs)],
+                                stdout=mock_log, stderr=mock_log)
+        server = subprocess.Popen([sys.executable, "main.py"], cwd=server_dir, env=env,
+                                  stdout=server_log, stderr=server_log)
+        try:
+            results = asyncio.run(run(args, server, conn))
+        finally:
+            server.terminate()
+            mock.terminate()
+            server.wait()
+            mock.wait()
+    conn.close()
+
+    report({
+        "benchmark": "soak",
+        "period_ms": args.period_ms,
+        "window_ms": args.window_ms,
+        "target_latency": {"mean_ms": args.latency_ms, "dist": args.latency_dist, "failure_rate": args.failure_rate},
+        **results,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Startup time of the server: import time of main.py with and without the Swagger docs, the
+slowest imported modules, and, with --server, the time until /healthz and /readyz answer
+with --jobs active jobs to recover from the benchmark database.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from bench_env import DB_HOST, DB_PORT, server_dir, connect, reset_db, report
+
+
+IMPORT_MAIN = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+
+
+def server_env(**extra) -> dict:
+    return {**os.environ, "STATEFUL_SET_INDEX": "0", "DB_HOST": DB_HOST, "DB_PORT": str(DB_PORT),
+            "CLOUD_LOGGING": os.environ.get("CLOUD_LOGGING", "0"), **extra}
+
+
+def import_ms(runs: int, api_docs: bool) -> dict:
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_MAIN], cwd=server_dir, capture_output=True, text=True,
+                                env=server_env(API_DOCS="1" if api_docs else "0"), check=True).stdout
+        samples.append(float(output.split()[-1]) * 1000)
+    return {"median_ms": statistics.median(samples), "min_ms": min(samples)}
+
+
+def slowest_imports(count: int) -> list:
+    """:return: top-level imports of main.py with the largest cumulative import time"""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=server_dir,
+                            capture_output=True, text=True, env=server_env(), check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # direct imports of main are indented by two spaces
+        if cumulative.strip().isdigit() and name.startswith("   ") and not name.startswith("    "):
+            modules.append({"module": name.strip(), "cumulative_ms": int(cumulative) / 1000})
+    return sorted(modules, key=lambda module: -module["cumulative_ms"])[:count]
+
+
+def wait_for(url: str, timeout: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url) as resp:
+                if resp.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.01)
+    raise SystemExit(f"{url} not ready in {timeout}s")
+
+
+def server_startup(jobs: int, port: int) -> dict:
+    conn = connect()
+    reset_db(conn)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO jobs (mail1, mail2, url, period, alerting_window, response_time, stateful_set_index, is_active)
+        SELECT 'admin@example.com', 'second@example.com', 'http://localhost:9/' || i, 60000, 60000, 60000, 0, true
+        FROM generate_series(1, %s) AS i;
+        """,
+        (jobs,)
+    )
+    conn.commit()
+    conn.close()
+
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "main.py"], cwd=server_dir, env=server_env(APP_PORT=str(port)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        healthy = wait_for(f"http://localhost:{port}/healthz", 60)
+        ready = wait_for(f"http://localhost:{port}/readyz", 120)
+    finally:
+        server.terminate()
+        server.wait()
+    return {"jobs": jobs, "healthz_ms": (healthy - start) * 1000, "readyz_ms": (ready - start) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--server", action="store_true", help="also start the server, needs the benchmark database")
+    parser.add_argument("--jobs", type=int, default=10_000)
+    parser.add_argument("--app-port", type=int, default=8080)
+    args = parser.parse_args()
+
+    results = {
+        "benchmark": "startup",
+        "import_main": import_ms(args.runs, api_docs=True),
+        "import_main_without_api_docs": import_ms(args.runs, api_docs=False),
+        "slowest_imports": slowest_imports(8),
+    }
+    if args.server:
+        results["server"] = server_startup(args.jobs, args.app_port)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Cost of finding the jobs whose alerting window elapsed: one vectorized WindowTable pass
+against the per-job check every pinging_task did after dispatching a ping, for --jobs jobs
+of which --failing are down. Does not need a database.
+"""
+import argparse
+import time
+
+from bench_env import measure, report
+
+from common import JobData
+from job_state import JobState, WindowTable
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--failing", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    results = {"benchmark": "window_check", "failing": args.failing, "runs": []}
+    for jobs in args.jobs:
+        table = WindowTable()
+        now = time.time_ns()
+        states = []
+        for job_id in range(jobs):
+            state = JobState(JobData(job_id, "a@example.com", "b@example.com", "http://localhost:9/", 10_000, 60_000,
+                                     60_000, True), 0.0, table)
+            # failing jobs pinged 2 min ago without success, the rest 1 s ago, awaiting the response
+            state.sent(now - (120 if job_id < args.failing else 1) * 1_000_000_000)
+            states.append(state)
+
+        def per_job():
+            due = []
+            for state in states:
+                oldest = state.oldest_unconfirmed()
+                if oldest is not None and (time.time_ns() - oldest) / 1_000_000 >= state.job.window:
+                    due.append(state)
+            return due
+
+        assert len(table.due(time.time_ns())) == len(per_job()) == args.failing
+        results["runs"].append({
+            "jobs": jobs,
+            "per_job_us": measure(per_job, args.iterations),
+            "vectorized_us": measure(lambda: table.due(time.time_ns()), args.iterations),
+        })
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -74,10 +74,13 @@ def clear_db():
         )
 
         cursor = conn.cursor()
-        setup_file = "../../server/db_migrations/V2__setup.sql"
-        with open(setup_file, 'r') as file:
-            sql_script = file.read()
-        cursor.execute(sql_script)
+        migrations_dir = "../../server/db_migrations"
+        migrations = sorted((f for f in os.listdir(migrations_dir) if f.startswith("V") and f.endswith(".sql")),
+                            key=lambda f: int(f[1:].split("__")[0]))
+        for setup_file in migrations:
+            with open(f"{migrations_dir}/{setup_file}", 'r') as file:
+                sql_script = file.read()
+            cursor.execute(sql_script)
         conn.commit()
     except Exception as e:
         error("error on clearing database: {}".format(e))
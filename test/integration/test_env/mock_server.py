@@ -1,17 +1,103 @@
 from asyncio import sleep
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+import time
 
 from aiohttp import web
 from aiohttp.web import GracefulExit
-from sys import argv, exit, stderr, stdout
+from sys import stderr
 import signal
-from threading import Lock
+from typing import Dict, List
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 response_mode = 'normal'
 response_modes = {'normal', 'timeout', '404'}
 
-pings_ctr_lock = Lock()
-pings_ctr = 0
+# virtual endpoints (/endpoints/{endpoint_id}) used by the benchmarks, each with its own
+# response mode, latency distribution and flap schedule (unset keys fall back to endpoint_config)
+latency_dists = {'fixed', 'uniform', 'exponential', 'lognormal'}
+DEFAULT_ENDPOINT_CONFIG = {
+    'mode': 'normal',
+    'latency_ms': 0.0,
+    'latency_dist': 'fixed',
+    'failure_rate': 0.0,
+    # every flap_period_s (counted from the unix epoch + flap_offset_s) the endpoint
+    # responds with flap_mode for flap_down_s, 0 disables flapping
+    'flap_period_s': 0.0,
+    'flap_down_s': 0.0,
+    'flap_offset_s': 0.0,
+    'flap_mode': '404',
+}
+endpoint_config = dict(DEFAULT_ENDPOINT_CONFIG)
+endpoint_specs: Dict[int, dict] = {}
+INTERVAL_BUCKETS = 1 << 16
+
+
+class SharedState:
+    """
+    Counters and configuration shared by all worker processes.
+
+    Every worker writes only its own row of the counter arrays, so no locking is needed
+    on the request path. Configuration changes are appended to a log file and replayed
+    by every worker before it serves the next request.
+    """
+
+    def __init__(self, workers: int, max_endpoints: int):
+        self.workers = workers
+        self.max_endpoints = max_endpoints
+        self.worker = 0
+        self.legacy_pings = multiprocessing.RawArray('Q', workers)
+        self.pings = multiprocessing.RawArray('Q', workers * max_endpoints)
+        self.failures = multiprocessing.RawArray('Q', workers * max_endpoints)
+        self.last_ping = multiprocessing.RawArray('d', max_endpoints)
+        # histogram of the time between consecutive pings of an endpoint, 1 ms buckets
+        self.intervals = multiprocessing.RawArray('Q', workers * INTERVAL_BUCKETS)
+        self.config_version = multiprocessing.RawValue('Q', 0)
+        self.config_lock = multiprocessing.Lock()
+        fd, self.config_log = tempfile.mkstemp(prefix="mock_server_config_")
+        os.close(fd)
+        self.applied_version = 0
+
+    def append_config(self, update: dict) -> None:
+        line = (json.dumps(update) + "\n").encode()
+        with self.config_lock:
+            with open(self.config_log, "ab") as log:
+                log.write(line)
+            self.config_version.value += len(line)
+        self.sync_config()
+
+    def sync_config(self) -> None:
+        if self.config_version.value == self.applied_version:
+            return
+        with self.config_lock:
+            with open(self.config_log, "rb") as log:
+                log.seek(self.applied_version)
+                lines = log.read(self.config_version.value - self.applied_version).splitlines()
+            self.applied_version = self.config_version.value
+        for line in lines:
+            apply_config(json.loads(line))
+
+    def column_sum(self, array, width: int) -> List[int]:
+        # ctypes exports an explicit-endianness format ('<Q') that memoryview only accepts through a cast
+        view = memoryview(array).cast('B').cast('Q')
+        totals = list(view[:width])
+        for worker in range(1, self.workers):
+            row = view[worker * width:(worker + 1) * width]
+            totals = [a + b for a, b in zip(totals, row)]
+        return totals
+
+
+shared: SharedState = None
 
 
 def panic(where: str, reason: str) -> None:
@@ -22,29 +108,54 @@ def panic(where: str, reason: str) -> None:
     raise GracefulExit()
 
 
+def apply_config(update: dict) -> None:
+    global response_mode
+    if update.get('reset'):
+        endpoint_config.clear()
+        endpoint_config.update(DEFAULT_ENDPOINT_CONFIG)
+        endpoint_specs.clear()
+    endpoint_config.update({key: update[key] for key in DEFAULT_ENDPOINT_CONFIG if key in update})
+    for endpoint_id, mode in update.get('modes', {}).items():
+        endpoint_specs.setdefault(int(endpoint_id), {})['mode'] = mode
+    for ids, spec in update.get('endpoints', {}).items():
+        first, _, last = ids.partition('-')
+        for endpoint_id in range(int(first), int(last or first) + 1):
+            endpoint_specs.setdefault(endpoint_id, {}).update(spec)
+    if 'legacy_mode' in update:
+        response_mode = update['legacy_mode']
+
+
+def validate_config(update: dict) -> None:
+    specs = [update, *update.get('endpoints', {}).values()]
+    for spec in specs:
+        assert set(spec) <= set(DEFAULT_ENDPOINT_CONFIG) | {'modes', 'endpoints', 'reset'}, \
+            f"unknown keys: {set(spec) - set(DEFAULT_ENDPOINT_CONFIG)}"
+        assert spec.get('latency_dist', 'fixed') in latency_dists, f"latency_dist should be one of: {latency_dists}"
+        for key in ('mode', 'flap_mode'):
+            assert spec.get(key, 'normal') in response_modes, f"{key} should be one of: {response_modes}"
+    assert set(update.get('modes', {}).values()) <= response_modes, f"response mode should be one of: {response_modes}"
+    ids = [*update.get('modes', {}), *(part for key in update.get('endpoints', {}) for part in key.split('-'))]
+    assert all(0 <= int(endpoint_id) < shared.max_endpoints for endpoint_id in ids), \
+        f"endpoint ids should be in [0, {shared.max_endpoints})"
+
+
 async def get_num_of_pings(request: web.Request) -> web.Response:
-    global pings_ctr_lock
-    with pings_ctr_lock:
-        val = pings_ctr
-    return web.Response(text=str(val))
+    return web.Response(text=str(sum(memoryview(shared.legacy_pings).cast('B').cast('Q'))))
+
 
 async def set_response_mode(request: web.Request) -> web.Response:
-    global response_mode
     try:
         mode = request.query['mode']
         assert mode in response_modes, f"response mode should be one of: {response_modes}"
     except (KeyError, AssertionError) as e:
         panic("set_response_mode", f"{type(e).__name__}: {e}")
     else:
-        response_mode = mode
+        shared.append_config({'legacy_mode': mode})
         return web.Response(status=200)
 
 
-async def pinging_endpoint(request: web.Request) -> web.Response:
-    global pings_ctr, pings_ctr_lock
-    with pings_ctr_lock:
-        pings_ctr += 1
-    match response_mode:
+async def respond(mode: str) -> web.Response:
+    match mode:
         case 'normal':
             return web.Response(status=200, text='hello world')
         case 'timeout':
@@ -53,27 +164,182 @@ async def pinging_endpoint(request: web.Request) -> web.Response:
         case '404':
             return web.Response(status=404)
         case _:
-            panic("pinging_endpoint", f"Unknown response mode '{response_mode}'")
+            panic("pinging_endpoint", f"Unknown response mode '{mode}'")
+
+
+async def pinging_endpoint(request: web.Request) -> web.Response:
+    shared.sync_config()
+    shared.legacy_pings[shared.worker] += 1
+    return await respond(response_mode)
+
+
+def sample_latency(mean_ms: float, dist: str) -> float:
+    mean = mean_ms / 1000
+    if mean <= 0:
+        return 0
+    match dist:
+        case 'fixed':
+            return mean
+        case 'uniform':
+            return random.uniform(0, 2 * mean)
+        case 'exponential':
+            return random.expovariate(1 / mean)
+        case 'lognormal':
+            # sigma = 1, scaled so that the mean is `mean`
+            return random.lognormvariate(math.log(mean) - 0.5, 1)
+
+
+def current_mode(config: dict) -> str:
+    period = config['flap_period_s']
+    if period > 0 and (time.time() - config['flap_offset_s']) % period < config['flap_down_s']:
+        return config['flap_mode']
+    return config['mode']
+
+
+async def virtual_endpoint(request: web.Request) -> web.Response:
+    shared.sync_config()
+    endpoint_id = int(request.match_info['endpoint_id'])
+    if endpoint_id >= shared.max_endpoints:
+        return web.Response(status=400, text=f"endpoint ids should be below {shared.max_endpoints}")
+
+    now = time.monotonic()
+    cell = shared.worker * shared.max_endpoints + endpoint_id
+    shared.pings[cell] += 1
+    last = shared.last_ping[endpoint_id]
+    if last:
+        bucket = min(int((now - last) * 1000), INTERVAL_BUCKETS - 1)
+        shared.intervals[shared.worker * INTERVAL_BUCKETS + bucket] += 1
+    shared.last_ping[endpoint_id] = now
+
+    spec = endpoint_specs.get(endpoint_id)
+    config = endpoint_config if spec is None else {**endpoint_config, **spec}
+    mode = current_mode(config)
+    if mode != 'normal':
+        shared.failures[cell] += 1
+        return await respond(mode)
+    latency = sample_latency(config['latency_ms'], config['latency_dist'])
+    if latency > 0:
+        await sleep(latency)
+    if config['failure_rate'] and random.random() < config['failure_rate']:
+        shared.failures[cell] += 1
+        return web.Response(status=500)
+    return web.Response(status=200, text='hello world')
+
+
+async def configure_endpoints(request: web.Request) -> web.Response:
+    """
+    Accepts JSON with any of:
+    - the keys of DEFAULT_ENDPOINT_CONFIG, changing the defaults of all endpoints
+    - modes: endpoint id -> response mode
+    - endpoints: endpoint id or "first-last" id range -> dict with keys of DEFAULT_ENDPOINT_CONFIG
+    - reset: true to drop all previous configuration first
+    """
+    try:
+        update = await request.json()
+        validate_config(update)
+    except (ValueError, AssertionError) as e:
+        return web.json_response({'error': str(e)}, status=400)
+    shared.append_config(update)
+    return web.Response(status=200)
+
+
+async def get_endpoint_stats(request: web.Request) -> web.Response:
+    pings = shared.column_sum(shared.pings, shared.max_endpoints)
+    intervals = shared.column_sum(shared.intervals, INTERVAL_BUCKETS)
+    total_intervals = sum(intervals)
+
+    def percentile(q: float):
+        if not total_intervals:
+            return None
+        rank = q * (total_intervals - 1)
+        seen = 0
+        for bucket, count in enumerate(intervals):
+            seen += count
+            if seen > rank:
+                return bucket
+        return INTERVAL_BUCKETS - 1
+
+    return web.json_response({
+        'pings': sum(pings),
+        'failures': sum(memoryview(shared.failures).cast('B').cast('Q')),
+        'endpoints': sum(1 for count in pings if count),
+        'interval_ms': {'p1': percentile(0.01), 'p50': percentile(0.5), 'p99': percentile(0.99)},
+    })
+
+
+async def get_endpoint_counters(request: web.Request) -> web.Response:
+    """Per-endpoint ping and failure counters of endpoints [first, last), in bulk."""
+    try:
+        first = int(request.query.get('first', 0))
+        last = min(int(request.query.get('last', shared.max_endpoints)), shared.max_endpoints)
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+    pings = shared.column_sum(shared.pings, shared.max_endpoints)[first:last]
+    failures = shared.column_sum(shared.failures, shared.max_endpoints)[first:last]
+    return web.json_response({'first': first, 'pings': pings, 'failures': failures})
+
+
+async def reset_endpoint_stats(request: web.Request) -> web.Response:
+    """Clears the interval histogram, e.g. between benchmark steps. Counters keep growing."""
+    memoryview(shared.intervals).cast('B')[:] = bytes(len(shared.intervals) * 8)
+    return web.Response(status=200)
 
 
 app = web.Application()
 app.router.add_get('/get_pings_received', get_num_of_pings)
 app.router.add_post('/set_response_mode', set_response_mode)
 app.router.add_get('/pinging_endpoint', pinging_endpoint)
+app.router.add_get(r'/endpoints/{endpoint_id:\d+}', virtual_endpoint)
+app.router.add_post('/configure_endpoints', configure_endpoints)
+app.router.add_get('/get_endpoint_stats', get_endpoint_stats)
+app.router.add_get('/get_endpoint_counters', get_endpoint_counters)
+app.router.add_post('/reset_endpoint_stats', reset_endpoint_stats)
 
 
 def handle_SIGINT(sig, frame):
     raise GracefulExit()
 
 
-signal.signal(signal.SIGTERM, handle_SIGINT)
+def run_worker(worker: int, host: str, port: int, reuse_port: bool) -> None:
+    shared.worker = worker
+    signal.signal(signal.SIGTERM, handle_SIGINT)
+    if uvloop is not None:
+        uvloop.install()
+    web.run_app(app, host=host, port=port, reuse_port=reuse_port, access_log=None, print=None)
 
 
-if __name__ == '__main__':
-    assert len(argv) == 3, "usage: python mock_server.py host port"
-    host = argv[1]
+def main() -> None:
+    global shared
+    parser = argparse.ArgumentParser(description="Mock target service for the integration tests and benchmarks.")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--workers", type=int, default=1, help="processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument("--max-endpoints", type=int, default=200_000, help="number of virtual endpoints")
+    args = parser.parse_args()
+
+    shared = SharedState(args.workers, args.max_endpoints)
     try:
-        port = int(argv[2])
-    except ValueError:
-        raise ValueError("port number must be an integer but was {}".format(argv[2]))
-    web.run_app(app, host=host, port=port)
\ No newline at end of file
+        if args.workers == 1:
+            run_worker(0, args.host, args.port, reuse_port=False)
+            return
+
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=run_worker, args=(worker, args.host, args.port, True))
+                   for worker in range(args.workers)]
+        for worker in workers:
+            worker.start()
+
+        def stop(sig, frame):
+            for worker in workers:
+                worker.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for worker in workers:
+            worker.join()
+    finally:
+        os.unlink(shared.config_log)
+
+
+if __name__ == '__main__':
+    main()
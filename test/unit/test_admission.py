@@ -0,0 +1,84 @@
+import sys
+from pathlib import Path
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+import pytest
+import asyncio
+from unittest.mock import patch
+from aiohttp import web
+import admission
+import main
+from common import JobData
+
+
+def setup_app():
+    app = web.Application(middlewares=[admission.admission_middleware])
+    app.router.add_post("/add_service", main.add_service)
+    app.router.add_get("/receive_alert", main.receive_alert)
+    app.router.add_get("/hello", main.hello)
+    return app
+
+
+def test_rate_limiter_refills_over_time():
+    limiter = admission.RateLimiter(rate=2, burst=2, max_keys=2)
+    assert limiter.acquire("a", now=0) == 0
+    assert limiter.acquire("a", now=0) == 0
+    assert limiter.acquire("a", now=0) == pytest.approx(0.5)
+    assert limiter.acquire("a", now=0.5) == 0
+    assert limiter.acquire("b", now=0.5) == 0
+
+    # "a" is evicted as the least recently used key and starts with a full bucket
+    limiter.acquire("c", now=0.5)
+    assert limiter.acquire("a", now=0.5) == 0
+    assert limiter.acquire("a", now=0.5) == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_middleware_rate_limits_clients(aiohttp_client):
+    with patch.object(admission, "CLIENT_LIMITER", admission.RateLimiter(rate=0.01, burst=1)):
+        test_client = await aiohttp_client(setup_app())
+        assert (await test_client.get("/hello")).status == 200
+
+        resp = await test_client.get("/hello")
+        assert resp.status == 429
+        assert int(resp.headers["Retry-After"]) >= 1
+
+        # exempt routes are not limited
+        assert (await test_client.get("/receive_alert")).status == 400
+
+
+@pytest.mark.asyncio
+async def test_admission_middleware_sheds_load_on_event_loop_lag(aiohttp_client):
+    with patch("admission.loop_monitor.current_lag", return_value=admission.SHED_LAG_THRESHOLD + 1):
+        test_client = await aiohttp_client(setup_app())
+        resp = await test_client.get("/hello")
+        assert resp.status == 503
+        assert resp.headers["Retry-After"] == "1"
+        assert (await test_client.get("/receive_alert")).status == 400
+
+
+@pytest.mark.asyncio
+async def test_add_service_admission(aiohttp_client):
+    payload = {
+        "url": "http://example.com",
+        "primary_email": "admission@example.com",
+        "secondary_email": "secondary@example.com",
+        "period": 10,
+        "alerting_window": 5,
+        "response_time": 2
+    }
+    with patch.object(admission, "EMAIL_LIMITER", admission.RateLimiter(rate=0.01, burst=2)), \
+         patch.object(admission, "PENDING_JOB_STARTS", asyncio.Queue(1)), \
+         patch("main.db_access.save_job", return_value=123) as save_job:
+        test_client = await aiohttp_client(setup_app())
+
+        assert (await test_client.post("/add_service", json=payload)).status == 200
+        assert admission.PENDING_JOB_STARTS.get_nowait() == JobData(123, "admission@example.com", "secondary@example.com",
+                                                                    "http://example.com", 10, 5, 2, True)
+        admission.PENDING_JOB_STARTS.put_nowait(None)
+
+        assert (await test_client.post("/add_service", json=payload)).status == 503
+        assert (await test_client.post("/add_service", json=payload)).status == 429
+        assert save_job.call_count == 1
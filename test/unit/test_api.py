@@ -6,10 +6,14 @@ sys.path.append(str(server_dir))
 
 import pytest
 import asyncio
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 from aiohttp import web
+from prometheus_client import REGISTRY, CollectorRegistry, Counter
 import main
-from common import JobData
+from common import JobData, JobStatsData
+from datetime import datetime
+import job_stats
+import metrics_exposition
 
 
 example_payload = {
@@ -28,6 +32,9 @@ def setup_app():
     app.router.add_get("/receive_alert", main.receive_alert)
     app.router.add_get("/get_alerting_jobs", main.get_alerting_jobs)
     app.router.add_delete('/del_job', main.del_job)
+    app.router.add_get("/job_stats", main.get_job_stats)
+    app.router.add_get("/readyz", main.readiness_handler)
+    app.router.add_get("/metrics_handler", main.metrics_handler)
     return app
 
 
@@ -46,6 +53,35 @@ async def test_add_service_success(aiohttp_client):
         assert data == {"success": True, "job_id": 123}
 
 
+@pytest.mark.asyncio
+async def test_add_service_retry_with_idempotency_key(aiohttp_client):
+    saved = JobData(123, "primary@example.com", "secondary@example.com", "http://example.com", 10, 5, 2, True)
+    with patch("main.db_access.save_job_idempotent", side_effect=[(saved, True), (saved, False)]) as save_job_idempotent, \
+         patch("main.admission.PENDING_JOB_STARTS", asyncio.Queue()) as pending:
+        test_client = await aiohttp_client(setup_app())
+        headers = {"Idempotency-Key": "provisioning-1"}
+
+        for _ in range(2):
+            resp = await test_client.post("/add_service", json=example_payload, headers=headers)
+            assert resp.status == 200
+            assert await resp.json() == {"success": True, "job_id": 123}
+        assert save_job_idempotent.call_args.args[1] == "provisioning-1"
+        # the retry is not started again
+        assert pending.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_add_service_idempotency_key_reused_for_another_service(aiohttp_client):
+    saved = JobData(123, "primary@example.com", "secondary@example.com", "http://other.com", 10, 5, 2, False)
+    with patch("main.db_access.save_job_idempotent", return_value=(saved, False)):
+        test_client = await aiohttp_client(setup_app())
+        resp = await test_client.post("/add_service", json=example_payload, headers={"Idempotency-Key": "provisioning-1"})
+        assert resp.status == 409
+
+        resp = await test_client.post("/add_service", json=example_payload, headers={"Idempotency-Key": "k" * 256})
+        assert resp.status == 400
+
+
 @pytest.mark.asyncio
 async def test_add_service_missing_keys(aiohttp_client):
     test_client = await aiohttp_client(setup_app())
@@ -124,6 +160,24 @@ async def test_get_alerting_jobs_success(aiohttp_client):
         assert data == {"jobs": [jobData._asdict(),]}
 
 
+@pytest.mark.asyncio
+async def test_get_alerting_jobs_include_archived(aiohttp_client):
+    job_data = JobData(1, "primary@example.com", "secondary@example.com", "https://example.com", 12, 54, 42, False)
+    archived_data = job_data._replace(job_id=2)
+    with patch("main.db_access.get_jobs", return_value=[job_data,]), \
+         patch("main.db_access.get_archived_jobs", return_value=[archived_data,]) as get_archived_jobs:
+        test_client = await aiohttp_client(setup_app())
+
+        resp = await test_client.get("/get_alerting_jobs", params={'primary_email': 'primary@example.com'})
+        assert (await resp.json()) == {"jobs": [job_data._asdict(),]}
+        get_archived_jobs.assert_not_called()
+
+        params = {'primary_email': 'primary@example.com', 'include_archived': 'true'}
+        resp = await test_client.get("/get_alerting_jobs", params=params)
+        assert resp.status == 200
+        assert (await resp.json()) == {"jobs": [job_data._asdict(), archived_data._asdict()]}
+
+
 @pytest.mark.asyncio
 async def test_get_alerting_jobs_missing_primary_email(aiohttp_client):
     test_client = await aiohttp_client(setup_app())
@@ -170,3 +224,182 @@ async def test_del_job_db_error(aiohttp_client):
         params = {'job_id': '1'}
         resp = await test_client.delete("/del_job", params=params)
         assert resp.status == 500
+
+
+@pytest.mark.asyncio
+async def test_metrics_middleware_labels_by_route(aiohttp_client):
+    app = web.Application(middlewares=[main.metrics_middleware])
+    app.router.add_get("/receive_alert", main.receive_alert)
+    test_client = await aiohttp_client(app)
+
+    labels = {"route": "/receive_alert", "status": "400"}
+    before = REGISTRY.get_sample_value("http_handler_duration_seconds_count", labels) or 0
+
+    resp = await test_client.get("/receive_alert")
+    assert resp.status == 400
+    assert REGISTRY.get_sample_value("http_handler_duration_seconds_count", labels) == before + 1
+
+    resp = await test_client.get("/receive_alert/unknown")
+    assert resp.status == 404
+    assert REGISTRY.get_sample_value("http_handler_duration_seconds_count", {"route": "unmatched", "status": "404"}) >= 1
+
+
+@pytest.mark.asyncio
+async def test_get_job_stats_merges_memory_and_db(aiohttp_client):
+    now = datetime.now().timestamp()
+    minute = datetime.fromtimestamp(now // 60 * 60)
+    stored = [JobStatsData(77, minute, 1, 1, 30, 30)]
+    job_stats.STORE.acquire(77)
+    job_stats.STORE.record_ping(77, True, 10, now)
+    job_stats.STORE.record_ping(77, True, 20, now)
+    job_stats.STORE.record_ping(77, False, 0, now)
+
+    with patch("main.db_access.get_job_stats", return_value=stored):
+        test_client = await aiohttp_client(setup_app())
+
+        resp = await test_client.get("/job_stats", params={"job_id": "77", "minutes": "5"})
+        assert resp.status == 200
+        data = await resp.json()
+        assert data["pings_ok"] == 2
+        assert data["pings_failed"] == 1
+        assert data["avg_latency_ms"] == 15
+        assert len(data["buckets"]) == 1
+
+
+def test_job_stats_store_ignores_pings_of_released_jobs():
+    store = job_stats.JobStatsStore()
+    store.acquire(1)
+    store.record_ping(1, True, 10)
+    store.release(1)
+    # a ping still in flight when the job alerted
+    store.record_ping(1, False, 0)
+    store.take_dirty()
+    store.record_ping(1, False, 0)
+    assert store.take_dirty() == []
+    assert store._slots == {}
+
+    store.record_ping(2, True, 10)
+    assert store.get(2, datetime.fromtimestamp(0)) == []
+
+
+@pytest.mark.asyncio
+async def test_get_job_stats_invalid_minutes(aiohttp_client):
+    test_client = await aiohttp_client(setup_app())
+
+    resp = await test_client.get("/job_stats", params={"job_id": "1", "minutes": "0"})
+    assert resp.status == 400
+
+
+@pytest.mark.asyncio
+async def test_readyz_after_recovery(aiohttp_client, monkeypatch):
+    monkeypatch.setattr(main, "ready", False)
+    recover_jobs = AsyncMock(side_effect=[False, True])
+    with patch("main.recover_jobs", recover_jobs), patch("main.asyncio.sleep", new_callable=AsyncMock):
+        test_client = await aiohttp_client(setup_app())
+        assert (await test_client.get("/readyz")).status == 503
+
+        await main.recover_until_done()
+        assert recover_jobs.call_count == 2
+        assert (await test_client.get("/readyz")).status == 200
+
+
+@pytest.mark.asyncio
+async def test_connect_db_retries(monkeypatch):
+    monkeypatch.setattr(main, "db_conn", None)
+    conn = object()
+    with patch("main.db_access.setup_connection", side_effect=[None, None, conn]) as setup_connection, \
+         patch("main.asyncio.sleep", new_callable=AsyncMock):
+        await main.connect_db(None)
+    assert setup_connection.call_count == 3
+    assert main.db_conn is conn
+
+    with patch("main.db_access.setup_connection", return_value=None), \
+         patch("main.asyncio.sleep", new_callable=AsyncMock):
+        with pytest.raises(ConnectionError):
+            await main.connect_db(None)
+
+
+@pytest.mark.asyncio
+async def test_metrics_handler_serves_cached_snapshot(aiohttp_client):
+    registry = CollectorRegistry()
+    counter = Counter("test_scrapes", "Test counter", registry=registry)
+    cache = metrics_exposition.ExpositionCache(registry, cache_seconds=60)
+    with patch("main.metrics_exposition.CACHE", cache):
+        test_client = await aiohttp_client(setup_app())
+
+        resp = await test_client.get("/metrics_handler", headers={"Accept-Encoding": "identity"})
+        assert resp.status == 200
+        assert resp.headers["Content-Type"].startswith("text/plain")
+        assert "test_scrapes_total 0.0" in await resp.text()
+
+        counter.inc()
+        resp = await test_client.get("/metrics_handler", headers={"Accept-Encoding": "identity"})
+        assert "test_scrapes_total 0.0" in await resp.text()
+
+        resp = await test_client.get("/metrics_handler", headers={
+            "Accept": "application/openmetrics-text; version=1.0.0",
+            "Accept-Encoding": "gzip",
+        })
+        assert resp.headers["Content-Type"].startswith("application/openmetrics-text")
+        assert resp.headers["Content-Encoding"] == "gzip"
+        text = await resp.text()
+        assert "test_scrapes_total 1.0" in text
+        assert text.endswith("# EOF\n")
+
+
+@pytest.mark.asyncio
+async def test_get_alerting_jobs_reads_from_replica(aiohttp_client, monkeypatch):
+    replica_conn, primary_conn = object(), object()
+    replica = MagicMock()
+    replica.connection.return_value = replica_conn
+    monkeypatch.setattr(main, "replica", replica)
+    monkeypatch.setattr(main, "db_conn", primary_conn)
+    with patch("main.db_access.get_jobs", return_value=[]) as get_jobs:
+        test_client = await aiohttp_client(setup_app())
+        resp = await test_client.get("/get_alerting_jobs", params={"primary_email": "primary@example.com"})
+        assert resp.status == 200
+        assert get_jobs.call_args.args[1] is replica_conn
+
+        # too stale
+        replica.connection.return_value = None
+        await test_client.get("/get_alerting_jobs", params={"primary_email": "primary@example.com"})
+        assert get_jobs.call_args.args[1] is primary_conn
+
+
+@pytest.mark.asyncio
+async def test_get_alerting_jobs_from_memory_of_all_pods(aiohttp_client, aiohttp_server, monkeypatch):
+    peer_status = [200]
+
+    async def peer_local_jobs(request):
+        job = JobData(2, request.query["primary_email"], "b@example.com", "http://b.com/", 10, 5, 2, True)
+        return web.json_response({"pod_index": 1, "jobs": [job._asdict()]}, status=peer_status[0])
+
+    peer = web.Application()
+    peer.router.add_get("/local_jobs", peer_local_jobs)
+    peer_server = await aiohttp_server(peer)
+
+    index = main.job_index.JobIndex()
+    index.add(JobData(3, "primary@example.com", "b@example.com", "http://a.com/", 10, 5, 2, False))
+    monkeypatch.setattr(main.job_index, "INDEX", index)
+    monkeypatch.setattr(main, "ready", True)
+    monkeypatch.setattr(main, "PEERS", 2)
+    monkeypatch.setattr(main, "PEERS_SERVICE", "alerting-app-headless")
+    monkeypatch.setattr(main, "STATEFUL_SET_INDEX", 0)
+    monkeypatch.setattr(main, "peer_url", lambda pod_index: str(peer_server.make_url("/local_jobs")))
+    monkeypatch.setattr(main, "_peers_session", None)
+
+    app = setup_app()
+    app.on_cleanup.append(main.close_peers_session)
+    with patch("main.db_access.get_jobs", return_value=[]) as get_jobs:
+        test_client = await aiohttp_client(app)
+        params = {"primary_email": "primary@example.com", "source": "memory"}
+        resp = await test_client.get("/get_alerting_jobs", params=params)
+        assert resp.status == 200
+        assert [job["job_id"] for job in (await resp.json())["jobs"]] == [2, 3]
+        get_jobs.assert_not_called()
+
+        # a pod that cannot answer makes the listing fall back to the database
+        peer_status[0] = 503
+        resp = await test_client.get("/get_alerting_jobs", params=params)
+        assert (await resp.json())["jobs"] == []
+        get_jobs.assert_called_once()
@@ -0,0 +1,81 @@
+import sys
+from pathlib import Path
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+import socket
+
+import pytest
+from prometheus_client import REGISTRY
+import circuit_breaker
+import coroutines
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, TRIAL
+from common import JobData
+from job_state import JobState, WindowTable
+
+
+def test_circuit_opens_after_consecutive_connect_failures():
+    breaker = CircuitBreaker(failure_threshold=3, open_seconds=10)
+    for _ in range(2):
+        breaker.record("a:80", True, now=0)
+    # any response resets the count
+    breaker.record("a:80", False, now=0)
+    for _ in range(2):
+        breaker.record("a:80", True, now=0)
+    assert breaker.allow("a:80", now=1) == CLOSED
+
+    breaker.record("a:80", True, now=1)
+    assert breaker.allow("a:80", now=2) == OPEN
+    assert breaker.allow("b:80", now=2) == CLOSED
+
+
+def test_open_circuit_is_checked_by_one_trial_at_a_time():
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10)
+    breaker.record("a:80", True, now=0)
+
+    assert breaker.allow("a:80", now=5) == OPEN
+    assert breaker.allow("a:80", now=10) == TRIAL
+    assert breaker.allow("a:80", now=10) == OPEN
+    # pings sent before the circuit opened do not postpone the next trial
+    breaker.record("a:80", True, now=11)
+    breaker.record("a:80", True, trial=True, now=12)
+    assert breaker.allow("a:80", now=21) == OPEN
+    assert breaker.allow("a:80", now=22) == TRIAL
+
+    breaker.record("a:80", False, trial=True, now=22)
+    assert breaker.allow("a:80", now=22) == CLOSED
+
+
+def test_evicting_a_host_closes_its_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10, max_hosts=1)
+    breaker.record("a:80", True, now=0)
+    breaker.record("b:80", True, now=0)
+    assert breaker.allow("a:80", now=1) == CLOSED
+    assert breaker.allow("b:80", now=1) == OPEN
+
+
+@pytest.mark.asyncio
+async def test_pings_to_an_unreachable_host_are_short_circuited(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "BREAKER", CircuitBreaker(failure_threshold=3, open_seconds=60))
+    # nothing listens on the port once the socket is closed
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    def short_circuited():
+        return REGISTRY.get_sample_value("pings_short_circuited_total") or 0
+
+    table = WindowTable()
+    states = [JobState(JobData(job_id, "a@example.com", "b@example.com", f"http://127.0.0.1:{port}/{job_id}",
+                               1000, 5000, 1000, True), 0.0, table) for job_id in range(5)]
+    before = short_circuited()
+    try:
+        for state in states:
+            await coroutines.single_request(state)
+    finally:
+        await coroutines.close_ping_session()
+
+    assert short_circuited() == before + 2
+    # short-circuited pings still count towards the alerting window
+    assert all(state.oldest_unconfirmed() is not None for state in states)
@@ -0,0 +1,237 @@
+import sys
+from pathlib import Path
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiohttp import web
+from prometheus_client import REGISTRY
+import coroutines
+from common import JobData, NotificationData
+from job_state import JobState, WindowTable
+
+
+def test_ping_phases_of_consecutive_jobs_are_spread_over_the_period():
+    period = 10.0
+    phases = [coroutines.ping_phase(job_id, period) for job_id in range(1, 1001)]
+    assert all(0 <= phase < period for phase in phases)
+
+    per_second = [0] * 10
+    for phase in phases:
+        per_second[int(phase)] += 1
+    assert max(per_second) < 1.2 * len(phases) / 10
+
+    assert coroutines.ping_phase(42, period) == coroutines.ping_phase(42, period)
+
+
+def test_first_ping_delay_is_aligned_to_the_epoch():
+    period = 10.0
+    phase = coroutines.ping_phase(7, period)
+    now = 1_000_000.0 + phase - 1
+    assert coroutines.first_ping_delay(7, period, now) == pytest.approx(1)
+    assert coroutines.first_ping_delay(7, period, now + 2) == pytest.approx(9)
+
+
+def test_count_dispatch_observes_previous_tick(monkeypatch):
+    def count():
+        return REGISTRY.get_sample_value("pings_dispatched_per_tick_count") or 0
+
+    def total():
+        return REGISTRY.get_sample_value("pings_dispatched_per_tick_sum") or 0
+
+    clock = [1000.0]
+    monkeypatch.setattr(coroutines.time, "monotonic", lambda: clock[0])
+    coroutines.count_dispatch()
+    count_before, total_before = count(), total()
+    for _ in range(4):
+        coroutines.count_dispatch()
+
+    clock[0] += coroutines.DISPATCH_TICK
+    coroutines.count_dispatch()
+    assert count() == count_before + 1
+    assert total() == total_before + 5
+
+
+def job(job_id: int, window: int = 5000) -> JobData:
+    return JobData(job_id, "a@example.com", "b@example.com", "http://localhost/", 1000, window, 1000, True)
+
+
+def test_job_state_tracks_oldest_unconfirmed_ping():
+    table = WindowTable()
+    state = JobState(job(1), 0.0, table)
+    assert state.oldest_unconfirmed() is None
+
+    for sent in (10, 20, 30):
+        state.sent(sent)
+    assert state.oldest_unconfirmed() == 10
+    assert table.oldest_unconfirmed[state.slot] == 10
+
+    state.succeeded(20)
+    assert state.oldest_unconfirmed() == 30
+    # a late response of an older ping does not confirm newer ones
+    state.succeeded(10)
+    assert state.oldest_unconfirmed() == 30
+
+    state.succeeded(30)
+    assert state.oldest_unconfirmed() is None
+    assert table.oldest_unconfirmed[state.slot] == 0
+
+
+def test_window_table_finds_jobs_whose_window_elapsed():
+    table = WindowTable()
+    states = [JobState(job(job_id, window=1000 * job_id), 0.0, table) for job_id in range(1, 2001)]
+    second = 1_000_000_000
+    for state in states:
+        state.sent(second)
+    states[0].succeeded(second)
+    assert len(table) == 2000
+
+    # windows of 1 s .. 2000 s, all measured from the ping sent at 1 s
+    due = table.due(11 * second)
+    assert [state.job.job_id for state in due] == list(range(2, 11))
+
+    for state in due:
+        state.release()
+    assert table.due(11 * second) == []
+    assert len(table) == 1991
+
+    # released slots are reused and do not inherit the previous job's window
+    reused = JobState(job(3000, window=60_000), 0.0, table)
+    reused.sent(11 * second)
+    assert reused not in table.due(12 * second)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("ping_now", [True, False])
+async def test_new_jobs_are_pinged_before_their_phase(monkeypatch, ping_now):
+    pinged = []
+
+    async def single_request(state):
+        pinged.append(state.job.job_id)
+
+    monkeypatch.setattr(coroutines, "single_request", single_request)
+    monkeypatch.setattr(coroutines, "cleanup_job_initialized", True)
+    # phase of the job is almost a whole period away
+    monkeypatch.setattr(coroutines, "first_ping_delay", lambda job_id, period: period - 0.001)
+    task = asyncio.create_task(coroutines.pinging_task(job(5, window=60_000)._replace(period=60_000), 0, ping_now))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert pinged == ([5] if ping_now else [])
+
+
+@pytest.mark.asyncio
+async def test_pings_of_one_host_share_keep_alive_connections(aiohttp_server):
+    async def handler(request):
+        await asyncio.sleep(0.01)
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get('/{path}', handler)
+    server = await aiohttp_server(app)
+
+    def opened(origin):
+        return REGISTRY.get_sample_value("ping_connections_opened_total", {"origin": origin}) or 0
+
+    table = WindowTable()
+    states = [JobState(job(job_id)._replace(url=str(server.make_url(f"/{job_id}"))), 0.0, table) for job_id in range(40)]
+    new_before, reused_before = opened("new"), opened("reused")
+    try:
+        await asyncio.gather(*(coroutines.single_request(state) for state in states))
+        await asyncio.gather(*(coroutines.single_request(state) for state in states))
+        coroutines.sample_ping_connections()
+    finally:
+        await coroutines.close_ping_session()
+
+    assert all(state.oldest_unconfirmed() is None for state in states)
+    # the second round only reuses connections of the first one
+    new = opened("new") - new_before
+    assert new <= 40
+    assert opened("reused") - reused_before == 80 - new
+    assert REGISTRY.get_sample_value("ping_connection_hosts") == 1
+    assert REGISTRY.get_sample_value("ping_connections_per_host_max") == new
+
+
+@pytest.mark.asyncio
+async def test_degraded_probing_backs_off_and_rearms_recovered_job(monkeypatch):
+    outcomes = [False, False, True, True, True]
+    probes = []
+    started = []
+
+    async def probe(url):
+        probes.append(asyncio.get_running_loop().time())
+        return outcomes[len(probes) - 1]
+
+    async def new_job(job_data, pod_index, ping_now=False):
+        started.append((job_data.job_id, job_data.is_active, ping_now))
+
+    rearmed = MagicMock(return_value=True)
+    monkeypatch.setattr(coroutines, "probe", probe)
+    monkeypatch.setattr(coroutines, "new_job", new_job)
+    monkeypatch.setattr(coroutines, "DEGRADED_PROBE_MAX_SECONDS", 0.04)
+    monkeypatch.setattr(coroutines.db_access, "setup_connection", MagicMock())
+    monkeypatch.setattr(coroutines.db_access, "set_job_active", rearmed)
+
+    state = JobState(job(9)._replace(period=10, is_active=False), 0.0, WindowTable())
+    await coroutines.degraded_probing_task(state, 0)
+    await asyncio.sleep(0)
+
+    assert len(probes) == 5
+    intervals = [later - earlier for earlier, later in zip(probes, probes[1:])]
+    # doubled after each failure up to the maximum, kept while recovery is confirmed
+    assert intervals[0] == pytest.approx(0.02, abs=0.01)
+    assert all(interval == pytest.approx(0.04, abs=0.01) for interval in intervals[1:])
+    assert state.recovered
+    assert rearmed.call_args.args[:2] == (9, 0)
+    assert started == [(9, True, True)]
+
+
+@pytest.mark.asyncio
+async def test_degraded_probing_gives_up_after_max_duration(monkeypatch):
+    async def probe(url):
+        return False
+
+    monkeypatch.setattr(coroutines, "probe", probe)
+    monkeypatch.setattr(coroutines, "DEGRADED_PROBE_MAX_HOURS", 0.05 / 3600)
+    state = JobState(job(10)._replace(period=10), 0.0, WindowTable())
+    await asyncio.wait_for(coroutines.degraded_probing_task(state, 0), 1)
+    assert not state.recovered
+
+
+@pytest.mark.asyncio
+async def test_resumed_escalations_share_one_connection(monkeypatch):
+    connections = {"open": 0, "max": 0}
+
+    def setup_connection(host, port):
+        connections["open"] += 1
+        connections["max"] = max(connections["max"], connections["open"])
+        conn = MagicMock()
+        conn.close.side_effect = lambda: connections.update(open=connections["open"] - 1)
+        return conn
+
+    def get_notifications_for_jobs(job_ids, conn, since):
+        # admins of even jobs responded
+        return {job_id: [NotificationData(job_id, since, job_id % 2 == 0, 1, job_id)] for job_id in job_ids}
+
+    sent = []
+    monkeypatch.setattr(coroutines.db_access, "setup_connection", setup_connection)
+    monkeypatch.setattr(coroutines.db_access, "get_notifications_for_jobs", MagicMock(side_effect=get_notifications_for_jobs))
+    monkeypatch.setattr(coroutines, "write_queue", MagicMock(save_notification=AsyncMock(return_value=1),
+                                                             set_job_inactive=AsyncMock()))
+    monkeypatch.setattr(coroutines, "send_alert", lambda to, url, notification_id: sent.append(to))
+    monkeypatch.setattr(coroutines, "RECOVERY_READ_BATCH", 1000)
+
+    time_sent = datetime.now() - timedelta(seconds=2)
+    pending = [(job(job_id)._replace(is_active=False), NotificationData(job_id, time_sent, False, 1, job_id))
+               for job_id in range(1, 3001)]
+    await asyncio.wait_for(coroutines.resume_escalations(pending, workers=4), 5)
+
+    assert connections["max"] == 1
+    assert coroutines.db_access.get_notifications_for_jobs.call_count == 3
+    assert len(sent) == 1500
+    coroutines.write_queue.set_job_inactive.assert_not_called()
@@ -6,18 +6,21 @@ sys.path.append(str(server_dir))
 
 import pytest
 import pytest_postgresql
-from datetime import datetime
+import asyncio
+from prometheus_client import REGISTRY
+from datetime import datetime, timedelta
 import db_access
-from common import JobData, NotificationData
+from common import JobData, NotificationData, JobStatsData, AlertTimings
 
 
 def setup_db(conn):
-    setup_file = server_dir / "db_migrations/V2__setup.sql"
-    with open(setup_file, 'r') as file:
-        sql_script = file.read()
-    
+    migrations = sorted((server_dir / "db_migrations").glob("V*__*.sql"),
+                        key=lambda path: int(path.name[1:].split("__")[0]))
     cursor = conn.cursor()
-    cursor.execute(sql_script)
+    for setup_file in migrations:
+        with open(setup_file, 'r') as file:
+            sql_script = file.read()
+        cursor.execute(sql_script)
     conn.commit()
 
 
@@ -62,6 +65,23 @@ def test_db_access_set_job_inactive(postgresql):
     cursor.close()
 
 
+def test_db_access_set_job_active(postgresql):
+    setup_db(postgresql)
+
+    cursor = postgresql.cursor()
+    cursor.execute("INSERT INTO jobs VALUES (DEFAULT, 'mail1@example.com', 'mail2@example.com', 'http://example.com', 10, 20, 30, 0, false) RETURNING job_id;")
+    job_id = cursor.fetchone()[0]
+    postgresql.commit()
+
+    assert not db_access.set_job_active(job_id, 1, postgresql)
+    assert db_access.set_job_active(job_id, 0, postgresql)
+    assert not db_access.set_job_active(job_id, 0, postgresql)
+    assert db_access.get_active_job_ids(postgresql, 0) == {job_id}
+    assert not db_access.set_job_active(job_id + 1, 0, postgresql)
+
+    cursor.close()
+
+
 def test_db_access_save_job(postgresql):
     setup_db(postgresql)
 
@@ -88,6 +108,26 @@ def test_db_access_save_job(postgresql):
     assert result[0] == job_id
 
 
+def test_db_access_save_job_idempotent(postgresql):
+    setup_db(postgresql)
+    job = JobData(-1, "mail1@example.com", "mail2@example.com", "http://example.com", 30, 10, 200, True)
+
+    saved, created = db_access.save_job_idempotent(job, "key-1", postgresql, 1)
+    assert created and saved == job._replace(job_id=saved.job_id)
+    retried, created = db_access.save_job_idempotent(job, "key-1", postgresql, 1)
+    assert not created and retried == saved
+
+    # keys are scoped to the primary email, jobs without a key are never deduplicated
+    other, created = db_access.save_job_idempotent(job._replace(mail1="other@example.com"), "key-1", postgresql, 1)
+    assert created and other.job_id != saved.job_id
+    db_access.save_job(job, postgresql, 1)
+    db_access.save_job(job, postgresql, 1)
+
+    cursor = postgresql.cursor()
+    cursor.execute("SELECT count(*) FROM jobs;")
+    assert cursor.fetchone()[0] == 4
+
+
 def test_db_access_get_jobs(postgresql):
     setup_db(postgresql)
 
@@ -230,3 +270,206 @@ def test_db_access_get_notifications_for_jobs(postgresql):
 
     notification_ids_3 = [n.notification_id for n in notifications[3]]
     assert 4 in notification_ids_3
+
+
+def test_db_access_save_and_get_job_stats(postgresql):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    minute = datetime(2024, 1, 1, 12, 0)
+    db_access.save_job_stats([
+        JobStatsData(1, minute, 10, 2, 500, 90),
+        JobStatsData(1, minute + timedelta(minutes=1), 12, 0, 600, 80),
+        JobStatsData(2, minute, 1, 1, 5, 5),
+    ], postgresql)
+    # flushing a bucket again overwrites it with the newer totals
+    db_access.save_job_stats([JobStatsData(1, minute, 11, 3, 550, 95)], postgresql)
+
+    stats = db_access.get_job_stats(1, minute, postgresql)
+    assert stats == [
+        JobStatsData(1, minute, 11, 3, 550, 95),
+        JobStatsData(1, minute + timedelta(minutes=1), 12, 0, 600, 80),
+    ]
+    assert db_access.get_job_stats(1, minute + timedelta(minutes=1), postgresql) == stats[1:]
+
+    assert db_access.delete_job_stats_before(minute + timedelta(minutes=1), postgresql) == 2
+    assert db_access.get_job_stats(2, minute, postgresql) == []
+
+
+@pytest.mark.asyncio
+async def test_write_behind_queue_groups_writes_in_one_transaction(postgresql):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    queue = db_access.WriteBehindQueue(lambda: postgresql, flush_interval=0.01)
+    labels = {"function": "save_notifications_and_set_jobs_inactive"}
+    batches_before = REGISTRY.get_sample_value("db_query_duration_seconds_count", labels) or 0
+
+    id1, id2, _, _ = await asyncio.gather(
+        queue.save_notification(NotificationData(-1, datetime.now(), False, 1, 1)),
+        queue.save_notification(NotificationData(-1, datetime.now(), False, 1, 2)),
+        queue.set_job_inactive(1),
+        queue.set_job_inactive(2),
+    )
+
+    assert REGISTRY.get_sample_value("db_query_duration_seconds_count", labels) == batches_before + 1
+    assert id1 != id2
+    assert db_access.get_notification_by_id(id2, postgresql).job_id == 2
+    assert db_access.get_active_job_ids(postgresql, 0) == set()
+    assert db_access.get_active_job_ids(postgresql, 1) == set()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_queue_flushes_full_batch_immediately(postgresql):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    queue = db_access.WriteBehindQueue(lambda: postgresql, flush_interval=60, max_batch=2)
+    ids = await asyncio.wait_for(asyncio.gather(
+        queue.save_notification(NotificationData(-1, datetime.now(), False, 1, 1)),
+        queue.save_notification(NotificationData(-1, datetime.now(), False, 2, 1)),
+    ), timeout=1)
+
+    assert len(set(ids)) == 2
+
+
+@pytest.mark.asyncio
+async def test_write_behind_queue_saves_alert_timings(postgresql):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    queue = db_access.WriteBehindQueue(lambda: postgresql, flush_interval=0.01)
+    decided = datetime.now()
+    notification_id = await queue.save_notification(NotificationData(-1, decided, False, 1, 1))
+    timings = AlertTimings(notification_id, decided - timedelta(seconds=3), decided,
+                           decided + timedelta(milliseconds=5), None)
+    await queue.save_alert_timings(timings)
+
+    assert db_access.get_alert_timings(notification_id, postgresql) == timings
+    assert db_access.get_notification_by_id(notification_id, postgresql).time_sent == decided
+
+
+@pytest.mark.asyncio
+async def test_write_behind_queue_propagates_errors():
+    queue = db_access.WriteBehindQueue(lambda: None, flush_interval=0.01)
+
+    with pytest.raises(ConnectionError):
+        await queue.set_job_inactive(1)
+
+
+def test_db_access_prepared_statements(postgresql, postgresql_proc, monkeypatch):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    monkeypatch.setenv("DB_USER", postgresql_proc.user)
+    monkeypatch.setenv("DB_PASS", postgresql_proc.password or "")
+    monkeypatch.setenv("DB_NAME", postgresql.info.dbname)
+    conn = db_access.setup_connection(postgresql_proc.host, postgresql_proc.port)
+    try:
+        for _ in range(2):
+            jobs = db_access.get_jobs_for_stateful_set(1, conn)
+            assert jobs == [EXAMPLE_JOBS[1], EXAMPLE_JOBS[2]]
+        notification_id = db_access.save_notification(NotificationData(-1, datetime.now(), False, 1, 2), conn)
+        assert db_access.get_notifications_for_jobs([1, 2], conn)[2][0].notification_id == notification_id
+        assert db_access.get_notifications_for_jobs([], conn) == {}
+
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM pg_prepared_statements;")
+        prepared = {row[0] for row in cursor.fetchall()}
+        assert {"get_jobs_for_stateful_set", "save_notification", "get_notifications_for_jobs"} <= prepared
+    finally:
+        conn.close()
+
+
+def test_db_access_get_notifications_for_jobs_since(postgresql):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    cursor = postgresql.cursor()
+    cursor.execute("INSERT INTO notifications VALUES (0, CURRENT_TIMESTAMP - interval '30 days', FALSE, 1, 1);")
+    cursor.execute("INSERT INTO notifications VALUES (1, CURRENT_TIMESTAMP, FALSE, 1, 1);")
+    postgresql.commit()
+
+    notifications = db_access.get_notifications_for_jobs([1], postgresql, datetime.now() - timedelta(days=1))
+    assert [n.notification_id for n in notifications[1]] == [1]
+    assert len(db_access.get_notifications_for_jobs([1], postgresql)[1]) == 2
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_db_access_maintain_notification_partitions(postgresql, archive):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    cursor = postgresql.cursor()
+    cursor.execute("SELECT create_notification_partitions((CURRENT_TIMESTAMP - interval '2 years')::timestamp, 0);")
+    cursor.execute("INSERT INTO notifications VALUES (0, CURRENT_TIMESTAMP - interval '2 years', FALSE, 1, 1);")
+    cursor.execute("INSERT INTO notifications VALUES (1, CURRENT_TIMESTAMP, FALSE, 1, 1);")
+    postgresql.commit()
+
+    removed = db_access.maintain_notification_partitions(3, datetime.now() - timedelta(days=365), archive, postgresql)
+    assert removed >= 12
+
+    notifications = db_access.get_notifications_for_jobs([1], postgresql)
+    assert [n.notification_id for n in notifications[1]] == [1]
+
+    cursor.execute("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'notifications_archive_p%';")
+    assert cursor.fetchone()[0] == (removed if archive else 0)
+    cursor.execute("SELECT count(*) FROM pg_tables WHERE tablename = %s;",
+                   ("notifications_p" + (datetime.now() + timedelta(days=62)).strftime("%Y%m"),))
+    assert cursor.fetchone()[0] == 1
+
+
+def test_db_access_archive_inactive_jobs(postgresql):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    cursor = postgresql.cursor()
+    # job 4 waits for the admin's response, job 5 was already escalated
+    for _ in range(2):
+        cursor.execute("INSERT INTO jobs VALUES (DEFAULT, 'mail4@example.com', 'mail5@example.com', 'http://service.com', 1000, 10, 100, 1, false);")
+    cursor.execute("INSERT INTO notifications VALUES (0, CURRENT_TIMESTAMP, FALSE, 1, 4);")
+    cursor.execute("INSERT INTO notifications VALUES (1, CURRENT_TIMESTAMP, FALSE, 1, 5);")
+    cursor.execute("INSERT INTO notifications VALUES (2, CURRENT_TIMESTAMP, FALSE, 2, 5);")
+    postgresql.commit()
+
+    since = datetime.now() - timedelta(days=1)
+    assert len(db_access.archive_inactive_jobs(1, since, 1, postgresql)) == 1
+    assert len(db_access.archive_inactive_jobs(1, since, 10, postgresql)) == 1
+    assert db_access.archive_inactive_jobs(1, since, 10, postgresql) == []
+
+    assert [job.job_id for job in db_access.get_jobs("mail4@example.com", postgresql)] == [4]
+    archived = db_access.get_archived_jobs("mail4@example.com", postgresql)
+    assert sorted(job.job_id for job in archived) == [3, 5]
+    assert archived[0]._replace(job_id=3) == EXAMPLE_JOBS[2]
+    assert len(db_access.get_notifications_for_jobs([5], postgresql)[5]) == 2
+
+
+def test_read_replica_falls_back_when_stale(postgresql, postgresql_proc, monkeypatch):
+    setup_db(postgresql)
+    insert_example_jobs(postgresql)
+
+    monkeypatch.setenv("DB_USER", postgresql_proc.user)
+    monkeypatch.setenv("DB_PASS", postgresql_proc.password or "")
+    monkeypatch.setenv("DB_NAME", postgresql.info.dbname)
+    clock = [0.0]
+    # the test server is a primary, its lag is 0
+    replica = db_access.ReadReplica(lambda: db_access.setup_connection(postgresql_proc.host, postgresql_proc.port),
+                                    max_lag=5, clock=lambda: clock[0])
+    try:
+        conn = replica.connection()
+        assert db_access.get_jobs("mail1@example.com", conn) == [EXAMPLE_JOBS[0]]
+        with pytest.raises(Exception):
+            conn.cursor().execute("DELETE FROM jobs;")
+        assert replica.caught_up_connection(db_access.get_wal_lsn(postgresql)) is conn
+
+        monkeypatch.setattr(db_access, "get_replication_lag", lambda conn: 60.0)
+        # the lag is checked again only after the check interval
+        assert replica.connection() is conn
+        clock[0] += 1
+        assert replica.connection() is None
+    finally:
+        conn.close()
+
+    unreachable = db_access.ReadReplica(lambda: None, max_lag=5)
+    assert unreachable.connection() is None
+    assert unreachable.caught_up_connection("0/0") is None
@@ -0,0 +1,73 @@
+import sys
+from pathlib import Path
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+import asyncio
+import socket
+
+import pytest
+import dns_cache
+from dns_cache import CachingResolver
+
+
+class FakeResolver:
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return [{"hostname": host, "host": "10.0.0.1", "port": port, "family": family, "proto": 0, "flags": 0}]
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_of_a_host_are_resolved_once():
+    fake = FakeResolver()
+    resolver = CachingResolver(ttl=30, stale_seconds=300, resolver=fake)
+
+    results = await asyncio.gather(*(resolver.resolve("example.com", 80) for _ in range(10)))
+    assert all(result[0]["host"] == "10.0.0.1" for result in results)
+    await resolver.resolve("example.com", 80)
+    assert fake.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_entry_is_served_while_the_resolver_fails():
+    fake = FakeResolver()
+    clock = [1000.0]
+    resolver = CachingResolver(ttl=30, stale_seconds=300, resolver=fake, clock=lambda: clock[0])
+    await resolver.resolve("example.com", 80)
+    fake.error = socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution")
+
+    clock[0] += 60
+    assert (await resolver.resolve("example.com", 80))[0]["host"] == "10.0.0.1"
+    assert fake.calls == 2
+
+    clock[0] += 300
+    with pytest.raises(socket.gaierror):
+        await resolver.resolve("example.com", 80)
+
+
+def test_prefetched_and_expiring_hosts_are_refreshed():
+    resolver = CachingResolver(ttl=30, stale_seconds=300, resolver=FakeResolver())
+    resolver.prefetch("http://example.com/health")
+    resolver.prefetch("https://example.org:8443/")
+    resolver.prefetch("not a url")
+    assert sorted(resolver._due(1000.0)) == [("example.com", 80, 0), ("example.org", 8443, 0)]
+    assert resolver._due(1000.0) == []
+
+    used = dns_cache.CacheEntry([], expires=1030.0, last_used=1000.0)
+    unused = dns_cache.CacheEntry([], expires=1030.0, last_used=600.0)
+    resolver._entries = {("used", 80, 0): used, ("unused", 80, 0): unused}
+    assert resolver._due(1010.0) == []
+    assert resolver._due(1025.0) == [("used", 80, 0)]
+    # entries of hosts not pinged anymore are dropped
+    assert ("unused", 80, 0) not in resolver._entries
@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+from common import JobData
+from job_index import JobIndex
+
+
+def job(job_id: int, mail1: str = "a@example.com", url: str = "http://a.com/", is_active: bool = True) -> JobData:
+    return JobData(job_id, mail1, "b@example.com", url, 1000, 5000, 1000, is_active)
+
+
+def test_jobs_are_listed_by_email_and_url():
+    index = JobIndex()
+    index.add(job(2))
+    index.add(job(1, url="http://b.com/", is_active=False))
+    index.add(job(3, mail1="c@example.com"))
+
+    assert index.by_email("a@example.com") == [job(1, url="http://b.com/", is_active=False), job(2)]
+    assert [j.job_id for j in index.by_url("http://a.com/")] == [2, 3]
+    assert index.by_email("unknown@example.com") == []
+
+    index.remove(2)
+    index.remove(2)
+    assert [j.job_id for j in index.by_url("http://a.com/")] == [3]
+    # a re-added job replaces its previous entries
+    index.add(job(3, mail1="d@example.com"))
+    assert index.by_email("c@example.com") == []
+    assert len(index) == 2
+
+
+def test_activity_follows_the_database():
+    index = JobIndex()
+    for job_id in range(1, 4):
+        index.add(job(job_id))
+    index.set_active(1, False)
+    assert [j.is_active for j in index.by_email("a@example.com")] == [False, True, True]
+
+    # job 2 was deleted through another pod, job 1 re-armed, job 9 is not indexed
+    index.sync_active({1, 3, 9})
+    assert [j.is_active for j in index.by_email("a@example.com")] == [True, False, True]
+    index.set_active(9, True)
+    index.add(job(9, mail1="e@example.com", is_active=False))
+    assert not index.by_email("e@example.com")[0].is_active
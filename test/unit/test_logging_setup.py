@@ -0,0 +1,73 @@
+import sys
+from pathlib import Path
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+import logging
+import queue
+from prometheus_client import REGISTRY
+import logging_setup
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def dropped(reason):
+    return REGISTRY.get_sample_value("log_records_dropped_total", {"reason": reason}) or 0
+
+
+def test_queue_logging_exports_snapshots_off_thread():
+    logger = logging.getLogger()
+    target = ListHandler()
+    original_handlers, original_level = logger.handlers[:], logger.level
+    for handler in original_handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(target)
+    logger.setLevel(logging.INFO)
+    try:
+        logging_setup.start_queue_logging(batch_size=10, queue_size=100, sample_rate=1.0)
+        assert target not in logger.handlers
+
+        log_data = {"function_name": "test"}
+        logging.info("job %s added", 1, extra={"json_fields": log_data})
+        log_data["job_id"] = 1
+        logging_setup.stop_queue_logging()
+
+        assert target in logger.handlers
+        assert [record.getMessage() for record in target.records] == ["job 1 added"]
+        assert target.records[0].json_fields == {"function_name": "test"}
+    finally:
+        logging_setup.stop_queue_logging()
+        logger.removeHandler(target)
+        for handler in original_handlers:
+            logger.addHandler(handler)
+        logger.setLevel(original_level)
+
+
+def test_full_queue_drops_records():
+    handler = logging_setup.NonBlockingQueueHandler(queue.Queue(1))
+    before = dropped("queue_full")
+    for _ in range(3):
+        handler.handle(logging.makeLogRecord({"msg": "Service added", "levelno": logging.INFO}))
+    assert handler.queue.qsize() == 1
+    assert dropped("queue_full") - before == 2
+
+
+def test_sampling_filter_only_samples_request_received_info_logs():
+    sampling_filter = logging_setup.SamplingFilter(0.0)
+    before = dropped("sampled")
+
+    def record(msg, level=logging.INFO):
+        return logging.makeLogRecord({"msg": msg, "levelno": level})
+
+    assert not sampling_filter.filter(record("Add service request received"))
+    assert sampling_filter.filter(record("Add service request received", logging.WARNING))
+    assert sampling_filter.filter(record("Service added"))
+    assert dropped("sampled") - before == 1
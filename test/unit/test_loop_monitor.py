@@ -0,0 +1,49 @@
+import sys
+from pathlib import Path
+
+server_dir = Path(__file__).parent.parent.parent / "server"
+sys.path.append(str(server_dir))
+
+import pytest
+import asyncio
+import time
+from prometheus_client import REGISTRY
+import loop_monitor
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+def stalls_at(call_site_prefix: str) -> float:
+    total = 0
+    for metric in REGISTRY.collect():
+        if metric.name != "event_loop_stalls":
+            continue
+        for sample in metric.samples:
+            if sample.name.endswith("_total") and sample.labels["call_site"].startswith(call_site_prefix):
+                total += sample.value
+    return total
+
+
+@pytest.mark.asyncio
+async def test_watchdog_reports_blocking_call_site():
+    lag_task = asyncio.create_task(loop_monitor.event_loop_lag_task())
+    loop_monitor.start_watchdog()
+    await asyncio.sleep(0.1)
+
+    before = stalls_at("test_loop_monitor.py:blocking_call")
+    blocking_call()
+    await asyncio.sleep(0.1)
+    lag_task.cancel()
+
+    assert stalls_at("test_loop_monitor.py:blocking_call") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_sample_stacks_sees_event_loop_thread():
+    loop_monitor.start_watchdog()
+    counts = await asyncio.get_running_loop().run_in_executor(None, loop_monitor.sample_stacks, 0.2, 0.01)
+
+    assert sum(counts.values()) > 0
+    assert all(isinstance(stack, str) for stack in counts)